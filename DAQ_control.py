@@ -2,24 +2,42 @@ from mcculw import ul
 from mcculw.enums import InterfaceType
 from mcculw.device_info import DaqDeviceInfo
 from mcculw.enums import DigitalIODirection
-from mcculw.device_info import DioInfo
 from mcculw.ul import ULError
+from mcculw.enums import ScanOptions, FunctionType
+import ctypes
+from time import perf_counter
 
+import numpy as np
+
+from ramp import RampPlanner, RAMP_RATE
 
-class DAQ:
 
-    output_range = None
-    ao_device = None
-    daq_device = None
+class DAQ:
+    """MCC DAQ driver. One instance holds the board, its analog output range and digital port, and the output state:
+    the code last written to every analog output channel and the last digital port value. Voltages are converted to
+    output codes with the range and resolution read at connection (no ul.from_eng_units call per write), and writes
+    that don't change an output code are skipped, so holding a voltage (e.g. 0 V while unlocked) costs no USB transfer."""
 
-    def __init__(self):
-        pass
+    def __init__(self, board_num=1):
+        self.board_num = board_num
+        self.output_range = None  # set by DAQconnect, None if no DAQ was found
+        self.daq_device = None
+        self.port = None  # digital output port (flipper mirror)
+        self.num_channels = 0  # analog outputs
+        self.range_min = 0.  # V, output code 0
+        self.volts_per_code = 1.
+        self.max_code = 0
+        self.supports_scan = False  # hardware timed analog output (daq_ramp), otherwise ramps are single steps
+        self.ramps = RampPlanner()  # voltage trajectory of each output channel
+        self.scan_buffer = None  # memory handle of the output scan running
+        self.codes = {}  # analog output channel: code last written (None while unknown, e.g. after a stopped scan)
+        self.port_value = None  # digital port value last written
+        self.writes = 0  # USB writes made (analog and digital)
+        self.skipped = 0  # writes skipped as the output already had the value
 
-    @staticmethod
-    def DAQconnect():
+    def DAQconnect(self):
         """Connects to DAQ. Based on Output Analog example code from MCC. Currently, set up for USB DAQ.
         Can connect to ethernet DAQ by changing connection code, may need other software /code to connect to IP."""
-        output_channel = 0
         interface_type = InterfaceType.ANY
         try:
             # Get descriptors for all the available DAQ devices.
@@ -34,69 +52,134 @@ class DAQ:
             for i in range(number_of_devices):
                 print('  [', i, '] ', devices[i].product_name, ' (',
                       devices[i].unique_id, ')', sep='')
-            DAQ.board_num = 1
-            if DAQ.board_num not in range(number_of_devices):
+            if self.board_num not in range(number_of_devices):
                 raise RuntimeError('Error: Invalid descriptor index')
-            print('here')
             # Create the DAQ device from the descriptor at the specified index.
-            #ul.create_daq_device(DAQ.board_num, devices[DAQ.board_num])
-            daq_dev_info = DaqDeviceInfo(DAQ.board_num)
+            #ul.create_daq_device(self.board_num, devices[self.board_num])
+            daq_dev_info = DaqDeviceInfo(self.board_num)
             dio_info = daq_dev_info.get_dio_info()
             if not daq_dev_info.supports_analog_output:
-                raise Exception('Error: The connected device does not support analog output. Please check device connection or the value of DAQ.board_num in DAQ_control.py')
-            
+                raise Exception('Error: The connected device does not support analog output. Please check device connection or the value of board_num in DAQ_control.py')
+
             ao_info = daq_dev_info.get_ao_info()
             if not daq_dev_info.supports_digital_io:
                 raise Exception('Error: The DAQ device does not support '
                                 'digital I/O')
-            global port
-            port = next((port for port in dio_info.port_info if port.supports_output),
-                        None)
-            if not port:
+            self.port = next((port for port in dio_info.port_info if port.supports_output),
+                             None)
+            if not self.port:
                 raise Exception('Error: The DAQ device does not support '
                                 'digital output')
 
-            ul.d_config_port(DAQ.board_num, port.type, DigitalIODirection.OUT)
-            print(port.type)
-            DAQ.output_range = ao_info.supported_ranges[0]
-            print('here2')
-            print('    Function demonstrated: AoDevice.a_out')
-            print('    Channel: ',  output_channel)
-            print('    Range:', DAQ.output_range.name)
-
+            ul.d_config_port(self.board_num, self.port.type, DigitalIODirection.OUT)
+            self.output_range = ao_info.supported_ranges[0]
+            self.num_channels = ao_info.num_chans
+            # code <-> voltage conversion of the range, read once
+            self.max_code = 2 ** ao_info.resolution - 1
+            self.range_min = ul.to_eng_units(self.board_num, self.output_range, 0)
+            self.volts_per_code = (ul.to_eng_units(self.board_num, self.output_range, self.max_code) -
+                                   self.range_min) / self.max_code
+            self.supports_scan = ao_info.supports_scan
+            print('    Analog outputs:', self.num_channels, ' Range:', self.output_range.name,
+                  ' Resolution:', ao_info.resolution, 'bits')
+            print('    Digital port:', self.port.type)
+            if not self.supports_scan:
+                print('    No analog output scan, voltage ramps are written as steps')
 
         except RuntimeError as error:
             print('\n', error)
-            DAQ.output_range = None
+            self.output_range = None
 
-    @staticmethod
-    def daq_output(correction):
-        """Outputs calculated voltage to DAQ channel VOUT0"""
-        try:
-            # try:s
-            output_channel = 0
-            out_val = ul.from_eng_units(DAQ.board_num,DAQ.output_range, correction)
-
-            ul.a_out(DAQ.board_num, output_channel, DAQ.output_range, out_val)
-        # except (ValueError, NameError, SyntaxError, AttributeError):
-        #    pass
-        except KeyboardInterrupt:
-            pass
-    @staticmethod
-    def daq_mirror_flipper_on():
-            ul.d_out(DAQ.board_num, port.type, 0xFF)
-            print('up daq')
-    @staticmethod
-    def daq_mirror_flipper_off():
-            ul.d_out(DAQ.board_num, port.type, 0x00)
-            print('down daq')
-    @staticmethod
-    def daq_disconnect():
-        """Disconnects from DAQ device"""
-        DAQ().daq_output(0)
-        if DAQ.daq_device is not None:
+    def code(self, voltage):
+        """Output code of a voltage (nearest, clipped to the range)"""
+        return int(min(max(round((voltage - self.range_min) / self.volts_per_code), 0), self.max_code))
+
+    def daq_output(self, correction, output_channel=0):
+        """Outputs calculated voltage to DAQ channel VOUT<output_channel> (set per laser, for multi laser locking)"""
+        now = perf_counter()
+        if self.scan_buffer is not None:
+            # the channel can't be written while a scan runs. Other channels still ramping carry on in a new scan
+            self.stop_scan(now)
+            self.ramps.step(output_channel, correction, now)
+            if self.ramps.ramping(now):
+                self.start_scan(now)
+                return
+        self.ramps.step(output_channel, correction, now)
+        code = self.code(correction)
+        if self.codes.get(output_channel) == code:
+            self.skipped += 1
+            return
+        ul.a_out(self.board_num, output_channel, self.output_range, code)
+        self.codes[output_channel] = code
+        self.writes += 1
+
+    def daq_ramp(self, target, output_channel=0, duration=0.1):
+        """Moves VOUT<output_channel> to target along a raised cosine of duration sec, played by the DAQ in the
+        background (analog output scan). Replaces the ramp running, starting from the voltage it reached"""
+        now = perf_counter()
+        if not self.supports_scan or duration <= 0:
+            self.daq_output(target, output_channel)
+            return
+        self.stop_scan(now)
+        self.ramps.ramp(output_channel, target, duration, now)
+        self.start_scan(now)
+
+    def start_scan(self, now):
+        """Plays the trajectories of all channels from now until the last ramp ends. The outputs hold the last sample"""
+        low_chan, high_chan, rate, samples = self.ramps.samples(now, RAMP_RATE)
+        codes = np.clip(np.round((samples - self.range_min) / self.volts_per_code), 0, self.max_code).astype(np.uint16)
+        memhandle = ul.win_buf_alloc(codes.size)
+        ctypes.memmove(memhandle, codes.ctypes.data, codes.nbytes)  # channels interleaved, as the scan outputs them
+        self.scan_buffer = memhandle
+        ul.a_out_scan(self.board_num, low_chan, high_chan, codes.size, int(round(rate)), self.output_range, memhandle,
+                      ScanOptions.BACKGROUND)
+        self.writes += 1
+        for channel, code in zip(range(low_chan, high_chan + 1), codes[-1]):
+            self.codes[channel] = int(code)  # held once the scan ends
+
+    def stop_scan(self, now):
+        if self.scan_buffer is not None:
+            ul.stop_background(self.board_num, FunctionType.AOFUNCTION)
+            ul.win_buf_free(self.scan_buffer)
+            self.scan_buffer = None
+            if self.ramps.ramping(now):
+                self.codes = dict.fromkeys(self.codes)  # stopped part way, the outputs are somewhere on the ramp
+
+    def digital_output(self, value):
+        """Writes the digital port, unless it already has value"""
+        if value == self.port_value:
+            self.skipped += 1
+            return
+        ul.d_out(self.board_num, self.port.type, value)
+        self.port_value = value
+        self.writes += 1
+
+    def board_name(self):
+        """Reads the board name from the DAQ. Changes no output, raises ULError if the DAQ doesn't answer (health check)"""
+        return ul.get_board_name(self.board_num)
+
+    def daq_mirror_flipper_on(self):
+        self.digital_output(0xFF)
+        print('up daq')
+
+    def daq_mirror_flipper_off(self):
+        self.digital_output(0x00)
+        print('down daq')
+
+    def daq_disconnect(self):
+        """Sets the analog outputs to 0 V and disconnects from DAQ device"""
+        for channel in list(self.codes) or [0]:
+            self.daq_output(0, channel)
+        if self.daq_device is not None:
             # Disconnect from the DAQ device.
-            if DAQ.daq_device.is_connected():
-                DAQ.daq_device.disconnect()
+            if self.daq_device.is_connected():
+                self.daq_device.disconnect()
             # Release the DAQ device resource.
-            DAQ.daq_device.release()
+            self.daq_device.release()
+
+
+def connect():
+    """Connects to the DAQ and returns it. Run at start up, and again by supervisor.SupervisedDAQ after a lost connection"""
+    daq = DAQ()
+    daq.DAQconnect()
+    return daq
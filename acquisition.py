@@ -0,0 +1,177 @@
+import queue
+import threading
+from time import sleep
+from collections import namedtuple
+from concurrent.futures import Future
+
+import metrics
+from controls import Signal
+from supervisor import ConnectionLost
+
+# One acquisition/lock cycle. Fields in the order returned by Signal.final_data
+Frame = namedtuple("Frame", ["waveform", "peaks_loc", "separation", "pos", "num_peaks", "scale", "laser_lock_status",
+                             "lost_peaks", "trigger_data", "correction", "voltage_out", "uncal_sep", "len_waveform",
+                             "laser_locks"])
+OUTAGE_WAIT = 0.1  # sec between frame attempts while the connection is down
+
+
+class LockSettings:
+    """GUI state needed by Signal. The GUI changes values with update(), the acquisition thread copies them once per frame.
+    Keys are the Signal arguments plus rapid_data and correction_history (arguments of final_data)."""
+
+    def __init__(self, **settings):
+        self._lock = threading.Lock()
+        self._settings = dict(settings)
+
+    def update(self, **settings):
+        with self._lock:
+            self._settings.update(settings)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._settings)
+
+
+class AcquisitionThread(threading.Thread):
+    """Owns the oscilloscope and DAQ handles. Runs Signal.final_data (scope query, peak finding, DAQ write) as fast as the
+    scope returns frames and pushes each result into a bounded queue, dropping the oldest frame if the GUI falls behind.
+    The lock loop rate is therefore set by the scope and not by the GUI redraw.
+    Any other hardware access (GUI buttons, flipper) is queued with call() and run between frames."""
+
+    def __init__(self, instr, daq, settings, max_frames=4, call_timeout=10, recorder=None):
+        super().__init__(name="acquisition", daemon=True)
+        self.instr = instr
+        self.daq = daq
+        self.settings = settings
+        self.recorder = recorder  # recorder.TraceRecorder, every frame is recorded (not only those shown by the GUI)
+        self.call_timeout = call_timeout  # sec. Longest a GUI query waits for the current frame to finish
+        self.frames = queue.Queue(maxsize=max_frames)
+        self.commands = queue.Queue()
+        self.running = False
+        self.dropped_frames = 0  # frames thrown away because the GUI did not collect them in time
+        self.error = None  # exception that stopped the thread, re-raised in the GUI by get_frames
+        self.connection_lost = None  # ConnectionLost while the scope or DAQ is reconnecting, None when frames come in
+        self.reconnections = 0  # outages recovered from, the GUI refreshes the scope pos/scale after each
+
+    def start(self):
+        self.running = True
+        super().start()
+
+    def run(self):
+        try:
+            while self.running:
+                self.run_commands()
+                settings = self.settings.snapshot()
+                rapid_data = settings.pop("rapid_data")
+                correction_history = settings.pop("correction_history")
+                try:
+                    frame = Frame._make(Signal(**settings).final_data(self.instr, self.daq, rapid_data,
+                                                                            correction_history))
+                except ConnectionLost as error:
+                    # scope or DAQ reconnecting (supervisor.py). No frames until it is back, GUI calls still run
+                    self.connection_lost = error
+                    sleep(OUTAGE_WAIT)
+                    continue
+                if self.connection_lost is not None:
+                    self.connection_lost = None
+                    self.reconnections += 1
+                if self.recorder is not None:
+                    self.recorder.record(frame)
+                if metrics.enabled:
+                    metrics.frame_done(frame)
+                self.put_frame(frame)
+        except Exception as error:
+            self.error = error
+        finally:
+            self.running = False
+            self.run_commands()  # don't leave the GUI waiting on a queued call
+
+    def stop(self, timeout=5):
+        """Stops the thread after the current frame. Waits at most timeout sec (a scope query can block)"""
+        self.running = False
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+
+    def put_frame(self, frame):
+        """Adds frame to the queue. If the queue is full the oldest frame is dropped"""
+        while True:
+            try:
+                self.frames.put_nowait(frame)
+                return
+            except queue.Full:
+                try:
+                    self.frames.get_nowait()
+                    self.dropped_frames += 1
+                except queue.Empty:
+                    pass
+
+    def get_frames(self, timeout=0):
+        """Returns all frames produced since the last call, oldest first. The last one is the newest frame.
+        Waits up to timeout sec for a frame if none are ready."""
+        frames = []
+        try:
+            frames.append(self.frames.get(timeout=timeout) if timeout != 0 else self.frames.get_nowait())
+            while True:
+                frames.append(self.frames.get_nowait())
+        except queue.Empty:
+            pass
+        if not frames and self.error is not None:
+            raise RuntimeError("Acquisition thread stopped") from self.error
+        return frames
+
+    def call(self, func, *args, wait=True, **kwargs):
+        """Runs func(*args, **kwargs) in the acquisition thread, between frames.
+        If wait, blocks until it has run and returns the result, otherwise returns straight away."""
+        if threading.current_thread() is self or not self.running:
+            return func(*args, **kwargs)
+        future = Future()
+        self.commands.put((func, args, kwargs, future))
+        if wait:
+            return future.result(timeout=self.call_timeout)
+        future.add_done_callback(report_call_error)
+        return None
+
+    def run_commands(self):
+        """Runs queued hardware calls"""
+        while True:
+            try:
+                func, args, kwargs, future = self.commands.get_nowait()
+            except queue.Empty:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as error:
+                future.set_exception(error)
+
+
+def report_call_error(future):
+    """Prints errors from hardware calls nobody waited for"""
+    if future.exception() is not None:
+        print("Hardware call failed:", future.exception())
+
+
+class HardwareProxy:
+    """Stands in for the instrument or DAQ outside the acquisition thread. Method calls are run by the acquisition thread.
+    Only methods listed in wait_for (e.g. queries) block for the result, everything else (writes) is fire and forget."""
+
+    def __init__(self, target, acquisition, wait_for=()):
+        self._target = target
+        self._acquisition = acquisition
+        self._wait_for = wait_for
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def proxied(*args, **kwargs):
+            return self._acquisition.call(attr, *args, wait=name in self._wait_for, **kwargs)
+
+        return proxied
+
+    def submit(self, func, *args, **kwargs):
+        """Runs func(target, *args, **kwargs) in the acquisition thread, between frames. Doesn't wait for it, e.g. for
+        long jobs (acquisition_profiles.tune_profiles) that report back to the GUI with window.write_event_value"""
+        self._acquisition.call(func, self._target, *args, wait=False, **kwargs)
@@ -0,0 +1,117 @@
+from collections import OrderedDict, namedtuple
+from time import perf_counter
+
+import numpy as np
+
+import controls
+
+'''Oscilloscope acquisition profiles (waveform rate, points, averaging, decimation). tune_profiles measures each candidate
+on the live signal and picks the one giving the best lock error bandwidth for the selected laser. The chosen profile is
+saved per laser (laser_data.csv, column after the DAQ channel) and applied when the laser is selected.'''
+
+# waveform_rate: ACQuire:WRATe, points: CHANnel1:DATA:POINts, average: ACQuire:AVERage:COUNt (1 turns averaging off),
+# decimation: CHANnel1:TYPE. Interpolation stays SMHD (osc_connection.connect), needed for a constant point spacing
+AcquisitionProfile = namedtuple("AcquisitionProfile", ["waveform_rate", "points", "average", "decimation"])
+PROFILES = OrderedDict([
+    ("auto", AcquisitionProfile("AUTO", "DEFault", 2, "PDETect")),  # osc_connection.connect settings
+    ("auto-avg8", AcquisitionProfile("AUTO", "DEFault", 8, "PDETect")),
+    ("auto-max-points", AcquisitionProfile("AUTO", "MAXimum", 2, "PDETect")),
+    ("max-samples", AcquisitionProfile("MSAMples", "MAXimum", 2, "PDETect")),
+    ("rapid", AcquisitionProfile("MWAVeform", "DEFault", 2, "PDETect")),  # rapid data collection button
+    ("rapid-no-avg", AcquisitionProfile("MWAVeform", "DEFault", 1, "SAMPle")),
+    ("rapid-hires", AcquisitionProfile("MWAVeform", "DEFault", 4, "HRESolution")),
+])
+DEFAULT_PROFILE = "auto"
+
+# Measured performance of a profile. frames_per_second includes the transfer and peak finding, transfer_bytes is per
+# waveform, noise is the frame to frame noise of the peak separation (MHz), valid is the fraction of frames with the
+# expected number of dips, bandwidth (Hz) from lock_bandwidth
+ProfileMeasurement = namedtuple("ProfileMeasurement", ["name", "frames_per_second", "transfer_bytes", "points", "noise",
+                                                       "valid", "bandwidth"])
+TUNE_FRAMES = 30  # frames measured per profile
+SETTLE_FRAMES = 3  # frames thrown away after changing the profile (averaging restarts)
+MIN_VALID = 0.8  # profiles with fewer frames with the expected dips aren't used
+LOCK_PRECISION = 1.  # MHz, separation error the lock has to resolve
+ASCII_BYTES = 11  # bytes per point of an ASCii transfer ("-1.2345E-02,")
+
+
+def apply_profile(instr, name):
+    """Sets the oscilloscope acquisition to the profile"""
+    profile = PROFILES[name]
+    instr.write('ACQuire:WRATe ' + profile.waveform_rate)
+    instr.write('CHANnel1:DATA:POINts ' + profile.points)
+    instr.write('CHANnel1:TYPE ' + profile.decimation)
+    if profile.average > 1:
+        instr.write('CHANnel1:ARIThmetics AVERage')
+        instr.write(f'ACQuire:AVERage:COUNt {profile.average}')
+    else:
+        instr.write('CHANnel1:ARIThmetics OFF')
+    controls.full_search.set()  # number of points may have changed, search the whole trace again
+
+
+def measure_profile(instr, name, mhz_per_screen, period, expected_peaks=2, frames=TUNE_FRAMES):
+    """Applies the profile and measures it on frames waveforms. mhz_per_screen is the calibration (in_MHz * points),
+    period the laser's voltage response rate (sec)"""
+    apply_profile(instr, name)
+    for _ in range(SETTLE_FRAMES):
+        controls.get_trace(instr, False, expected_peaks)
+    separations = []
+    lengths = []
+    start = perf_counter()
+    for _ in range(frames):
+        waveform, peaks_loc, num_peaks, separation, peaks, trigger_data, separation_var = controls.get_trace(instr, False, expected_peaks)
+        lengths.append(len(waveform))
+        if num_peaks == expected_peaks:
+            separations.append(separation / len(waveform))  # fraction of the screen, doesn't depend on the points
+    frames_per_second = frames / (perf_counter() - start)
+    points = int(np.median(lengths))
+    dtype = controls.DATA_FORMATS[controls.data_format]
+    transfer_bytes = points * (np.dtype(dtype).itemsize if dtype is not None else ASCII_BYTES)
+    # averaged frames are correlated, compare frames an averaging count apart. Differences remove the slow drift
+    lag = PROFILES[name].average
+    separations = np.array(separations) * mhz_per_screen
+    valid = len(separations) / frames
+    if valid >= MIN_VALID and len(separations) > lag + 1:
+        noise = np.std(separations[lag:] - separations[:-lag]) / np.sqrt(2)
+    else:
+        noise = np.inf
+    measurement = ProfileMeasurement(name, frames_per_second, transfer_bytes, points, noise, valid, 0.)
+    return measurement._replace(bandwidth=lock_bandwidth(measurement, period))
+
+
+def lock_bandwidth(measurement, period):
+    """Bandwidth (Hz) at which the lock error is known to LOCK_PRECISION: independent frames per second (averaged
+    frames count as one) divided by the frames needed to average the noise down to LOCK_PRECISION, up to the Nyquist
+    frequency. Not above the laser's voltage response rate (1 / (2 period)), a faster profile can't be used by the lock"""
+    if not np.isfinite(measurement.noise):
+        return 0.
+    independent_rate = measurement.frames_per_second / PROFILES[measurement.name].average
+    frames_needed = max(1., (measurement.noise / LOCK_PRECISION) ** 2)
+    bandwidth = independent_rate / frames_needed / 2
+    return min(bandwidth, 1 / (2 * period)) if period > 0 else bandwidth
+
+
+def tune_profiles(instr, mhz_per_screen, period, expected_peaks=2, names=None, frames=TUNE_FRAMES):
+    """Measures each profile (all of PROFILES by default) and applies the best: highest bandwidth, then lowest noise.
+    Takes several seconds per profile, the lock is paused while it runs. Returns the best name (None if no profile
+    saw the expected dips, the default profile is applied) and the measurements"""
+    measurements = [measure_profile(instr, name, mhz_per_screen, period, expected_peaks, frames)
+                    for name in (names or PROFILES)]
+    usable = [measurement for measurement in measurements if measurement.bandwidth > 0]
+    best = max(usable, key=lambda measurement: (measurement.bandwidth, -measurement.noise)).name if usable else None
+    apply_profile(instr, best or DEFAULT_PROFILE)
+    return best, measurements
+
+
+def print_measurements(measurements, best):
+    for measurement in measurements:
+        print(f"{measurement.name:>16}: {measurement.frames_per_second:6.2f} frames/s, {measurement.points:5d} points "
+              f"({measurement.transfer_bytes / 1000:.1f} kB), noise {measurement.noise:7.3f} MHz, "
+              f"{measurement.valid:4.0%} valid, bandwidth {measurement.bandwidth:.3f} Hz"
+              + ("  <- best" if measurement.name == best else ""))
+
+
+def laser_profile(dict_laser_info, laser_name):
+    """Acquisition profile saved for the laser, None if it has none"""
+    laser_info = dict_laser_info[laser_name]
+    return laser_info[9] if len(laser_info) >= 10 and laser_info[9] in PROFILES else None
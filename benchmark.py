@@ -0,0 +1,193 @@
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+from collections import defaultdict
+from types import SimpleNamespace
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+import controls
+from pid import DEFAULT_GAINS
+from pipeline import PipelinedScope
+from ring_buffer import RingBuffer
+from simulation import simulated_backends
+
+'''Lock loop benchmark. Runs Signal.final_data (get_trace -> find_peaks -> lock_laser -> DAQ write) and the plot update
+against the simulated oscilloscope/DAQ (synthetic or replayed traces) and reports per stage latency percentiles,
+iterations per second and memory allocated per iteration as JSON.
+    python benchmark.py --points 3000 --iterations 500 --output benchmark_results.json'''
+
+STAGES = ["transfer", "parse", "find_peaks", "control", "daq_write", "render", "total"]
+
+
+class StageTimer:
+    """Collects the time spent in each stage, summed over one iteration (e.g. transfer of both channels)"""
+
+    def __init__(self):
+        self.current = defaultdict(float)
+        self.results = defaultdict(list)
+
+    def timed(self, stage, func):
+        """Wraps func so its run time is added to stage"""
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.current[stage] += time.perf_counter() - start
+        return wrapper
+
+    def end_iteration(self):
+        # parse is everything in read_channel that isn't waiting for the data
+        self.current["parse"] = self.current.pop("read", 0.) - self.current["transfer"]
+        for stage in STAGES:
+            self.results[stage].append(self.current[stage])
+        self.current = defaultdict(float)
+
+
+class TimedInstrument:
+    """Oscilloscope wrapper timing the data queries as the transfer stage"""
+
+    def __init__(self, instr, timer):
+        self.instr = instr
+        self.query_str = timer.timed("transfer", instr.query_str)
+        self.query_bin_block = timer.timed("transfer", instr.query_bin_block)
+        if hasattr(instr, "read_frame"):
+            # pipelined, the data is read in another thread. Only the wait for the frame read ahead is timed
+            self.read_frame = timer.timed("read", timer.timed("transfer", instr.read_frame))
+
+    def __getattr__(self, name):
+        return getattr(self.instr, name)
+
+
+def make_signal(in_MHz, dict_laser_info):
+    """Signal set up as in gui_main with locking on, peaks identified and calibration done"""
+    return controls.Signal(pos=0.08, default_pos=0.08, change_pos=False, locking=True, in_MHz=in_MHz,
+                           continue_lock=True, scale=0.002, laser_lock_status=False, peaks_identified=True,
+                           ident_peaks=False, default_scale=0.002, dict_laser_info=dict_laser_info,
+                           laser_name="benchmark", show_trig_sig=True)
+
+
+def run(iterations, points, data_format, trace_file, realtime, render, track_allocations, pipeline=False):
+    """Runs the lock loop iterations times. Returns StageTimer results, bytes allocated per iteration (if tracked),
+    the simulated DAQ and the hidden latency of the pipelined scope (None if not pipelined)"""
+    laser_offset = 100.
+    # drift of the laser is switched off so the lock error doesn't change sign (only the code is being timed)
+    instr, daq = simulated_backends(points=points, trace_file=trace_file, realtime=realtime, laser_offset=laser_offset + 20,
+                                    laser_drift=0., seed=0)
+    controls.set_data_format(instr, data_format)
+    in_MHz = 300 * instr.scale / instr.fsr_scale / points  # calibration of the simulated scope
+    # response rate 0 and rapid_data True so a voltage is written every iteration
+    dict_laser_info = {"benchmark": [laser_offset, 0.08, 0.002, 1 / instr.mhz_per_volt, 0.] + list(DEFAULT_GAINS)}
+    correction_history = RingBuffer(10000)
+    timer = StageTimer()
+    scope = PipelinedScope(instr) if pipeline else None
+    timed_instr = TimedInstrument(scope or instr, timer)
+    timed_daq = SimpleNamespace(daq_output=timer.timed("daq_write", daq.daq_output))
+    if render:
+        from plots import WaveformPlot, ErrorPlot, ERROR_GRAPH_POINTS
+        fig = Figure(edgecolor="#242424", linewidth=2)
+        waveform_plot = WaveformPlot(FigureCanvasAgg(fig), fig.add_subplot(111))
+        fig_error = Figure(edgecolor="#242424", linewidth=2, figsize=(5, 2))
+        error_plot = ErrorPlot(FigureCanvasAgg(fig_error), fig_error.add_subplot(111))
+    # time the stages inside get_trace/signal_response by wrapping the functions they call
+    original = controls.read_channel, controls.signal, controls.lock_laser
+    controls.read_channel = timer.timed("read", controls.read_channel)
+    controls.signal = SimpleNamespace(find_peaks=timer.timed("find_peaks", original[1].find_peaks))
+    controls.lock_laser = timer.timed("control", controls.lock_laser)
+    allocated = []
+    try:
+        for _ in range(iterations):
+            if track_allocations:
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+            waveform, peaks_loc, separation, pos, num_peaks, scale, laser_lock_status, lost_peaks, trigger_data, correction, voltage_out, uncal_sep, len_waveform, laser_locks \
+                = make_signal(in_MHz, dict_laser_info).final_data(timed_instr, timed_daq, True,
+                                                                                correction_history)
+            if render:
+                render_start = time.perf_counter()
+                hene_peak = peaks_loc[0] if len(peaks_loc) else None
+                waveform_plot.update(waveform, peaks_loc, in_MHz, trigger_data, hene_peak, True, len_waveform)
+                error_plot.update(correction_history.view(ERROR_GRAPH_POINTS))
+                timer.current["render"] += time.perf_counter() - render_start
+            timer.current["total"] += time.perf_counter() - start
+            timer.end_iteration()
+            if track_allocations:
+                allocated.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        controls.read_channel, controls.signal, controls.lock_laser = original
+        if scope is not None:
+            scope.close()
+    return timer.results, allocated, daq, scope.hidden_latency() if scope is not None else None
+
+
+def summarise(durations):
+    """Latency statistics in ms"""
+    durations = np.asarray(durations) * 1000
+    return {"mean_ms": float(np.mean(durations)), "p50_ms": float(np.percentile(durations, 50)),
+            "p90_ms": float(np.percentile(durations, 90)), "p99_ms": float(np.percentile(durations, 99)),
+            "max_ms": float(np.max(durations))}
+
+
+def benchmark(iterations=500, points=3000, data_format="REAL,32", trace_file=None, realtime=False, render=True,
+              peak_refinement=None, peak_tracking=False, warmup=20, batch_frames=1, pipeline=False):
+    """Runs the benchmark and returns the results as a dictionary (see --help)"""
+    controls.peak_refinement = peak_refinement
+    controls.peak_tracking = peak_tracking
+    controls.batch_frames = batch_frames
+    run(warmup, points, data_format, trace_file, realtime, render, False, pipeline)
+    results, _, daq, hidden = run(iterations, points, data_format, trace_file, realtime, render, False, pipeline)
+    # separate run for allocations, tracemalloc slows everything down
+    tracemalloc.start()
+    try:
+        _, allocated, _, _ = run(min(iterations, 100), points, data_format, trace_file, realtime, render, True, pipeline)
+    finally:
+        tracemalloc.stop()
+    total = sum(results["total"])
+    return {
+        "config": {"iterations": iterations, "points": points, "data_format": data_format, "trace_file": trace_file,
+                   "realtime": realtime, "render": render, "peak_refinement": peak_refinement,
+                   "peak_tracking": peak_tracking, "batch_frames": batch_frames, "pipeline": pipeline},
+        "system": {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+                   "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "iterations_per_second": iterations / total,
+        "daq_writes": sum(1 for call in daq.calls if call[1] == "a_out"),
+        "pipeline": None if hidden is None else {"transfer_ms": hidden[0] * 1000, "wait_ms": hidden[1] * 1000,
+                                                 "hidden_fraction": hidden[2]},
+        "stages": {stage: summarise(results[stage]) for stage in STAGES},
+        "allocated_kib_per_iteration": {"mean": float(np.mean(allocated)) / 1024,
+                                        "max": float(np.max(allocated)) / 1024},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lock loop benchmark. Writes per stage latencies as JSON")
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--points", type=int, choices=[600, 3000, 6000], default=3000)
+    parser.add_argument("--format", dest="data_format", choices=list(controls.DATA_FORMATS), default="REAL,32")
+    parser.add_argument("--replay", metavar="TRACE_FILE", default=None, help="replay traces (trace file or recording directory) instead of synthetic ones")
+    parser.add_argument("--realtime", action="store_true", help="include the simulated scope frame rate and transfer time")
+    parser.add_argument("--no-render", dest="render", action="store_false", help="skip the plot update stage")
+    parser.add_argument("--peak-refinement", choices=controls.PEAK_REFINEMENTS, default=None)
+    parser.add_argument("--peak-tracking", action="store_true")
+    parser.add_argument("--batch-frames", type=int, default=1, help="frames read and processed as one block per iteration")
+    parser.add_argument("--pipeline", action="store_true", help="read the next frame while the last one is processed")
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args()
+    results = benchmark(args.iterations, args.points, args.data_format, args.replay, args.realtime, args.render,
+                        args.peak_refinement, args.peak_tracking, batch_frames=args.batch_frames,
+                        pipeline=args.pipeline)
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(f"{results['iterations_per_second']:.1f} iterations/s, {results['daq_writes']} DAQ writes")
+    if results["pipeline"] is not None:
+        print(f"  pipeline: transfer {results['pipeline']['transfer_ms']:.1f} ms, waited {results['pipeline']['wait_ms']:.1f} ms "
+              f"per frame ({results['pipeline']['hidden_fraction']:.0%} hidden)")
+    for stage, stats in results["stages"].items():
+        print(f"  {stage:<11} p50 {stats['p50_ms']:8.3f} ms   p99 {stats['p99_ms']:8.3f} ms")
+    print("Results written to", args.output)
@@ -1,18 +1,63 @@
-import beepy
+import threading
 import numpy as np
 import scipy.signal as signal
-# import DAQ_control
-from DAQ_control import DAQ
-from time import time
+from scheduler import ControlScheduler
+from pid import PIDController, DEFAULT_GAINS, OUTPUT_LIMIT
+from lock_statistics import LockStatistics
+from supervisor import ConnectionLost
+from concurrent.futures import TimeoutError as CallTimeout
 
-old_time = time()
+try:
+    import beepy
+except ImportError:  # alarm sound is optional (e.g. benchmark.py on a machine without it)
+    beepy = None
+
+control_scheduler = ControlScheduler()  # when the lock writes voltages (fixed rate, set by the laser's response rate)
+controllers = {}  # PIDController per DAQ analog output channel, gains of the laser locked on it (dict_laser_info[laser_name][5:8])
+lock_statistics = LockStatistics()  # lock error/voltage statistics of the selected laser, every locked frame
+DIP_ASSIGN_TOLERANCE = 50  # MHz. Multi laser locking, largest distance of a dip from a laser's desired offset to be assigned to it
+
+# Waveform transfer format. Binary block data is decoded straight into numpy arrays, "ASCii" is kept as a fallback
+# (comma separated string, parsed in python - roughly 3-4x more bytes on the wire)
+DATA_FORMATS = {"REAL,32": '<f4', "INT,16": '<i2', "INT,8": 'i1', "ASCii": None}
+data_format = "REAL,32"
+y_conversion = {}  # (y origin, y increment) per channel for INT formats. Cleared when the format is changed
+
+# Sub-sample dip positions for the peak separation, fitted over the FWHM of each dip. None uses the integer sample positions
+PEAK_REFINEMENTS = ("parabolic", "centroid", "lorentzian")
+peak_refinement = None
+
+# Peak tracking: search only windows (3 FWHM each side) around the peaks of the last frame. Only done while the last full
+# search found the expected number of peaks (HeNe and one per locked laser), otherwise every frame is a full search, so a
+# dip coming back is seen straight away. A full search is also done when a peak is lost or split, the osc scale/pos
+# changes and every FULL_SEARCH_INTERVAL frames (to see new peaks)
+peak_tracking = False
+FULL_SEARCH_INTERVAL = 20
+MIN_TRACK_WINDOW = 10  # samples each side of a tracked peak
+tracked_peaks = None  # dict of positions, widths, trace length and frames since the last full search (acquisition thread only)
+full_search = threading.Event()  # set when the peaks move (osc_update, acquisition_profiles.apply_profile), cleared by find_dips
+
+# Batch acquisition: batch_frames consecutive frames are read as one block (frames, points). Dips are found once on the
+# mean trace, then located (and refined) in every frame in one vectorised pass. The separation is the mean over the block,
+# its variance is given to the controller as a noise estimate
+batch_frames = 1
+
+# Output ramps: lock voltages are played by the DAQ as a smooth hardware timed ramp (DAQ.daq_ramp) over RAMP_FRACTION of
+# the voltage response period, instead of a step held until the next correction. A new correction replaces the ramp running.
+# Experimental: the PID gains are tuned for steps, with the ramp delay the lock error is larger (main.py --ramp)
+output_ramp = False
+RAMP_FRACTION = 0.5
+
+TRACE_SCALE = 0.05*1000  # Osc vertical scale *1000 (milli-volts), applied to the trace returned by get_trace
 
 
 class Signal:
     def __init__(self, pos, default_pos, change_pos, locking, in_MHz, continue_lock, scale, laser_lock_status,
-                 peaks_identified, ident_peaks, default_scale, dict_laser_info, laser_name, show_trig_sig, manual_adj_V):
-        self.manual_adj_V = manual_adj_V
+                 peaks_identified, ident_peaks, default_scale, dict_laser_info, laser_name, show_trig_sig,
+                 lock_lasers=None, hene_peak=None):
         self.voltage_out = None
+        self.lock_lasers = lock_lasers  # lasers locked together from the same trace (multi laser locking), None for only laser_name
+        self.hene_peak = hene_peak  # index of the HeNe dip, needed to assign the other dips to lasers
         self.pos = pos
         self.default_pos = default_pos
         self.change_pos = change_pos
@@ -28,33 +73,43 @@ class Signal:
         self.laser_name = laser_name
         self.show_trig_sig = show_trig_sig
 
-    def signal_response(self, num_peaks, separation, rapid_data, correction_array):
+    def signal_response(self, num_peaks, separation, rapid_data, correction_history, daq, separation_var=None):
         """ Response depending on signal.
              If 2 peaks are observed, laser is controlled to keep frequency lock.
              If < or > 2 peaks are observed, oscilloscope will try to adjust horizontal position to find peaks.
              If no peaks are found, oscilloscope will reset to default pos and scale.
         """
-        global old_time
-        response_rate = self.dict_laser_info[self.laser_name][4]
-        if not rapid_data and response_rate < 1.5:
-            response_rate = 1.5
+        control_scheduler.set_period(self.dict_laser_info[self.laser_name][4])  # voltage response rate (sec)
+        channel = laser_channel(self.dict_laser_info, self.laser_name)
+        controller = channel_controller(channel)
         correction = None
         uncal_sep = separation  # uncalibration separation
         if separation != 0 and self.in_MHz is not None:
             separation = (separation * self.in_MHz)  # separation in MHZ
+            if separation_var is not None:
+                separation_var = separation_var * self.in_MHz ** 2
         lost_peaks = False
         self.laser_lock_status = True
         voltage_out = False
         if not self.change_pos:
             if num_peaks == 2 and self.locking and self.peaks_identified and self.in_MHz is not None:
-                # control laser
-                correction = lock_laser(separation, self.dict_laser_info, self.laser_name, correction_array, self.manual_adj_V)
-                if -5 < correction < 5:
+                # control laser. The controller only steps when a voltage is due, in between it holds its last output
+                if control_scheduler.due():
+                    correction = lock_laser(separation, self.dict_laser_info, self.laser_name, controller,
+                                            separation_var)
+                    write = True
+                else:
+                    correction = controller.output
+                    write = False
+                if -OUTPUT_LIMIT < correction < OUTPUT_LIMIT:
                     self.laser_lock_status = True
-                    if (time() - old_time) >= float(response_rate):
+                    lock_statistics.add(self.laser_name, separation - abs(self.dict_laser_info[self.laser_name][0]),
+                                        correction)
+                    if write:
                         voltage_out = True
-                        DAQ().daq_output(correction)
-                        old_time = time()
+                        write_voltage(daq, correction, channel)
+                        correction_history.push(correction)
+                        control_scheduler.actuated()
                 else:
                     self.laser_lock_status = False
             elif num_peaks == 2 and not self.locking:
@@ -62,37 +117,120 @@ class Signal:
             elif num_peaks > 2 or num_peaks == 1:
                 self.laser_lock_status = False
                 if self.locking:
-                    beepy.beep(sound=3)
+                    alarm()
             elif num_peaks == 0:
                 if self.locking and not self.continue_lock:
                     lost_peaks = True
-                    beepy.beep(sound=3)
+                    alarm()
                 elif self.locking and self.continue_lock:
                     lost_peaks = False
                 self.laser_lock_status = False
         else:
             pass
         if not self.laser_lock_status:
-            pass
-            DAQ().daq_output(0)
+            daq.daq_output(0, channel)  # every unlocked frame. The DAQ driver skips the write once the output is at 0 V
+        if correction is None or not self.laser_lock_status:
+            control_scheduler.reset()  # not locking, restart the deadlines when the lock starts again
+            # voltage locking will start from (bumpless transfer). The last lock or manual voltage, as in the error graph
+            controller.hold(0. if not self.laser_lock_status or len(correction_history) == 0 else correction_history.last())
         return self.pos, self.laser_lock_status, separation, lost_peaks, self.scale, correction, voltage_out, uncal_sep
 
-    def final_data(self, instr, rapid_data, correction_array):
-        waveform, peaks_loc, num_peaks, separation, peaks, trigger_data = get_trace(instr, self.show_trig_sig)
-        pos, laser_lock_status, separation, lost_peaks, self.scale, correction, voltage_out, uncal_sep = self.signal_response(
-            num_peaks,
-            separation, rapid_data, correction_array)
+    def multi_signal_response(self, num_peaks, peaks, separation, correction_history, daq):
+        """ Response for multi laser locking (lock_lasers). Every dip other than the HeNe dip is assigned to the laser whose
+            desired offset is closest to its offset from the HeNe dip. Each laser is locked on its own DAQ channel,
+            lasers without a dip are unlocked (0 V on their channel).
+            Returns the same values as signal_response for laser_name (shown on the GUI), and laser_locks:
+            {laser name: (separation in MHz or None, correction or None, locked)}
+        """
+        control_scheduler.set_period(min(self.dict_laser_info[name][4] for name in self.lock_lasers))
+        uncal_sep = separation
+        if separation != 0 and self.in_MHz is not None:
+            separation = (separation * self.in_MHz)  # separation in MHZ (first two dips, as in single laser locking)
+        lost_peaks = False
+        voltage_out = False
+        laser_locks = {name: (None, None, False) for name in self.lock_lasers}
+        due = control_scheduler.due()
+        if not self.change_pos and self.locking and self.peaks_identified and self.in_MHz is not None and \
+                self.hene_peak is not None and 2 <= num_peaks <= len(self.lock_lasers) + 1:
+            offsets = {name: abs(self.dict_laser_info[name][0]) for name in self.lock_lasers}
+            assigned = assign_dips(peaks, self.hene_peak, self.in_MHz, offsets)
+            for name, laser_separation in assigned.items():
+                controller = channel_controller(laser_channel(self.dict_laser_info, name))
+                correction = lock_laser(laser_separation, self.dict_laser_info, name, controller) if due else controller.output
+                laser_locks[name] = (laser_separation, correction, -OUTPUT_LIMIT < correction < OUTPUT_LIMIT)
+        elif not self.change_pos and self.locking:
+            # alarms as signal_response: lost peaks, or a peak count that doesn't fit the lasers locked
+            if num_peaks == 0 and not self.continue_lock:
+                lost_peaks = True
+                alarm()
+            elif num_peaks == 1 or num_peaks > len(self.lock_lasers) + 1:
+                alarm()
+        any_locked = any(locked for _, _, locked in laser_locks.values())
+        selected_separation, selected_correction, selected_locked = laser_locks.get(self.laser_name, (None, None, False))
+        if selected_locked:
+            lock_statistics.add(self.laser_name, selected_separation - abs(self.dict_laser_info[self.laser_name][0]),
+                                selected_correction)
+        for name, (laser_separation, correction, locked) in laser_locks.items():
+            channel = laser_channel(self.dict_laser_info, name)
+            if locked and due:
+                write_voltage(daq, correction, channel)
+                if name == self.laser_name:
+                    correction_history.push(correction)
+                voltage_out = True
+            elif not locked and self.locking and not self.change_pos:
+                daq.daq_output(0, channel)
+                channel_controller(channel).hold(0.)
+            elif not locked and name == self.laser_name:
+                # not locking, start from the manual voltage (bumpless transfer)
+                channel_controller(channel).hold(correction_history.last() if len(correction_history) else 0.)
+        if any_locked and due:
+            control_scheduler.actuated()
+        elif not any_locked:
+            control_scheduler.reset()
+        laser_lock_status = all(locked for _, _, locked in laser_locks.values())
+        correction = laser_locks.get(self.laser_name, (None, None, False))[1]
+        return self.pos, laser_lock_status, separation, lost_peaks, self.scale, correction, voltage_out, uncal_sep, laser_locks
+
+    def final_data(self, instr, daq, rapid_data, correction_history):
+        """instr and daq are the oscilloscope and DAQ backends (hardware or simulation.py)"""
+        expected_peaks = len(self.lock_lasers) + 1 if self.lock_lasers else 2  # HeNe and one dip per locked laser
+        waveform, peaks_loc, num_peaks, separation, peaks, trigger_data, separation_var = get_trace(
+            instr, self.show_trig_sig, expected_peaks)
+        if self.lock_lasers:
+            pos, laser_lock_status, separation, lost_peaks, self.scale, correction, voltage_out, uncal_sep, laser_locks = self.multi_signal_response(
+                num_peaks, peaks, separation, correction_history, daq)
+            peaks_loc = np.round(peaks).astype(int)  # all dips are shown and used for peak identification
+        else:
+            pos, laser_lock_status, separation, lost_peaks, self.scale, correction, voltage_out, uncal_sep = self.signal_response(
+                num_peaks,
+                separation, rapid_data, correction_history, daq, separation_var)
+            laser_locks = None
+        if voltage_out and hasattr(instr, "invalidate"):
+            instr.invalidate()  # pipelined scope, the frame read ahead is from before the new voltage
         len_waveform = len(waveform)
 
 
-        return waveform, peaks_loc, separation, self.pos, num_peaks, self.scale, laser_lock_status, lost_peaks, trigger_data, correction, voltage_out, uncal_sep, len_waveform
+        return waveform, peaks_loc, separation, self.pos, num_peaks, self.scale, laser_lock_status, lost_peaks, trigger_data, correction, voltage_out, uncal_sep, len_waveform, laser_locks
+
+
+def calibration_factors(scale, one_HeNe_FSR, cal_scale, cal_points, len_waveform):
+    """MHz and nm per waveform point, from the HeNe FSR (samples) measured at cal_scale with cal_points points
+    (3000 if unknown). (None, None) if not calibrated"""
+    # HeNe wavelength/4/avg. num of indices between HeNe peaks
+    try:
+        cal_points = 3000 if cal_points is None else cal_points  # not rapid data collection at calibration
+        in_MHz = 300 / one_HeNe_FSR * scale / cal_scale * cal_points / len_waveform
+        in_nm = 632 / 4 / one_HeNe_FSR * scale / cal_scale
+    except (TypeError, ZeroDivisionError):
+        return None, None
+    return in_MHz, in_nm
 
 
-def status_indicator(num_peaks, separation, in_MHz):
-    # for LED on GUI. True if 2 peaks and not ~3000 MHz apart
-    if num_peaks == 2 and in_MHz and not 2980 <= separation <= 3020:
+def status_indicator(num_peaks, separation, in_MHz, expected_peaks=2):
+    # for LED on GUI. True if 2 peaks (one per locked laser + HeNe) and not ~3000 MHz apart
+    if num_peaks == expected_peaks and in_MHz and not 2980 <= separation <= 3020:
         return True
-    else:d
+    else:
         return False
 
 
@@ -107,52 +245,267 @@ def scan_gen__drift_control(HeNe_peak_loc, FSR, desired_offset):
         pass
 
 
-def lock_laser(separation, dict_laser_info, laser_name, correction_array, manual_adj_V):
-    """Convert to MHz, find difference between desired offset and actual offset.
-    Assuming that positive voltage = increase in frequency.
+def lock_laser(separation, dict_laser_info, laser_name, controller, separation_var=None):
+    """Convert to MHz, find difference between desired offset and actual offset, and step the PID controller
+    (of the laser's DAQ channel). Assuming that positive voltage = increase in frequency.
     If not, input voltage for 1 MHz as a negative number.
+    separation_var (MHz^2, batch acquisition) lowers the gain for errors within the noise of the separation.
     """
     voltage_1MHz = dict_laser_info[laser_name][3]  # voltage value equivalent to 1MHz change in laser frequency
     desired_offset = dict_laser_info[laser_name][0]  # desired offset from HeNe peak
+    polarity = np.sign(desired_offset)  # Will require user input for polarity of laser box.
+    kp, ki, kd = laser_gains(dict_laser_info, laser_name)
+    controller.configure(laser_name, kp, ki, kd, voltage_1MHz, polarity)
+    return controller.update(separation, abs(desired_offset), variance=separation_var)
+
+
+def alarm():
+    """Beeps while locking with lost peaks or the wrong number of peaks. Silent without beepy"""
+    if beepy is not None:
+        beepy.beep(sound=3)
 
-    if len(correction_array) == 0:
-        error = separation - abs(desired_offset)
-        polarity = np.sign(desired_offset)
-        correction = -1 * polarity * error * voltage_1MHz  # amount of voltage. Drives in the opposite direction to error. Will require user input for polarity of laser box.
+
+def write_voltage(daq, voltage, channel):
+    """Lock voltage to the DAQ channel: a ramp over part of the response period with output_ramp, otherwise a step"""
+    if output_ramp:
+        daq.daq_ramp(voltage, channel, RAMP_FRACTION * control_scheduler.period)
     else:
-        error = separation - abs(desired_offset) + correction_array[-1]
-        polarity = np.sign(desired_offset)
-        correction = -1 * polarity * error * voltage_1MHz  # amount of voltage. Drives in the opposite direction to error. Will require user input for polarity of laser box.
-        if np.sign(correction_array[-1]) != np.sign(correction):
-            dict_laser_info[4] -= manual_adj_V
+        daq.daq_output(voltage, channel)
 
-    return correction
 
+def channel_controller(channel):
+    """PID controller of a DAQ analog output channel"""
+    if channel not in controllers:
+        controllers[channel] = PIDController()
+    return controllers[channel]
 
-def get_trace(instr, show_trig_sig):
-    """Get current waveform and trigger signal from oscilloscope. Smooth signal data. Returns number of peaks and checks if it is noise/scan amplitude incorrect (over 10 peaks)."""
-    # set updated osc settings
-    YData = instr.query_str('CHANnel1:DATA? 1')  # Read y data of ch 1
-    # print(instr.query_str('CHANnel2:DATA:HEADer?')) when making changes to osc. settings double check that the 4 value is 1 (number of samples per interval)
-    TraceData = np.array(YData.split(","), float)
-    if show_trig_sig:
-        trigger_data = instr.query_str('CHANnel2:DATA? 1')  # Read y data of ch 2
-        trigger_data = np.array(trigger_data.split(","), float)
 
-    else:
+def laser_channel(dict_laser_info, laser_name):
+    """DAQ analog output channel of the laser, 0 if the laser has none saved"""
+    laser_info = dict_laser_info[laser_name]
+    return int(laser_info[8]) if len(laser_info) >= 9 else 0
+
+
+def assign_dips(peaks, hene_peak, in_MHz, offsets):
+    """Assigns dips to lasers for multi laser locking. peaks are dip positions (samples), hene_peak the HeNe dip,
+    offsets {laser name: desired offset in MHz}. The closest dip/laser pairs are matched first, each dip and laser once,
+    pairs further than DIP_ASSIGN_TOLERANCE apart aren't matched. Returns {laser name: separation from HeNe in MHz}"""
+    peaks = np.asarray(peaks, dtype=float)
+    dips = np.delete(peaks, np.abs(peaks - hene_peak).argmin())
+    separations = np.abs(dips - hene_peak) * in_MHz
+    names = list(offsets)
+    distance = np.abs(separations[:, None] - np.array([offsets[name] for name in names])[None, :])  # (dips, lasers)
+    assigned = {}
+    for flat in np.argsort(distance, axis=None):
+        dip, laser = np.unravel_index(flat, distance.shape)
+        if distance[dip, laser] > DIP_ASSIGN_TOLERANCE:
+            break
+        if names[laser] not in assigned and not np.isnan(separations[dip]):
+            assigned[names[laser]] = separations[dip]
+            separations[dip] = np.nan  # dip used
+    return assigned
+
+
+def laser_gains(dict_laser_info, laser_name):
+    """PID gains (kp, ki, kd) saved for the laser, defaults if the laser has none"""
+    laser_info = dict_laser_info[laser_name]
+    return tuple(laser_info[5:8]) if len(laser_info) >= 8 else DEFAULT_GAINS
+
+
+def set_data_format(instr, new_format):
+    """Sets the waveform transfer format on the oscilloscope. Binary data is sent little endian to match np.frombuffer."""
+    global data_format
+    if new_format not in DATA_FORMATS:
+        raise ValueError(f"Unknown waveform data format: {new_format}")
+    instr.write("FORM " + new_format)
+    if DATA_FORMATS[new_format] is not None:
+        instr.write("FORMat:BORDer LSBFirst")
+    data_format = new_format
+    y_conversion.clear()
+
+
+def read_channel(instr, channel):
+    """Reads the waveform of one oscilloscope channel into a numpy array of voltages, using the current data format"""
+    query = f'CHANnel{channel}:DATA? 1'
+    dtype = DATA_FORMATS[data_format]
+    if dtype is None:
+        # ASCii fallback. Values are comma separated
+        return np.array(instr.query_str(query).split(","), float)
+    data = np.frombuffer(instr.query_bin_block(query), dtype=dtype)
+    if data_format == "REAL,32":
+        return data
+    # INT formats are raw ADC values, converted using the origin/increment of the channel (only asked for once)
+    if channel not in y_conversion:
+        y_conversion[channel] = (float(instr.query_str(f'CHANnel{channel}:DATA:YORigin?')),
+                                 float(instr.query_str(f'CHANnel{channel}:DATA:YINCrement?')))
+    y_origin, y_increment = y_conversion[channel]
+    return data * y_increment + y_origin
+
+
+def read_traces(instr, channels):
+    """Waveforms of channels from the same frame. A pipeline.PipelinedScope gives the frame it has already read"""
+    if hasattr(instr, "read_frame"):
+        return instr.read_frame(channels)
+    return [read_channel(instr, channel) for channel in channels]
+
+
+def read_block(instr, frames, show_trig_sig):
+    """Reads frames consecutive waveforms of ch 1 into a 2-D block (frames, points), and the trigger (ch 2) of the last
+    frame if show_trig_sig. Frames with a different length to the last one (scale change) are dropped.
+    A pipelined scope reads the same channels for every frame (changing them throws away the frame read ahead)."""
+    pipelined = hasattr(instr, "read_frame")
+    channels = (1, 2) if show_trig_sig and pipelined else (1,)
+    frame_traces = [read_traces(instr, channels) for _ in range(frames)]
+    traces = [frame[0] for frame in frame_traces]
+    if not show_trig_sig:
         trigger_data = []
-    peaks, _ = signal.find_peaks(-TraceData,
-                                 prominence=0.05)  # size of peaks must be large enough to identify from noise/ramp return peaks
+    elif pipelined:
+        trigger_data = frame_traces[-1][1]
+    else:
+        trigger_data = read_channel(instr, 2)
+    return np.stack([trace for trace in traces if len(trace) == len(traces[-1])]), trigger_data
+
+
+def batch_positions(block, peaks, properties):
+    """Positions of the dips in every frame of a block (frames, points) of negated waveforms, as one vectorised pass.
+    peaks and properties are from find_peaks on the mean trace. Each dip is the highest point within +-FWHM of the mean
+    position, refined with peak_refinement if set. Returns an array (frames, peaks)"""
+    frames, points = block.shape
+    half_width = np.maximum(np.ceil(properties["widths"]), 3).astype(int)
+    offsets = np.arange(-half_width.max(), half_width.max() + 1)
+    index = np.clip(peaks[:, None] + offsets, 0, points - 1)  # (peaks, window)
+    inside = np.abs(offsets) <= half_width[:, None]
+    values = np.where(inside, block[:, index], -np.inf)  # (frames, peaks, window)
+    positions = np.take_along_axis(index[None], values.argmax(axis=2)[:, :, None], axis=2)[:, :, 0]
+    if peak_refinement is None:
+        return positions.astype(float)
+    # all frames fitted at once, as one long trace. Dips within a FWHM of the screen edge may use points of the next frame
+    row_start = (np.arange(frames) * points)[:, None]
+    refined = refine_peaks(block.ravel(), (positions + row_start).ravel(), np.tile(properties["prominences"], frames),
+                           np.tile(properties["widths"], frames), peak_refinement)
+    return refined.reshape(frames, -1) - row_start
+
+
+def find_dips(trace, expected_peaks=2):
+    """find_peaks on the negated waveform. Uses the windows around the last peaks if peak_tracking is on and the last
+    full search found expected_peaks."""
+    global tracked_peaks
+    if full_search.is_set():
+        full_search.clear()
+        tracked_peaks = None
+    if peak_tracking and tracked_peaks is not None and len(trace) == tracked_peaks["length"] and \
+            len(tracked_peaks["positions"]) == expected_peaks and tracked_peaks["frames"] < FULL_SEARCH_INTERVAL:
+        found = search_windows(trace, tracked_peaks["positions"], tracked_peaks["widths"])
+        if found is not None:
+            tracked_peaks.update(positions=found[0], widths=found[1]["widths"], frames=tracked_peaks["frames"] + 1)
+            return found
+    peaks, properties = signal.find_peaks(trace, prominence=0.05,
+                                          width=0 if peak_refinement or peak_tracking or batch_frames > 1 else None)  # size of peaks must be large enough to identify from noise/ramp return peaks
+    if peak_tracking and len(peaks) == expected_peaks:
+        tracked_peaks = {"positions": peaks, "widths": properties["widths"], "length": len(trace), "frames": 0}
+    else:
+        tracked_peaks = None
+    return peaks, properties
+
+
+def search_windows(trace, positions, widths):
+    """Looks for exactly one peak in a window around each position. Returns peaks and properties as find_peaks does,
+    or None if a peak was lost, split, or the windows overlap (then a full search is needed)"""
+    half_window = np.maximum(3 * widths, MIN_TRACK_WINDOW).astype(int)
+    starts = np.clip(positions - half_window, 0, len(trace))
+    stops = np.clip(positions + half_window + 1, 0, len(trace))
+    if np.any(starts[1:] < stops[:-1]):
+        return None
+    peaks = np.empty(len(positions), dtype=int)
+    properties = {"prominences": np.empty(len(positions)), "widths": np.empty(len(positions))}
+    for i, (start, stop) in enumerate(zip(starts, stops)):
+        window_peaks, window_properties = signal.find_peaks(trace[start:stop], prominence=0.05, width=0)
+        if len(window_peaks) != 1:
+            return None
+        peaks[i] = window_peaks[0] + start
+        properties["prominences"][i] = window_properties["prominences"][0]
+        properties["widths"][i] = window_properties["widths"][0]
+    return peaks, properties
+
+
+def refine_peaks(trace, peaks, prominences, widths, method):
+    """Fractional sample positions of the peaks (dips of the waveform, so trace is the negated waveform).
+    prominences and widths (FWHM in samples) come from find_peaks. All peaks are fitted at once:
+    parabolic - parabola through the highest 3 points.
+    centroid - centre of mass above the peak base, within the FWHM.
+    lorentzian - weighted least squares Lorentzian fit within the FWHM (1/Lorentzian is a parabola, so the fit is linear).
+    Falls back to parabolic for a peak if its fit fails."""
+    peaks = np.asarray(peaks)
+    inner = np.clip(peaks, 1, len(trace) - 2)
+    y_left, y_peak, y_right = trace[inner - 1], trace[inner], trace[inner + 1]
+    curvature = y_left - 2 * y_peak + y_right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        parabolic = np.where(curvature < 0, inner + 0.5 * (y_left - y_right) / curvature, peaks)
+    if method == "parabolic":
+        return parabolic
+    # window of +-FWHM/2 around each peak, heights above the base of the peak
+    half_width = np.maximum(np.ceil(np.asarray(widths) / 2), 2).astype(int)
+    offsets = np.arange(-half_width.max(), half_width.max() + 1)
+    index = peaks[:, None] + offsets
+    inside = (np.abs(offsets) <= half_width[:, None]) & (index >= 0) & (index < len(trace))
+    base = trace[peaks] - np.asarray(prominences)
+    height = np.where(inside, trace[np.clip(index, 0, len(trace) - 1)] - base[:, None], 0)
+    height = np.clip(height, 0, None)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if method == "centroid":
+            refined = peaks + np.sum(height * offsets, axis=1) / np.sum(height, axis=1)
+        elif method == "lorentzian":
+            # fit 1/height = a x^2 + b x + c, weighted by height^4 (uncertainty of 1/height goes as 1/height^2)
+            weight = height ** 4
+            basis = np.stack([offsets ** 2, offsets, np.ones_like(offsets)]).astype(float)  # (3, window)
+            normal = np.einsum('nw,iw,jw->nij', weight, basis, basis)
+            target = np.einsum('nw,iw,nw->ni', weight, basis, np.where(height > 0, 1 / height, 0))
+            a, b, _ = np.linalg.solve(normal + 1e-12 * np.eye(3), target[:, :, None])[:, :, 0].T
+            refined = peaks - b / (2 * a)
+            refined = np.where((a > 0) & (np.abs(refined - peaks) <= half_width), refined, np.nan)
+        else:
+            raise ValueError(f"Unknown peak refinement: {method}")
+    return np.where(np.isfinite(refined), refined, parabolic)
+
+
+def get_trace(instr, show_trig_sig, expected_peaks=2):
+    """Get current waveform and trigger signal from oscilloscope. Smooth signal data. Returns number of peaks and checks if it is noise/scan amplitude incorrect (over 10 peaks).
+    With batch_frames > 1 the waveform is the mean of a block of frames, separation the mean separation and
+    separation_var the variance of that mean (samples^2, None for a single frame). expected_peaks (HeNe and one per locked
+    laser) is the number of dips peak tracking follows."""
+    # set updated osc settings
+    if batch_frames > 1:
+        block, trigger_data = read_block(instr, batch_frames, show_trig_sig)  # Read y data of ch 1, batch_frames frames
+        TraceData = block.mean(axis=0)
+    else:
+        block = None
+        # Read y data of ch 1 and ch 2 (trigger) of the same frame
+        traces = read_traces(instr, (1, 2) if show_trig_sig else (1,))
+        TraceData = traces[0]
+        trigger_data = traces[1] if show_trig_sig else []
+    # print(instr.query_str('CHANnel2:DATA:HEADer?')) when making changes to osc. settings double check that the 4 value is 1 (number of samples per interval)
+    peaks, properties = find_dips(-TraceData, expected_peaks)
     num_peaks = len(peaks)
     if num_peaks > 10:  # check if noise/scan amplitude incorrect - prevents slow program from extremely long array of peaks.
         num_peaks = 0
+    peaks_loc = peaks[0:2]
+    separation_var = None
+    if block is not None and 0 < num_peaks <= 10 and len(block) > 1:
+        # dips in every frame of the block. Mean positions are returned as peaks
+        positions = batch_positions(-block, peaks, properties)
+        peaks = positions.mean(axis=0)
+        if len(peaks) >= 2:
+            separations = positions[:, 1] - positions[:, 0]
+            separation_var = np.var(separations, ddof=1) / len(separations)
+    elif peak_refinement is not None and 0 < num_peaks:
+        # all dips, for multi laser locking. Sub-sample positions are returned as peaks, peaks_loc stays integer (for plotting)
+        peaks = refine_peaks(-TraceData, peaks, properties["prominences"], properties["widths"], peak_refinement)
     if len(peaks) >= 2:
         separation = peaks[1] - peaks[0]
     else:
         separation = 0
-    peaks_loc = peaks[0:2]
-    TraceData = TraceData * 0.05*1000  # Osc vertical scale *1000 (milli-volts)
-    return TraceData, peaks_loc, num_peaks, separation, peaks, trigger_data
+    TraceData = TraceData * TRACE_SCALE
+    return TraceData, peaks_loc, num_peaks, separation, peaks, trigger_data, separation_var
 
 
 def osc_update(instr, scale, pos):
@@ -163,6 +516,8 @@ def osc_update(instr, scale, pos):
         instr.write('TIMebase:SCAle ' + str(scale))  # set scale for osc
         read_scale = float((instr.query("TIMebase:RATime?"))) / 12
         scale = read_scale
-    except:
+    except (ConnectionLost, ValueError, CallTimeout) as error:  # connection down (reconnecting), unreadable reply or acquisition thread busy
+        print("Oscilloscope pos/scale not updated:", error)
         status_osc = False
+    full_search.set()  # peaks move with the scale/pos, search the whole trace again
     return status_osc, scale, pos
@@ -1,56 +1,80 @@
 import numpy as np
 import socket
 import time
-from DAQ_control import DAQ
 
 UDP_IP = "isyspi03"  # set it to destination IP. RPi in this case
 UDP_PORT = 25566
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+sock.setblocking(False)  # flipper acknowledgements are polled, never waited for
+SETTLE_TIME = 5  # sec. Time allowed for the mirror to move if the raspberry pi doesn't acknowledge
+ACK_SETTLE_TIME = 0.5  # sec. Time allowed for the mirror to move after the raspberry pi acknowledged
+PEAK_TIMEOUT = 5  # sec. Time after the mirror settled to see the expected peaks before peak identification fails
 
 
 # code on rasp pi for pin __
 # responds to flipper=1 (up, 5V) (actually 3.3V) and flipper=0 (down, 0V )
 
 class PeakIdentification:
-    """Required functions to identify the HeNe peak from two peaks on oscilloscope display"""
-    def __init__(self, ident_peaks=None, peaks_loc=None, peaks_identified=None):
+    """Required functions to identify the HeNe peak from two peaks on oscilloscope display
+    (or more with multi laser locking: expected_peaks is the HeNe peak plus one per locked laser)"""
+
+    def __init__(self, ident_peaks=None, peaks_loc=None, peaks_identified=None, expected_peaks=2):
         self.ident_peaks = ident_peaks
         self.peaks_loc = peaks_loc
         self.peaks_identified = peaks_identified
+        self.expected_peaks = expected_peaks
 
-    def peak_identity(self, stage, prev_peaks, mirror_up, mirror_error):
-        """identifies the HeNe peak by flipping the mirror and finding the peak of the pair closest to the single peak when the mirror is up. Requires all parameters in init to be filled."""
-        print("stage:", stage)
+    def peak_identity(self, stage, prev_peaks, mirror_up, mirror_error, stage_started=None):
+        """identifies the HeNe peak by flipping the mirror and finding the peak of the pair closest to the single peak when the mirror is up. Requires all parameters in init to be filled.
+        Called once per frame, never blocks. Moves to the next stage once the mirror has settled and the expected number of peaks is seen:
+        stage 0: mirror down, wait for two peaks. stage 1: flip mirror up. stage 2: wait for the single HeNe peak (saved in prev_peaks), flip mirror down.
+        stage 3: wait for two peaks, the HeNe peak is the one closest to the single peak.
+        Fails if the peaks aren't seen within PEAK_TIMEOUT sec of both the mirror settling and the stage starting.
+        stage_started is the time the stage began (time.monotonic), None before identification starts and after it ends."""
         HeNe_closest = None
+        num_peaks = len(self.peaks_loc)
+        now = time.monotonic()
+        start_stage = stage
+        if stage_started is None:
+            stage_started = now  # identification starts
         if stage == 0:
-            prev_peaks = self.peaks_loc
+            flipper.flipper_off()  # does nothing if already down
+            if flipper.settled() and num_peaks == self.expected_peaks:
+                prev_peaks = self.peaks_loc
+                stage = 1
         elif stage == 1:
-            FlipperControl.flipper_on()
-            mirror_up = True
-        elif stage == 5:
-            try:
-                if len(self.peaks_loc) != 1:
-                    raise ValueError
-                single_peak = self.peaks_loc
-                HeNe_closest = prev_peaks[self.find_closest(single_peak, prev_peaks)]
-                FlipperControl.flipper_off()
-                mirror_up = False
+            flipper.flipper_on()
+            stage = 2
+        elif stage == 2:
+            if flipper.settled() and num_peaks == 1:
+                prev_peaks = self.peaks_loc  # single HeNe peak
+                flipper.flipper_off()
+                stage = 3
+        elif stage == 3:
+            if flipper.settled() and num_peaks == self.expected_peaks:
+                HeNe_closest = self.peaks_loc[self.find_closest(prev_peaks, self.peaks_loc)]
                 self.peaks_identified = True
-                stage = -1
-                self.ident_peaks = False
-            except ValueError:
-                FlipperControl.flipper_off()
-                mirror_up = False
-                self.peaks_identified = False
-                mirror_error = True
-                stage = -1
                 self.ident_peaks = False
-        stage += 1
+                stage = 0
+        if stage != start_stage:
+            stage_started = now
+        if stage != 1 and self.ident_peaks and \
+                min(flipper.settled_for(), now - stage_started) > PEAK_TIMEOUT:
+            # wrong number of peaks after the mirror settled (possible that more than one FSR or raspberry pi not connected)
+            flipper.flipper_off()
+            self.peaks_identified = False
+            mirror_error = True
+            stage = 0
+            self.ident_peaks = False
+        if not self.ident_peaks:
+            stage_started = None  # done or failed, the next identification starts its own clock
+        print("stage:", stage)
+        mirror_up = flipper.mirror_up
         if mirror_up:
             loc_mirror = 1
         else:
             loc_mirror = 0
-        return self.peaks_identified, stage, prev_peaks, HeNe_closest, mirror_up, self.ident_peaks, loc_mirror, mirror_error
+        return self.peaks_identified, stage, prev_peaks, HeNe_closest, mirror_up, self.ident_peaks, loc_mirror, mirror_error, stage_started
 
     @staticmethod
     def find_closest(single_peak, list_peaks):
@@ -80,19 +104,64 @@ class PeakIdentification:
 #  TODO pop up if  click multiple times to ask if connected to raspi
 
 class FlipperControl:
-    @staticmethod
-    def flipper_on():
+    """Mirror flipper. Moves are started straight away and never wait: settled() tells if the mirror has finished moving.
+    The mirror counts as settled SETTLE_TIME sec after the move started, or ACK_SETTLE_TIME sec after the raspberry pi
+    acknowledges the move (it echoes the flipper=0/1 message back over UDP)."""
+    def __init__(self):
+        self.daq = None  # set by gui_main. Replaced with a proxy so the DAQ is only driven from the acquisition thread
+        self.mirror_up = False
+        self.move_time = None  # time the last move started
+        self.ack_time = None  # time the raspberry pi acknowledged the last move
+        self.message = None
+
+    def flipper_on(self):
         # to add - led saying if up or down, and any manual input?
-        DAQ.daq_mirror_flipper_on()
-        sock.sendto(b'flipper=1\n', (UDP_IP, UDP_PORT))
-        time.sleep(5)
+        if not self.mirror_up or self.move_time is None:
+            self.daq.daq_mirror_flipper_on()
+            self.move(True)
+            print("up")
 
-        print("up")
+    def flipper_off(self):
+        if self.mirror_up or self.move_time is None:
+            self.daq.daq_mirror_flipper_off()
+            self.move(False)
+            print("down")
+
+    def move(self, mirror_up):
+        self.mirror_up = mirror_up
+        self.message = b'flipper=1\n' if mirror_up else b'flipper=0\n'
+        self.move_time = time.monotonic()
+        self.ack_time = None
+        try:
+            sock.sendto(self.message, (UDP_IP, UDP_PORT))
+        except OSError as error:  # raspberry pi not found. DAQ output still moves the mirror
+            print("Flipper message not sent:", error)
+
+    def check_ack(self):
+        """Reads any replies from the raspberry pi without waiting"""
+        while self.ack_time is None:
+            try:
+                reply, _ = sock.recvfrom(64)
+            except OSError:  # nothing received (or raspberry pi unreachable)
+                return
+            if reply.strip() == self.message.strip():
+                self.ack_time = time.monotonic()
+
+    def settled_time(self):
+        """Time at which the mirror is (or will be) settled"""
+        if self.move_time is None:
+            return -np.inf
+        self.check_ack()
+        if self.ack_time is not None:
+            return min(self.ack_time + ACK_SETTLE_TIME, self.move_time + SETTLE_TIME)
+        return self.move_time + SETTLE_TIME
+
+    def settled(self):
+        return time.monotonic() >= self.settled_time()
+
+    def settled_for(self):
+        """Seconds since the mirror settled, negative while still moving"""
+        return time.monotonic() - self.settled_time()
 
-    @staticmethod
-    def flipper_off():
-        DAQ.daq_mirror_flipper_off()
-        sock.sendto(b'flipper=0\n', (UDP_IP, UDP_PORT))
-        time.sleep(5)
 
-        print("down")
+flipper = FlipperControl()
@@ -0,0 +1,123 @@
+import csv
+import os
+import threading
+from collections import OrderedDict
+
+from pid import DEFAULT_GAINS
+
+'''Laser settings (laser_data.csv) kept in memory. The GUI and the lock only read and edit the in-memory values, the
+file is written in the background a little after the last change and is never truncated in place.'''
+
+SCHEMA_VERSION = 2  # 1: no header line, 6 to 11 columns. 2: version header line, all 11 columns
+# columns after the laser name: (name, type, default). Columns without a default are required
+COLUMNS = [("offset", float, None), ("default_pos", float, None), ("default_scale", float, None),
+           ("voltage_1MHz", float, None), ("response_rate", float, None),
+           ("kp", float, DEFAULT_GAINS[0]), ("ki", float, DEFAULT_GAINS[1]), ("kd", float, DEFAULT_GAINS[2]),
+           ("channel", int, 0), ("profile", str, "")]
+FIELDS = {name: index for index, (name, _, _) in enumerate(COLUMNS)}  # field name: index in the list of a laser
+HEADER = "# laser_data version"
+WRITE_DELAY = 2.  # sec after the last change before the file is written
+NEW_LASER_DEFAULTS = {"default_pos": 0.08, "default_scale": 0.002, "response_rate": 1.0}
+
+
+class LaserStore:
+    """In-memory laser settings. lasers is the dict_laser_info used by the GUI and controls: laser name -> list of
+    values in COLUMNS order (offset, default pos, default scale, voltage for 1 MHz, voltage response rate (sec),
+    kp, ki, kd, DAQ channel, acquisition profile). The first laser is the one opened at start up.
+    Changes edit the lists in place and schedule a write WRITE_DELAY sec later, so repeated changes (e.g. arrow key
+    presses on the response rate) are written once. The file is written to a temporary file and renamed over the old
+    one, so a crash leaves either the old or the new file. flush() writes any pending change straight away."""
+
+    def __init__(self, fname, write_delay=WRITE_DELAY):
+        self.fname = fname
+        self.write_delay = write_delay
+        self.lasers, self.version = read_lasers(fname)
+        self._lock = threading.Lock()
+        self._timer = None
+        self.dirty = self.version != SCHEMA_VERSION  # older files are rewritten in the current version
+
+    def set(self, laser_name, **values):
+        """Sets fields (names from COLUMNS) of a laser, e.g. set(name, default_pos=0.1, kp=0.5)"""
+        laser_info = self.lasers[laser_name]
+        with self._lock:
+            for field, value in values.items():
+                laser_info[FIELDS[field]] = COLUMNS[FIELDS[field]][1](value)
+        self.save_later()
+
+    def get(self, laser_name, field):
+        return self.lasers[laser_name][FIELDS[field]]
+
+    def add(self, laser_name, offset, voltage_1MHz):
+        """Adds a laser with the default pos/scale/response rate, gains, channel and no acquisition profile"""
+        values = dict(NEW_LASER_DEFAULTS, offset=offset, voltage_1MHz=voltage_1MHz)
+        with self._lock:
+            self.lasers[laser_name] = [column_type(values[name] if default is None else default)
+                                       for name, column_type, default in COLUMNS]
+        self.save_later()
+
+    def delete(self, laser_name):
+        with self._lock:
+            del self.lasers[laser_name]
+        self.save_later()
+
+    def select(self, laser_name):
+        """Moves the laser to the top of the file, so it is opened first at the next start up"""
+        with self._lock:
+            self.lasers.move_to_end(laser_name, last=False)
+        self.save_later()
+
+    def save_later(self):
+        """Writes the file write_delay sec after the last change"""
+        with self._lock:
+            self.dirty = True
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.write_delay, self.save)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Writes pending changes now (on exit)"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if self.dirty:
+            self.save()
+
+    def save(self):
+        with self._lock:
+            rows = [[name] + list(values) for name, values in self.lasers.items()]
+            self.dirty = False
+        temporary = self.fname + ".tmp"
+        with open(temporary, 'w', newline='') as laser_file:
+            laser_file.write(f"{HEADER} {SCHEMA_VERSION}: name, " + ", ".join(name for name, _, _ in COLUMNS) + "\n")
+            csv.writer(laser_file).writerows(rows)
+            laser_file.flush()
+            os.fsync(laser_file.fileno())
+        os.replace(temporary, self.fname)
+
+
+def read_lasers(fname):
+    """Reads the laser settings file. Returns (OrderedDict laser name -> values in COLUMNS order, schema version).
+    Missing optional columns get their defaults"""
+    lasers = OrderedDict()
+    version = 1
+    with open(fname, 'r', newline='') as laser_file:
+        for row in csv.reader(laser_file):
+            if not row or not row[0].strip():
+                continue
+            if row[0].startswith(HEADER):
+                version = int(row[0][len(HEADER):].split(":")[0])
+                if version > SCHEMA_VERSION:
+                    print(f"{fname} is version {version}, newer than this program ({SCHEMA_VERSION}). "
+                          f"Unknown columns are ignored")
+                continue
+            values = []
+            for i, (name, column_type, default) in enumerate(COLUMNS):
+                text = row[i + 1].strip() if i + 1 < len(row) else ""
+                if text == "" and default is None:
+                    raise ValueError(f"{fname}: laser {row[0]} has no {name}")
+                values.append(column_type(text) if text != "" else default)
+            lasers[row[0].strip()] = values
+    return lasers, version
@@ -0,0 +1,83 @@
+import argparse
+import json
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+'''Client of the headless lock API (lock_daemon.py), from Python or the command line:
+    python lock_client.py status
+    python lock_client.py laser HENE
+    python lock_client.py identify
+    python lock_client.py calibrate
+    python lock_client.py lock on
+Only needs the standard library, so it runs on any computer with Python (through an SSH tunnel for another one).'''
+
+DEFAULT_PORT = 8700
+
+
+class LockClient:
+    def __init__(self, port=DEFAULT_PORT, host="localhost", timeout=15):
+        self.url = f"http://{host}:{port}"
+        self.timeout = timeout
+
+    def request(self, path, content=None):
+        """GET path, or POST content (dictionary) as JSON. Returns the reply, raises ValueError with the daemon's message
+        if the request was refused"""
+        data = None if content is None else json.dumps(content).encode()
+        request = Request(self.url + path, data=data, headers={"Content-Type": "application/json"})
+        try:
+            with urlopen(request, timeout=self.timeout) as reply:
+                return json.load(reply)
+        except HTTPError as error:
+            raise ValueError(json.load(error).get("error", str(error))) from None
+
+    def status(self):
+        return self.request("/status")
+
+    def waveform(self):
+        return self.request("/waveform")
+
+    def lock(self, on=True):
+        return self.request("/lock", {"on": on})
+
+    def select_laser(self, name):
+        return self.request("/laser", {"name": name})
+
+    def identify_peaks(self):
+        return self.request("/identify", {})
+
+    def calibrate(self):
+        return self.request("/calibrate", {})
+
+    def mirror(self, up=True):
+        return self.request("/mirror", {"up": up})
+
+    def set_scale(self, scale):
+        return self.request("/scale", {"scale": scale})
+
+    def set_response_rate(self, seconds):
+        return self.request("/response_rate", {"seconds": seconds})
+
+    def continue_lock(self, on=True):
+        return self.request("/continue_lock", {"on": on})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Control the headless lock (main.py --headless)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("command", choices=["status", "lock", "laser", "identify", "calibrate", "mirror", "scale",
+                                            "response_rate", "continue_lock"])
+    parser.add_argument("value", nargs="?", default=None,
+                        help="on/off (lock, continue_lock), up/down (mirror), laser name, scale (s/div) or response rate (sec)")
+    args = parser.parse_args()
+    client = LockClient(args.port)
+    switch = args.value in ("on", "up", "true", "1")
+    commands = {"status": client.status, "identify": client.identify_peaks, "calibrate": client.calibrate,
+                "lock": lambda: client.lock(switch), "mirror": lambda: client.mirror(switch),
+                "continue_lock": lambda: client.continue_lock(switch),
+                "laser": lambda: client.select_laser(args.value),
+                "scale": lambda: client.set_scale(float(args.value)),
+                "response_rate": lambda: client.set_response_rate(float(args.value))}
+    try:
+        print(json.dumps(commands[args.command](), indent=2))
+    except ValueError as error:
+        print("Refused:", error)
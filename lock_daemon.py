@@ -0,0 +1,205 @@
+import json
+import queue
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import controls
+from controls import osc_update, laser_gains, laser_channel
+from flipper_raspi import flipper
+from laser_store import LaserStore
+from lock_client import DEFAULT_PORT
+from lock_loop import LockLoop
+from scheduler import MIN_PERIOD
+
+'''Headless lock (main.py --headless). Runs acquisition, peak identification and locking without PySimpleGUI/Tk or
+matplotlib, controlled through a JSON API on http://localhost:<port> (lock_client.py is a client):
+    GET  /status                        lock state, separation, laser, calibration, rates
+    GET  /waveform                      last waveform and peaks (for a remote display)
+    POST /lock        {"on": true}      start/stop locking (needs peaks identified and the scale calibrated)
+    POST /laser       {"name": "HENE"}  switch the selected laser
+    POST /identify                      start peak identification (flips the mirror)
+    POST /calibrate                     take the current separation as the HeNe FSR (mirror up, two HeNe peaks)
+    POST /mirror      {"up": true}      move the flipper mirror
+    POST /scale       {"scale": 0.004}  oscilloscope time scale (s/div), e.g. two HeNe peaks on screen for /calibrate
+    POST /response_rate {"seconds": 1}  voltage response rate of the selected laser
+    POST /continue_lock {"on": true}    keep locking when the peaks are lost (the GUI asks with a popup)
+The API only listens on 127.0.0.1. Requests are run by the daemon loop between frames, like the GUI events.'''
+
+
+class LockDaemon(LockLoop):
+    """The lock loop (lock_loop.py) without the window. Runs the API requests between frames"""
+
+    def __init__(self, instr, daq, fname="laser_data.csv", recorder=None):
+        self.requests = queue.Queue()  # (func, args, Future) from the API
+        self.running = False
+        super().__init__(instr, daq, LaserStore(fname), recorder=recorder)
+
+    def run(self):
+        """Runs until stop() (or Ctrl+C). Saves the laser settings on the way out"""
+        self.running = True
+        self.acquisition.start()
+        try:
+            while self.running:
+                self.next_frame(timeout=0.1)
+                self.run_requests()
+                self.push_settings()
+        finally:
+            self.acquisition.stop()
+            self.store.flush()
+
+    def stop(self):
+        self.running = False
+
+    # requests from the API, run in the daemon loop
+    def call(self, func, *args, timeout=10):
+        """Runs func(*args) in the daemon loop and returns the result (exceptions are raised here)"""
+        future = Future()
+        self.requests.put((func, args, future))
+        return future.result(timeout=timeout)
+
+    def run_requests(self):
+        while True:
+            try:
+                func, args, future = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                future.set_result(func(*args))
+            except Exception as error:
+                future.set_exception(error)
+
+    def set_locking(self, on):
+        """As GUIEvents.enable_laser_lock, errors instead of the popups"""
+        if on and not self.peaks_identified:
+            raise ValueError("Identify the peaks before locking")
+        if on and not self.one_HeNe_FSR:
+            raise ValueError("Calibrate the scale before locking")
+        self.locking = bool(on)
+
+    def select_laser(self, laser_name):
+        """As GUIEvents.change_laser: defaults of the new laser, and its acquisition profile"""
+        if laser_name not in self.dict_laser_info:
+            raise ValueError(f"Unknown laser {laser_name}")
+        self.laser_name = laser_name
+        self.default_pos, self.default_scale = self.dict_laser_info[laser_name][1:3]
+        self.pos, self.scale = self.default_pos, self.default_scale
+        self.status_osc, self.scale, self.pos = osc_update(self.instr, self.scale, self.pos)
+        self.use_laser_profile(self.instr)
+        self.store.select(laser_name)  # opened first next time
+
+    def identify_peaks(self):
+        self.ident_peaks = True
+
+    def calibrate(self):
+        """As check_FSR: the separation of the two HeNe peaks on screen (mirror up) is one HeNe FSR"""
+        if self.frame is None or not self.frame.uncal_sep or self.rapid_data:
+            raise ValueError("Calibration needs two HeNe peaks on screen and rapid data collection off")
+        self.one_HeNe_FSR = self.frame.uncal_sep
+        self.cal_scale = self.scale
+        self.cal_points = self.frame.len_waveform
+
+    def set_scale(self, scale):
+        """As the Manually Adjust Scale control of the GUI"""
+        self.status_osc, self.scale, self.pos = osc_update(self.instr, float(scale), self.pos)
+
+    def move_mirror(self, up):
+        if up:
+            flipper.flipper_on()
+        else:
+            flipper.flipper_off()
+        self.mirror_up = bool(up)
+
+    def set_response_rate(self, seconds):
+        if seconds < MIN_PERIOD:
+            raise ValueError(f"Response rate must be at least {MIN_PERIOD} s")
+        self.store.set(self.laser_name, response_rate=seconds)
+
+    def set_continue_lock(self, on):
+        self.continue_lock = bool(on)
+
+    def status(self):
+        """State of the lock as a JSON serialisable dictionary"""
+        frame = self.frame
+        laser_info = self.dict_laser_info[self.laser_name]
+        return {"laser": self.laser_name, "lasers": list(self.dict_laser_info), "desired_offset_MHz": laser_info[0],
+                "response_rate_s": laser_info[4], "gains": list(laser_gains(self.dict_laser_info, self.laser_name)),
+                "daq_channel": laser_channel(self.dict_laser_info, self.laser_name),
+                "scale": self.scale, "pos": self.pos, "locking": self.locking, "locked": bool(self.laser_lock_status),
+                "peaks_identified": self.peaks_identified, "identifying": self.ident_peaks, "stage": self.stage,
+                "calibrated": self.one_HeNe_FSR is not None, "in_MHz": self.in_MHz, "mirror_up": flipper.mirror_up,
+                "continue_lock": self.continue_lock, "osc_ok": self.status_osc,
+                "connection_lost": None if self.acquisition.connection_lost is None else str(self.acquisition.connection_lost),
+                "num_peaks": None if frame is None else int(frame.num_peaks),
+                "separation_MHz": None if frame is None or self.in_MHz is None else float(frame.separation),
+                "correction_V": None if frame is None or frame.correction is None else float(frame.correction),
+                "achieved_rate_Hz": controls.control_scheduler.achieved_rate,
+                "laser_locks": None if frame is None or frame.laser_locks is None else {
+                    name: {"separation_MHz": None if separation is None else float(separation),
+                           "correction_V": None if correction is None else float(correction), "locked": bool(locked)}
+                    for name, (separation, correction, locked) in frame.laser_locks.items()},
+                "dropped_frames": self.acquisition.dropped_frames,
+                "events": [{"time": event_time, "message": message} for event_time, message in self.events]}
+
+    def waveform(self):
+        frame = self.frame
+        if frame is None:
+            return {"waveform": [], "peaks": [], "hene_peak": None, "in_MHz": self.in_MHz}
+        return {"waveform": np.asarray(frame.waveform, dtype=float).tolist(),
+                "peaks": np.asarray(frame.peaks_loc, dtype=float).tolist(),
+                "hene_peak": None if self.hene_peak is None else float(self.hene_peak), "in_MHz": self.in_MHz}
+
+
+# POST path: (LockDaemon method, JSON field passed to it or None)
+ROUTES = {"/lock": ("set_locking", "on"), "/laser": ("select_laser", "name"), "/identify": ("identify_peaks", None),
+          "/calibrate": ("calibrate", None), "/mirror": ("move_mirror", "up"), "/scale": ("set_scale", "scale"),
+          "/response_rate": ("set_response_rate", "seconds"), "/continue_lock": ("set_continue_lock", "on")}
+
+
+class APIHandler(BaseHTTPRequestHandler):
+    daemon = None  # LockDaemon, set by serve
+
+    def do_GET(self):
+        if self.path == "/status":
+            self.reply(200, self.daemon.call(self.daemon.status))
+        elif self.path == "/waveform":
+            self.reply(200, self.daemon.call(self.daemon.waveform))
+        else:
+            self.reply(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path not in ROUTES:
+            self.reply(404, {"error": f"Unknown path {self.path}"})
+            return
+        method, field = ROUTES[self.path]
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            args = () if field is None else (body[field],)
+            self.daemon.call(getattr(self.daemon, method), *args)
+        except (ValueError, KeyError, TypeError) as error:
+            self.reply(400, {"error": str(error)})
+            return
+        self.reply(200, self.daemon.call(self.daemon.status))
+
+    def reply(self, code, content):
+        body = json.dumps(content).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(daemon, port=DEFAULT_PORT):
+    """Starts the API on http://localhost:port in a background thread. Returns the server (shutdown() to stop)"""
+    handler = type("LockAPIHandler", (APIHandler,), {"daemon": daemon})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, name="lock api", daemon=True).start()
+    print(f"Lock API on http://localhost:{port}")
+    return server
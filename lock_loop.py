@@ -0,0 +1,146 @@
+import time
+
+from acquisition import AcquisitionThread, HardwareProxy, LockSettings
+from acquisition_profiles import PROFILES, apply_profile, laser_profile
+from controls import osc_update, calibration_factors
+from flipper_raspi import PeakIdentification, flipper
+from ring_buffer import RingBuffer
+
+'''Lock loop shared by the GUI (user_interface.gui_main) and the headless daemon (lock_daemon.py). The acquisition
+thread runs Signal.final_data and owns the hardware; LockLoop holds the lock state (laser, pos/scale, calibration,
+peak identification) and runs the steps taken for every new frame. The GUI draws the frame and reacts to window events
+between frames, the daemon runs its API requests there. What needs the user (lost peaks, failed identification) goes
+through methods the GUI replaces with popups.'''
+
+CORRECTION_HISTORY_LENGTH = 100000  # voltage outputs kept in memory, several hours at the fastest response rate
+
+
+class LockLoop:
+    """Lock state and the per frame steps. Opens the last used laser (first in the store), puts the oscilloscope and
+    mirror in their start up state and creates the acquisition thread (started by the caller). instr and daq are the
+    connected oscilloscope and DAQ, used through HardwareProxy (self.instr, self.daq) once the thread runs.
+    calibration is an object with calibrate() (plots.OSCCalibration caches it for the plots)"""
+
+    def __init__(self, instr, daq, store, recorder=None, calibration=None, show_trig_sig=False):
+        self.store = store
+        self.dict_laser_info = store.lasers
+        self.laser_name = next(iter(self.dict_laser_info))  # last used laser, first in the file
+        self.default_pos, self.default_scale = self.dict_laser_info[self.laser_name][1:3]
+        self.pos, self.scale = self.default_pos, self.default_scale
+        self.locking = False
+        self.change_pos = False
+        self.continue_lock = False
+        self.peaks_identified = False
+        self.ident_peaks = False
+        self.stage = 0
+        self.stage_started = None  # time the peak identification stage began
+        self.prev_peaks = None
+        self.mirror_up = True
+        self.loc_mirror = 1
+        self.mirror_error = False
+        self.hene_peak = None
+        self.show_trig_sig = show_trig_sig
+        self.one_HeNe_FSR = None
+        self.cal_scale = None
+        self.cal_points = None  # number of waveform points when the scale was set up
+        self.in_MHz = None
+        self.in_nm = None
+        self.status_osc = True
+        self.rapid_data = False
+        self.lock_lasers = None  # lasers locked together (multi laser locking), None locks only laser_name
+        self.frame = None  # newest acquisition.Frame
+        self.laser_lock_status = False
+        self.events = []  # (time, message) of lost peaks, failed identification, ...
+        self.correction_history = RingBuffer(CORRECTION_HISTORY_LENGTH)  # voltages sent to the DAQ
+        self.reconnections = 0  # acquisition.reconnections seen
+        self.calibrate_axis = calibration_factors if calibration is None else calibration.calibrate
+        flipper.daq = daq
+        self.status_osc, self.scale, self.pos = osc_update(instr, self.scale, self.pos)
+        self.use_laser_profile(instr)
+        flipper.flipper_on()  # mirror up for faster calibration. Doesn't wait for the mirror to move
+        self.settings = LockSettings(**self.lock_settings(), laser_lock_status=False, rapid_data=self.rapid_data,
+                                     correction_history=self.correction_history)
+        self.acquisition = AcquisitionThread(instr, daq, self.settings, recorder=recorder)
+        self.instr = HardwareProxy(instr, self.acquisition, wait_for=("query", "query_str"))
+        self.daq = HardwareProxy(daq, self.acquisition)
+        flipper.daq = self.daq
+
+    def lock_settings(self):
+        """Lock state handed to the acquisition thread (Signal arguments)"""
+        return dict(pos=self.pos, default_pos=self.default_pos, change_pos=self.change_pos, locking=self.locking,
+                    in_MHz=self.in_MHz, continue_lock=self.continue_lock, scale=self.scale,
+                    peaks_identified=self.peaks_identified, ident_peaks=self.ident_peaks,
+                    default_scale=self.default_scale, dict_laser_info=self.dict_laser_info,
+                    laser_name=self.laser_name, show_trig_sig=self.show_trig_sig, lock_lasers=self.lock_lasers,
+                    hene_peak=self.hene_peak)
+
+    def push_settings(self):
+        """Hands the current state to the acquisition thread for the next frame"""
+        self.settings.update(**self.lock_settings(), rapid_data=self.rapid_data)
+
+    @property
+    def expected_peaks(self):
+        return len(self.lock_lasers) + 1 if self.lock_lasers else 2  # HeNe and one dip per locked laser
+
+    def next_frame(self, timeout=0):
+        """Processes the newest frame from the acquisition thread (older ones are dropped) and returns it, None if
+        there was no new frame within timeout sec"""
+        frames = self.acquisition.get_frames(timeout=timeout)
+        if frames:
+            self.process(frames[-1])
+        elif self.acquisition.connection_lost is not None:
+            self.laser_lock_status = False  # no frames while the scope or DAQ reconnects
+        if self.acquisition.reconnections != self.reconnections:
+            # back after an outage (supervisor.py). The supervisor has set the scope up again, read back the actual scale
+            self.reconnections = self.acquisition.reconnections
+            self.event("Hardware connection restored")
+            self.status_osc, self.scale, self.pos = osc_update(self.instr, self.scale, self.pos)
+        return frames[-1] if frames else None
+
+    def process(self, frame):
+        """Lock status, calibration, HeNe peak tracking and peak identification for a new frame"""
+        self.frame = frame
+        expected_peaks = self.expected_peaks
+        # only locked with the expected peaks, while locking, not changing pos and with the oscilloscope working
+        self.laser_lock_status = frame.laser_lock_status and self.locking and not self.change_pos and \
+            frame.num_peaks == expected_peaks and self.status_osc
+        self.in_MHz, self.in_nm = self.calibrate_axis(frame.scale, self.one_HeNe_FSR, self.cal_scale, self.cal_points,
+                                                      frame.len_waveform)
+        if frame.lost_peaks:
+            self.peaks_lost()
+        peaks_loc = frame.peaks_loc
+        if self.hene_peak is not None and len(peaks_loc):
+            # keeps track of the HeNe peak, identifies the peaks again if it moved too far within one frame
+            self.ident_peaks, self.peaks_identified = PeakIdentification(
+                self.ident_peaks, peaks_loc, self.peaks_identified, expected_peaks).check_peaks_in_range(
+                self.hene_peak, self.change_pos, frame.waveform)
+            self.hene_peak = peaks_loc[PeakIdentification.find_closest(self.hene_peak, peaks_loc)]
+        if self.ident_peaks:
+            # flips the mirror up to find the HeNe peak, then matches it to the closest peak with the mirror down
+            self.peaks_identified, self.stage, self.prev_peaks, self.hene_peak, self.mirror_up, self.ident_peaks, \
+                self.loc_mirror, self.mirror_error, self.stage_started = PeakIdentification(
+                    self.ident_peaks, peaks_loc, self.peaks_identified, expected_peaks).peak_identity(
+                    self.stage, self.prev_peaks, self.mirror_up, self.mirror_error, self.stage_started)
+        if self.mirror_error:
+            self.identification_failed()
+            self.mirror_error = False
+
+    def peaks_lost(self):
+        """Locking with the peaks lost. Stops locking unless continue_lock (the GUI asks with a popup)"""
+        self.event("Lost the peaks" + ("" if self.continue_lock else ", locking stopped"))
+        if not self.continue_lock:
+            self.locking = False
+
+    def identification_failed(self):
+        self.event("Peak identification failed (wrong number of peaks after moving the mirror)")
+
+    def event(self, message):
+        print(message)
+        self.events = self.events[-19:] + [(time.time(), message)]
+
+    def use_laser_profile(self, instr):
+        """Applies the acquisition profile saved for the laser, if any"""
+        profile = laser_profile(self.dict_laser_info, self.laser_name)
+        if profile is not None:
+            apply_profile(instr, profile)
+            self.rapid_data = PROFILES[profile].waveform_rate == "MWAVeform"
@@ -0,0 +1,174 @@
+import json
+import threading
+from time import monotonic, strftime
+
+import numpy as np
+
+'''Lock quality statistics, updated online from every locked frame (controls.Signal): mean/variance of the lock error
+and of the voltage, overlapping Allan deviation of the lock error over octaves of tau, and the power spectral density of
+the lock error. Memory doesn't grow with the run time. Shown in the GUI (Lock Statistics button) and exported as JSON.'''
+
+ALLAN_OCTAVES = 12  # tau = 1, 2, 4, ... 2048 frames
+PSD_SEGMENT = 256  # frames per PSD segment (Welch, Hann window, 50% overlap)
+
+
+class RunningStats:
+    """Mean and variance, updated one value at a time (Welford)"""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.  # sum of squared differences from the mean
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+
+class AllanDeviation:
+    """Overlapping Allan deviation at tau = m frames, m = 1, 2, 4, ... 2^(octaves - 1).
+    The running sum of the values (phase) is kept for the last 2 * m_max + 1 frames only, each new frame adds the
+    squared second difference x[i] - 2 x[i - m] + x[i - 2m] of every octave to its sum."""
+
+    def __init__(self, octaves=ALLAN_OCTAVES):
+        self.m = 2 ** np.arange(octaves)
+        self.phase = np.zeros(2 * self.m[-1] + 1)  # ring buffer of the running sum
+        self.index = 0  # frames added
+        self.sums = np.zeros(octaves)
+        self.counts = np.zeros(octaves, dtype=int)
+
+    def add(self, value):
+        size = len(self.phase)
+        current = self.phase[(self.index - 1) % size] + value if self.index else value
+        self.phase[self.index % size] = current
+        self.index += 1
+        ready = self.index > 2 * self.m  # enough frames for the second difference of the octave
+        if ready.any():
+            m = self.m[ready]
+            differences = current - 2 * self.phase[(self.index - 1 - m) % size] + self.phase[(self.index - 1 - 2 * m) % size]
+            self.sums[ready] += differences ** 2
+            self.counts[ready] += 1
+
+    def deviation(self):
+        """(tau in frames, Allan deviation) of the octaves with data"""
+        used = self.counts > 0
+        m = self.m[used]
+        return m, np.sqrt(self.sums[used] / (2 * m ** 2 * self.counts[used]))
+
+
+class StreamingPSD:
+    """Welch power spectral density (one sided, units^2/Hz), averaged over all segments so far. Only the current
+    segment is kept. The sample rate is the mean frame rate, given by the caller."""
+
+    def __init__(self, segment=PSD_SEGMENT):
+        self.segment = segment
+        self.window = np.hanning(segment)
+        self.buffer = np.zeros(segment)
+        self.filled = 0
+        self.power = np.zeros(segment // 2 + 1)  # sum of the segment periodograms
+        self.segments = 0
+
+    def add(self, value):
+        self.buffer[self.filled] = value
+        self.filled += 1
+        if self.filled == self.segment:
+            data = self.buffer - self.buffer.mean()
+            self.power += np.abs(np.fft.rfft(data * self.window)) ** 2
+            self.segments += 1
+            half = self.segment // 2
+            self.buffer[:half] = self.buffer[half:]  # 50% overlap
+            self.filled = half
+
+    def spectrum(self, sample_rate):
+        """(frequency in Hz, PSD), empty until the first segment is complete"""
+        if self.segments == 0 or sample_rate <= 0:
+            return np.array([]), np.array([])
+        psd = self.power / self.segments / (sample_rate * np.sum(self.window ** 2))
+        psd[1:-1] *= 2  # one sided
+        return np.fft.rfftfreq(self.segment, 1 / sample_rate), psd
+
+
+class LockStatistics:
+    """Statistics of the lock of one laser. add() is called by the acquisition thread, the GUI reads summary().
+    Starts again when the laser changes or reset() is called."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, laser_name=None):
+        with self._lock:
+            self.laser_name = laser_name
+            self.error = RunningStats()  # MHz, separation - desired offset
+            self.voltage = RunningStats()  # V, controller output
+            self.allan = AllanDeviation()
+            self.psd = StreamingPSD()
+            self.start = None
+            self.last = None
+
+    def add(self, laser_name, error, voltage, now=None):
+        """One locked frame. error in MHz, voltage is the controller output (V)"""
+        if laser_name != self.laser_name:
+            self.reset(laser_name)
+        now = monotonic() if now is None else now
+        with self._lock:
+            if self.start is None:
+                self.start = now
+            self.last = now
+            self.error.add(error)
+            self.voltage.add(voltage)
+            self.allan.add(error)
+            self.psd.add(error)
+
+    def frame_interval(self):
+        """Mean time between locked frames (sec). Frames aren't evenly spaced, tau and frequencies use the mean"""
+        return (self.last - self.start) / (self.error.count - 1) if self.error.count > 1 else 0.
+
+    def summary(self):
+        """Current statistics as a dictionary of numbers and lists (JSON serialisable)"""
+        with self._lock:
+            interval = self.frame_interval()
+            m, adev = self.allan.deviation()
+            frequency, psd = self.psd.spectrum(1 / interval if interval > 0 else 0.)
+            return {"laser": self.laser_name, "frames": self.error.count, "frame_interval_s": interval,
+                    "error_mean_MHz": self.error.mean, "error_std_MHz": self.error.std,
+                    "voltage_mean_V": self.voltage.mean, "voltage_std_V": self.voltage.std,
+                    "allan_tau_s": list(m * interval), "allan_deviation_MHz": list(adev),
+                    "psd_frequency_Hz": list(frequency), "psd_MHz2_per_Hz": list(psd)}
+
+    def export(self, fname=None):
+        """Writes summary() to a JSON file (default lock_statistics_<laser>_<time>.json). Returns the file name"""
+        summary = self.summary()
+        if fname is None:
+            fname = f"lock_statistics_{summary['laser']}_{strftime('%Y%m%d-%H%M%S')}.json"
+        with open(fname, 'w') as export_file:
+            json.dump(summary, export_file, indent=2)
+        return fname
+
+
+def summary_text(summary):
+    """Statistics summary as lines of text, for the GUI"""
+    lines = [f"Laser: {summary['laser']}   frames: {summary['frames']}   "
+             f"frame interval: {summary['frame_interval_s']:.3f} s",
+             f"Lock error: mean {summary['error_mean_MHz']:.3f} MHz, std {summary['error_std_MHz']:.3f} MHz",
+             f"Voltage: mean {summary['voltage_mean_V']:.4f} V, std {summary['voltage_std_V']:.4f} V",
+             "", "Allan deviation (lock error)"]
+    lines += [f"  tau {tau:10.4g} s: {adev:.4f} MHz" for tau, adev in
+              zip(summary['allan_tau_s'], summary['allan_deviation_MHz'])]
+    frequency, psd = summary['psd_frequency_Hz'], summary['psd_MHz2_per_Hz']
+    if frequency:
+        # a few points of the spectrum, log spaced (all of it is in the export)
+        lines += ["", "Lock error PSD"]
+        for i in np.unique(np.geomspace(1, len(frequency) - 1, 8).astype(int)):
+            lines.append(f"  {frequency[i]:8.4f} Hz: {np.sqrt(psd[i]):.4f} MHz/rtHz")
+    return lines
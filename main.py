@@ -1,24 +1,106 @@
-from osc_connection import connect
-from user_interface import gui_main
-from DAQ_control import DAQ
+import argparse
+import controls
 import sys
 from time import sleep
 
-# connect to osc
-instr = connect()
-DAQ().DAQconnect()
+# backend selection. "hardware" needs the oscilloscope (RsInstrument + RSVISA) and the MCC DAQ (mcculw).
+# "simulated" uses simulation.py, so the program can be run and timed without the lab
+parser = argparse.ArgumentParser(description="Frequency offset lock")
+parser.add_argument("--backend", choices=["hardware", "simulated"], default="hardware")
+parser.add_argument("--points", type=int, choices=[600, 3000, 6000], default=3000,
+                    help="simulated waveform points (rapid data collection gives 1/5 of this)")
+parser.add_argument("--replay", metavar="TRACE_FILE", default=None,
+                    help="simulated oscilloscope replays this trace file (e.g. C_test_TraceFile.CSV) or recording directory")
+parser.add_argument("--extra-lasers", metavar="OFFSET", type=float, nargs="*", default=[],
+                    help="simulated oscilloscope shows more laser dips at these offsets (MHz), tuned by DAQ channels 1, 2, ...")
+parser.add_argument("--record", metavar="DIR", default=None,
+                    help="record every frame (trace, peaks, correction) to DIR, keeping the newest chunks (recorder.py)")
+parser.add_argument("--peak-refinement", choices=controls.PEAK_REFINEMENTS, default=None,
+                    help="fit sub-sample dip positions for the peak separation (useful with rapid data collection)")
+parser.add_argument("--peak-tracking", action="store_true",
+                    help="search for peaks only around the last peak positions, with a full search when a peak is lost")
+parser.add_argument("--pipeline", action="store_true",
+                    help="read the next waveform while the last one is processed (pipeline.py), reports the hidden transfer time. "
+                         "The frame read ahead is thrown away after every lock voltage, so the PID never sees data from before it")
+parser.add_argument("--batch-frames", type=int, default=1,
+                    help="read this many frames per lock step and use their mean separation (noise estimate for the controller)")
+parser.add_argument("--ramp", action="store_true",
+                    help="experimental: play each lock voltage as a smooth hardware timed ramp (DAQ output scan) instead of a "
+                         "step. The PID gains aren't tuned for the delay the ramp adds, so it currently degrades the lock "
+                         "(lock error std 0.57 -> 0.89 MHz on the simulator)")
+parser.add_argument("--metrics-port", type=int, default=None,
+                    help="serve loop metrics (rates, stage latencies, lock events) on http://localhost:PORT/metrics")
+parser.add_argument("--metrics-file", default=None,
+                    help="write the loop metrics to this file every 10 s")
+parser.add_argument("--headless", action="store_true",
+                    help="run the lock without the GUI, controlled through the JSON API (lock_daemon.py, lock_client.py)")
+parser.add_argument("--api-port", type=int, default=8700,
+                    help="port of the headless lock API on localhost")
+args = parser.parse_args()
+controls.peak_refinement = args.peak_refinement
+controls.peak_tracking = args.peak_tracking
+controls.batch_frames = args.batch_frames
+controls.output_ramp = args.ramp
+
+if args.backend == "hardware":
+    import osc_connection
+    import DAQ_control
+    from supervisor import SupervisedScope, SupervisedDAQ
+    # connect to osc and DAQ. A lost connection is re-established in the background with the settings in use (supervisor.py)
+    try:
+        instr = SupervisedScope(osc_connection.connect)
+    except (ConnectionError, RuntimeError) as error:
+        sys.exit(f"Oscilloscope not connected: {error}")
+    try:
+        daq = SupervisedDAQ(DAQ_control.connect)
+    except (ConnectionError, RuntimeError, DAQ_control.ULError) as error:
+        instr.close()
+        sys.exit(f"DAQ not connected: {error}")
+else:
+    from simulation import simulated_backends
+    instr, daq = simulated_backends(points=args.points, trace_file=args.replay, extra_lasers=args.extra_lasers)
+if args.pipeline:
+    from pipeline import PipelinedScope
+    instr = PipelinedScope(instr)  # closing it stops the transfer thread and closes the connection
+if args.metrics_port is not None or args.metrics_file is not None:
+    import metrics
+    metrics.install(daq, gui=not args.headless)  # wraps the loop stages, nothing is measured without it
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+    if args.metrics_file is not None:
+        metrics.dump_periodically(args.metrics_file)
+recorder = None
+if args.record is not None:
+    from recorder import TraceRecorder
+    recorder = TraceRecorder(args.record)
 sleep(1)
 
 try:
-    gui_main(instr)
-except KeyboardInterrupt or SystemExit:
+    if args.headless:
+        from lock_daemon import LockDaemon, serve
+        daemon = LockDaemon(instr, daq, recorder=recorder)
+        server = serve(daemon, args.api_port)
+        try:
+            daemon.run()  # until Ctrl+C, the laser settings are saved and the acquisition stopped on the way out
+        finally:
+            server.shutdown()
+        raise SystemExit
+    from user_interface import gui_main  # PySimpleGUI and matplotlib only needed with the GUI
+    gui_main(instr, daq, recorder)
+except (KeyboardInterrupt, SystemExit):  # gui_main stops the acquisition thread before returning
     instr.close()  # close osc connection
-    DAQ().daq_disconnect()
+    daq.daq_disconnect()
     sys.exit()
+finally:
+    if args.pipeline:
+        instr.report()
+    if recorder is not None:
+        recorder.close()
+        print(f"Recorded {recorder.recorded} frames to {args.record} ({recorder.dropped} dropped)")
 
 # Limitations in this code :
-# - Unable to manually select oscilloscope waveform/point collection rate  (Can only do Auto, max waveform or max points)
-# - Voltage response rate limited by speed of code/oscilloscope response. Perhaps multithreading would be beneficial, however code is only ~0.15 sec compared to the 0.2-1.3 sec for the oscilloscope
+# - Oscilloscope waveform/point collection rate is chosen from the profiles in acquisition_profiles.py (Tune Acquisition button), not set freely
+# - Voltage response rate limited by oscilloscope response (0.2-1.3 sec). The lock loop runs in its own thread (acquisition.py), so GUI redraws no longer slow it down
 # - Faster osc. speed means less data points (speed of data transfer -> size of data)
 # - Change Pos button is not really necessary right now. If able to get a controllable scan generator, or want to add in capabilities for the oscilloscope to center the peaks, this would allow the user to override any changes in pos by the oscilloscope.
 # - Found that the centering was not very important given that ideally one HeNe FSR should be about the scan range
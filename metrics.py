@@ -0,0 +1,210 @@
+import bisect
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+'''Metrics of the acquisition/lock loop (main.py --metrics-port / --metrics-file). Counters, gauges and latency
+histograms, exported as text on http://localhost:<port>/metrics or written to a file every few seconds.
+Disabled by default: the stages are only wrapped by install(), so without it the loop runs the original functions
+and the few direct hooks (frame_done, gui_loop) are behind a single "if metrics.enabled" check.'''
+
+enabled = False
+LATENCY_BUCKETS = [1e-5 * 2 ** i for i in range(21)]  # sec, 10 us to ~10 s
+DUMP_INTERVAL = 10  # sec between file dumps
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount  # only ever incremented from one thread per counter, no lock needed
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0.
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    """Counts of values per bucket (upper bounds), with the sum, count and maximum"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last is above the largest bucket
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile"""
+        if self.count == 0:
+            return 0.
+        target = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets + [self.max], self.counts):
+            total += count
+            if total >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+class Registry:
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.start = time.monotonic()
+        self.last_export = (self.start, {})  # time and counter values at the last text export, for rates
+        self._lock = threading.Lock()  # only for creating metrics and exporting
+
+    def counter(self, name):
+        if name not in self.counters:
+            with self._lock:
+                self.counters.setdefault(name, Counter())
+        return self.counters[name]
+
+    def gauge(self, name):
+        if name not in self.gauges:
+            with self._lock:
+                self.gauges.setdefault(name, Gauge())
+        return self.gauges[name]
+
+    def histogram(self, name):
+        if name not in self.histograms:
+            with self._lock:
+                self.histograms.setdefault(name, Histogram())
+        return self.histograms[name]
+
+    def text(self):
+        """All metrics as text, one per line. Counters also give their rate (/s) since the last export"""
+        with self._lock:
+            now = time.monotonic()
+            last_time, last_values = self.last_export
+            lines = [f"uptime_seconds {now - self.start:.1f}"]
+            for name, counter in sorted(self.counters.items()):
+                rate = (counter.value - last_values.get(name, 0)) / (now - last_time) if now > last_time else 0.
+                lines.append(f"{name}_total {counter.value}")
+                lines.append(f"{name}_per_second {rate:.3f}")
+            for name, gauge in sorted(self.gauges.items()):
+                lines.append(f"{name} {gauge.value:g}")
+            for name, histogram in sorted(self.histograms.items()):
+                mean = histogram.sum / histogram.count if histogram.count else 0.
+                lines.append(f"{name}_seconds count={histogram.count} mean={mean * 1000:.3f}ms "
+                             f"p50={histogram.quantile(0.5) * 1000:.3f}ms p99={histogram.quantile(0.99) * 1000:.3f}ms "
+                             f"max={histogram.max * 1000:.3f}ms")
+            self.last_export = (now, {name: counter.value for name, counter in self.counters.items()})
+            return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def timed(name, func):
+    """Wraps func so its run time goes into the latency histogram name"""
+    histogram = registry.histogram(name)
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    return wrapper
+
+
+def install(daq, gui=True):
+    """Enables metrics and wraps the stages of the loop: get_trace, find_peaks, lock_laser, daq_output/daq_ramp (of daq,
+    the DAQ or SimulatedDAQ instance), the flipper moves and update_gui (if gui). window.read is wrapped by gui_main"""
+    global enabled
+    import controls
+    from types import SimpleNamespace
+    from flipper_raspi import flipper
+    enabled = True
+    controls.get_trace = timed("get_trace", controls.get_trace)
+    controls.signal = SimpleNamespace(find_peaks=timed("find_peaks", controls.signal.find_peaks))
+    controls.lock_laser = timed("lock_laser", controls.lock_laser)
+    daq.daq_output = timed("daq_output", daq.daq_output)
+    daq.daq_ramp = timed("daq_ramp", daq.daq_ramp)
+    flipper.flipper_on = timed("flipper_on", flipper.flipper_on)
+    flipper.flipper_off = timed("flipper_off", flipper.flipper_off)
+    if gui:
+        import user_interface
+        user_interface.update_gui = timed("update_gui", user_interface.update_gui)
+
+
+previous_lock_status = None
+
+
+def frame_done(frame):
+    """Called by the acquisition thread for every frame (acquisition.Frame): loop rate, lost peaks, lock transitions"""
+    global previous_lock_status
+    registry.counter("frames").inc()
+    registry.gauge("num_peaks").set(frame.num_peaks)
+    if frame.lost_peaks:
+        registry.counter("lost_peaks").inc()
+    if frame.voltage_out:
+        registry.counter("lock_voltage_writes").inc()
+    if previous_lock_status is not None and frame.laser_lock_status != previous_lock_status:
+        registry.counter("lock_acquired" if frame.laser_lock_status else "lock_lost").inc()
+    registry.gauge("locked").set(1 if frame.laser_lock_status else 0)
+    previous_lock_status = frame.laser_lock_status
+
+
+def gui_loop(dropped_frames):
+    """Called once per GUI loop"""
+    registry.counter("gui_loops").inc()
+    registry.gauge("dropped_frames").set(dropped_frames)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = registry.text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # no line per request in the console
+
+
+def serve(port):
+    """Serves the metrics on http://localhost:port/metrics (only reachable from this computer)"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics http", daemon=True).start()
+    print(f"Metrics on http://localhost:{port}/metrics")
+    return server
+
+
+def dump_periodically(fname, interval=DUMP_INTERVAL):
+    """Writes the metrics to fname every interval sec (temporary file then rename, so readers never see half a file)"""
+    def run():
+        while True:
+            time.sleep(interval)
+            dump(fname)
+
+    threading.Thread(target=run, name="metrics dump", daemon=True).start()
+
+
+def dump(fname):
+    temporary = fname + ".tmp"
+    with open(temporary, 'w') as dump_file:
+        dump_file.write(registry.text())
+    os.replace(temporary, fname)
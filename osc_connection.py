@@ -1,7 +1,8 @@
 from RsInstrument import *  # RS library for oscilloscope communication. Requires RSVISA application on device
+from controls import set_data_format
 
 
-'''Connects to oscilloscope. Only to be run once, at the start of the program'''
+'''Connects to oscilloscope. Run at the start of the program, and again by supervisor.SupervisedScope after a lost connection'''
 
 
 # Default position upon start up, reverts to this value upon errors. Will be adjustable by user during program run
@@ -9,7 +10,8 @@ from RsInstrument import *  # RS library for oscilloscope communication. Require
 # osc IP =  http://142.90.121.229/
 # offline lab osc IP = 142.90.106.218
 
-def connect():
+def connect(data_format="REAL,32"):
+    """data_format is the waveform transfer format, one of controls.DATA_FORMATS. Use "ASCii" if binary transfer gives trouble."""
     RsInstrument.assert_minimum_version('1.50.0')  # ensure correct version used
 
     # instrument options
@@ -19,7 +21,7 @@ def connect():
     # connect to oscilloscope
     LanConnect = 'TCPIP::142.90.121.229::inst0::INSTR'  # Instrument address
     if LanConnect not in instr_list:  # check if osc is an option
-        exit("Cannot Find Oscilloscope, Try Again")
+        raise ConnectionError("Cannot Find Oscilloscope, Try Again")  # at start up main.py stops, later the supervisor tries again
     instr = RsInstrument(LanConnect, True, False)  # connect
     idn = instr.query_str('*IDN?')  # request ID from oscilloscope (to ensure proper connection)
     # print connected instrument details
@@ -39,7 +41,7 @@ def connect():
     instr.write('TRIGger:A:MODE NORmal')  # only record when triggered - switch back to NORmal
     instr.write('ACQuire:INTerpolate SMHD')  # data collection as histogram-like so distance between points is const. Doesn't stay constant for all scale ranges!
     instr.write('CHANnel1:DATA:POINts DEFault')
-    instr.write("FORM ASCii")
+    set_data_format(instr, data_format)  # binary block transfer, decoded with np.frombuffer in controls.read_channel
     instr.write('CHANnel1:ARIThmetics AVERage')
     instr.write('ACQuire:AVERage:COUNt 2')
     instr.write('CHANnel1:TYPE PDETect')
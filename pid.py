@@ -0,0 +1,78 @@
+from time import monotonic
+
+import numpy as np
+
+# Default gains for lasers saved without them in the CSV file. Error is in MHz, gains are relative to the laser's
+# voltage for 1 MHz change, so kp = 1 corrects the whole error in one step, ki (1/s) and kd (s) are per second
+DEFAULT_GAINS = (0.3, 0.5, 0.)  # kp, ki, kd
+OUTPUT_LIMIT = 5.  # V, DAQ output range. The lock is lost (voltage back to 0) if the output reaches it
+MAX_SLEW = 1.  # V/s, largest change of the output voltage
+DERIVATIVE_FILTER = 0.5  # sec, time constant of the low pass filter on the derivative
+
+
+class PIDController:
+    """PID lock of the peak separation. Output is the absolute voltage for the DAQ.
+    - integral is kept in volts and clamped to the output range. It is frozen while the output is limited (range or
+      slew) and the error would push it further (anti-windup)
+    - derivative is taken on the measured separation (no kick when the desired offset changes) and low pass filtered
+    - output changes by at most max_slew V/s
+    - bumpless transfer: while not locking, hold() is given the voltage on the DAQ. When locking starts (or the laser
+      is changed) the integral is set so that the first output is that voltage
+    - if the variance of the measurement is known (batch acquisition), P and I are scaled by error^2 / (error^2 + variance),
+      so errors within the noise barely move the output"""
+
+    def __init__(self, output_limit=OUTPUT_LIMIT, max_slew=MAX_SLEW, derivative_filter=DERIVATIVE_FILTER):
+        self.output_limit = output_limit
+        self.max_slew = max_slew
+        self.derivative_filter = derivative_filter
+        self.kp, self.ki, self.kd = DEFAULT_GAINS
+        self.gain = 0.  # V/MHz, -polarity * voltage for 1 MHz
+        self.laser_name = None
+        self.active = False
+        self.output = 0.  # V, last output (or the held voltage)
+        self.integral = 0.  # V
+        self.derivative = 0.  # MHz/s, filtered
+        self.last_measurement = None
+        self.last_time = None
+
+    def configure(self, laser_name, kp, ki, kd, voltage_1MHz, polarity):
+        """Sets the gains of the selected laser. A new laser starts again from the current output"""
+        if laser_name != self.laser_name:
+            self.laser_name = laser_name
+            self.active = False
+        self.kp, self.ki, self.kd = kp, ki, kd
+        self.gain = -1 * polarity * voltage_1MHz  # drives in the opposite direction to error
+
+    def hold(self, output):
+        """Not locking. output is the voltage on the DAQ, locking will start from it"""
+        self.active = False
+        self.output = output
+
+    def update(self, measurement, setpoint, now=None, variance=None):
+        """One controller step. measurement and setpoint in MHz, variance of the measurement in MHz^2 (optional).
+        Returns the voltage to output"""
+        now = monotonic() if now is None else now
+        error = measurement - setpoint
+        weight = 1. if not variance else error ** 2 / (error ** 2 + variance)
+        if not self.active:
+            # bumpless transfer, the integral takes the part of the current output P doesn't give
+            self.integral = self.output - self.gain * weight * self.kp * error
+            self.derivative = 0.
+            self.last_measurement = measurement
+            self.last_time = now
+            self.active = True
+        dt = now - self.last_time
+        if dt > 0:
+            raw_derivative = (measurement - self.last_measurement) / dt
+            self.derivative += dt / (self.derivative_filter + dt) * (raw_derivative - self.derivative)
+        integral = np.clip(self.integral + weight * self.gain * self.ki * error * dt, -self.output_limit, self.output_limit)
+        output = self.gain * (weight * self.kp * error + self.kd * self.derivative) + integral
+        limited = np.clip(output, -self.output_limit, self.output_limit)
+        limited = np.clip(limited, self.output - self.max_slew * dt, self.output + self.max_slew * dt)
+        # anti-windup, only integrate if the output isn't limited or the integral moves it back towards the limit
+        if limited == output or np.sign(integral - self.integral) != np.sign(output - limited):
+            self.integral = integral
+        self.output = float(limited)
+        self.last_measurement = measurement
+        self.last_time = now
+        return self.output
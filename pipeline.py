@@ -0,0 +1,121 @@
+import queue
+import threading
+from time import perf_counter, sleep
+
+from controls import read_channel
+from supervisor import ConnectionLost
+
+'''Pipelined oscilloscope reads (main.py/benchmark.py --pipeline). A transfer thread reads the next waveforms while the
+lock processes the last ones, so the transfer time is hidden behind peak finding, the controller and the GUI calls.'''
+
+OUTAGE_WAIT = 0.1  # sec between reads while the scope is reconnecting
+
+
+class PipelinedScope:
+    """Wraps the oscilloscope connection. read_frame (used by controls.get_trace) returns waveforms the transfer thread
+    has already read, and the thread starts reading the next frame straight away (double buffer: one frame being
+    processed, one being read). The frame used is therefore read up to one cycle earlier than a blocking read would be.
+    Every other call (write, query, ...) is passed on to the connection, one at a time with the transfer thread.
+    A write (scale, pos, trigger, acquisition settings) throws away frames read before it, and so does a lock voltage
+    written to the DAQ (invalidate, called by controls.Signal.final_data): the PID never sees a frame from before its
+    last correction. While a voltage is written every frame this waits for a fresh read, as without the pipeline.
+    hidden_latency() gives how much of the transfer time was overlapped with processing."""
+
+    def __init__(self, instr, depth=1):
+        self.instr = instr
+        self.instr_lock = threading.Lock()  # the connection isn't thread safe
+        self.slots = queue.Queue(maxsize=depth)  # frames read ahead
+        self.channels = (1,)  # channels read for each frame, set by read_frame
+        self.generation = 0  # changed by writes, frames from an older generation are thrown away
+        self.transfer_time = 0.  # sec, total time spent reading frames used
+        self.wait_time = 0.  # sec, total time read_frame waited for a frame
+        self.frames = 0
+        self.discarded = 0  # frames thrown away after a write or channel change
+        self.error = None
+        self.running = True
+        self.thread = threading.Thread(target=self.transfer_loop, name="scope transfer", daemon=True)
+        self.thread.start()
+
+    def __getattr__(self, name):
+        attr = getattr(self.instr, name)
+        if not callable(attr):
+            return attr
+
+        def locked(*args, **kwargs):
+            with self.instr_lock:
+                if name == "write":
+                    self.generation += 1
+                return attr(*args, **kwargs)
+
+        return locked
+
+    def invalidate(self):
+        """Throws away the frames read ahead and the one being read (they don't show the effect of a new lock voltage)"""
+        with self.instr_lock:
+            self.generation += 1
+
+    def read_frame(self, channels):
+        """Waveforms of channels (list of arrays) from the next frame read after the last write"""
+        channels = tuple(channels)
+        if channels != self.channels:
+            with self.instr_lock:
+                self.channels = channels
+                self.generation += 1
+        start = perf_counter()
+        while True:
+            try:
+                generation, traces, transfer_time = self.slots.get(timeout=0.5)
+            except queue.Empty:
+                if self.error is not None:
+                    raise RuntimeError("Scope transfer thread stopped") from self.error
+                continue
+            if isinstance(traces, ConnectionLost) and not getattr(self.instr, "connected", False):
+                raise traces
+            if generation == self.generation and not isinstance(traces, ConnectionLost):
+                break  # errors read before the scope came back are thrown away
+            self.discarded += 1
+        self.wait_time += perf_counter() - start
+        self.transfer_time += transfer_time
+        self.frames += 1
+        return traces
+
+    def transfer_loop(self):
+        try:
+            while self.running:
+                start = perf_counter()
+                with self.instr_lock:
+                    generation = self.generation
+                    try:
+                        traces = [read_channel(self.instr, channel) for channel in self.channels]
+                    except ConnectionLost as error:
+                        traces = error  # raised by read_frame, the thread carries on until the scope is back
+                if isinstance(traces, ConnectionLost):
+                    sleep(OUTAGE_WAIT)
+                item = (generation, traces, perf_counter() - start)
+                while self.running:
+                    try:
+                        self.slots.put(item, timeout=0.5)
+                        break
+                    except queue.Full:
+                        pass
+        except Exception as error:
+            self.error = error
+
+    def hidden_latency(self):
+        """(mean transfer time per frame, mean time the lock waited for it (sec), fraction of the transfer hidden)"""
+        if self.frames == 0:
+            return 0., 0., 0.
+        transfer = self.transfer_time / self.frames
+        wait = self.wait_time / self.frames
+        return transfer, wait, max(0., 1 - wait / transfer) if transfer > 0 else 0.
+
+    def report(self):
+        transfer, wait, hidden = self.hidden_latency()
+        print(f"Pipelined scope reads: {self.frames} frames, transfer {transfer * 1000:.1f} ms, waited "
+              f"{wait * 1000:.1f} ms per frame ({hidden:.0%} of the transfer hidden), {self.discarded} discarded")
+
+    def close(self):
+        """Stops the transfer thread and closes the connection"""
+        self.running = False
+        self.thread.join(5)
+        self.instr.close()
@@ -0,0 +1,216 @@
+import numpy as np
+from matplotlib.ticker import FormatStrFormatter
+
+from controls import calibration_factors
+
+'''Waveform and correction voltage plots of the GUI, drawn on matplotlib figure canvases. Nothing here needs
+PySimpleGUI/Tk: user_interface.py puts the canvases in the window, benchmark.py --render draws on Agg canvases.'''
+
+ERROR_GRAPH_POINTS = 50  # number of most recent voltage outputs shown on the error graph
+
+
+class WaveformPlot:
+    """Waveform display. Lines, markers and text are made once and updated with set_data each frame, then blitted over
+    a cached background of the axes. The axes themselves (ticks, grid, labels) are only redrawn when the limits change,
+    i.e. when the calibration, scale or number of points changes."""
+
+    def __init__(self, fig_agg, ax, calibration=None):
+        self.fig_agg = fig_agg
+        self.ax = ax
+        self.calibration = calibration if calibration is not None else OSCCalibration()
+        self.background = None
+        self.calibrated = None
+        ax.grid()
+        ax.minorticks_on()
+        # turn off top and right axis for aesthetics
+        ax.spines['top'].set_visible(False)
+        ax.spines['right'].set_visible(False)
+        ax.set_ylabel("Millivolts", labelpad=0.2)
+        ax.yaxis.set_major_formatter(FormatStrFormatter('%.00f'))
+        ax.set_ylim([-15, 1])
+        line_colour = "#5F9EA0"
+        self.trigger_line, = ax.plot([], [], animated=True)
+        self.waveform_line, = ax.plot([], [], color=line_colour, linewidth=2, animated=True)
+        self.peaks_marker, = ax.plot([], [], 'x', color="#7223B4", linewidth=2, animated=True)
+        # hene peak identifiers, red x and "HeNe" text
+        self.hene_marker, = ax.plot([], [], 'x', color="r", linewidth=10, animated=True)
+        self.hene_text = ax.text(0, 0, "HeNe", animated=True, visible=False)
+        self.artists = [self.trigger_line, self.waveform_line, self.peaks_marker, self.hene_marker, self.hene_text]
+        fig_agg.mpl_connect('draw_event', self.on_draw)
+
+    def on_draw(self, event):
+        """After a full redraw (axes change, window resize) save the empty axes as background and draw the artists on it"""
+        self.background = self.fig_agg.copy_from_bbox(self.ax.bbox)
+        self.draw_artists()
+
+    def draw_artists(self):
+        for artist in self.artists:
+            self.ax.draw_artist(artist)
+
+    def update(self, waveform, peaks_loc, in_MHz, trigger_data, hene_peak, peaks_identified, len_waveform):
+        x_axis_points, peaks_loc_cal, x_axis_points_trig, hene_peak_cal = self.calibration.cal_hene(in_MHz, self.ax,
+                                                                                                  peaks_loc,
+                                                                                                  trigger_data,
+                                                                                                  hene_peak,
+                                                                                                  len_waveform)
+        self.trigger_line.set_data(x_axis_points_trig, -np.asarray(trigger_data))
+        self.waveform_line.set_data(x_axis_points, waveform)
+        self.peaks_marker.set_data(peaks_loc_cal, waveform[peaks_loc])
+        if peaks_identified and hene_peak is not None:
+            self.hene_marker.set_data([hene_peak_cal], [waveform[hene_peak]])
+            self.hene_text.set_position((hene_peak_cal, waveform[hene_peak] - 2))
+            self.hene_text.set_visible(True)
+        else:
+            self.hene_marker.set_data([], [])
+            self.hene_text.set_visible(False)
+        if self.axes_changed(x_axis_points, waveform, in_MHz is not None and hene_peak is not None):
+            self.fig_agg.draw()  # full redraw, on_draw caches the new background
+        elif self.background is not None:
+            self.fig_agg.restore_region(self.background)
+            self.draw_artists()
+            self.fig_agg.blit(self.ax.bbox)
+
+    def axes_changed(self, x_axis_points, waveform, calibrated):
+        """Sets new axis limits/labels if needed. Returns True if the axes have to be redrawn"""
+        changed = self.background is None
+        # label x-axis in MHz only when calibrated and HeNe peak identified
+        if calibrated != self.calibrated:
+            self.calibrated = calibrated
+            self.ax.set_xlabel("MHz" if calibrated else "", labelpad=0.2)
+            changed = True
+        # x limits follow the calibrated x-axis. Small shifts of the HeNe peak between frames don't move the axis
+        x_min, x_max = self.ax.get_xlim()
+        leeway = 0.02 * abs(x_axis_points[-1] - x_axis_points[0])
+        if abs(x_axis_points[0] - x_min) > leeway or abs(x_axis_points[-1] - x_max) > leeway:
+            self.ax.set_xlim([x_axis_points[0], x_axis_points[-1]])
+            changed = True
+        # y limits are fixed at -15, 1 mV to reduce movement of the axis. Only grows if the waveform doesn't fit
+        y_min, y_max = self.ax.get_ylim()
+        wave_min, wave_max = np.amin(waveform), np.amax(waveform)
+        if -15 <= wave_min <= 1 and wave_max <= 1:
+            new_ylim = (-15, 1)
+        else:
+            new_ylim = (min(wave_min, -15), max(wave_max, 1))
+        if (y_min, y_max) != new_ylim and (wave_min < y_min or wave_max > y_max or new_ylim == (-15, 1)):
+            self.ax.set_ylim(new_ylim)
+            changed = True
+        return changed
+
+
+class ErrorPlot:
+    """Correction voltage display. Same idea as WaveformPlot: one line and one text artist, blitted every frame.
+    Axes only redrawn when the y range has to change."""
+
+    def __init__(self, fig_agg_error, ax_error):
+        self.fig_agg = fig_agg_error
+        self.ax = ax_error
+        self.background = None
+        ax_error.grid()
+        ax_error.minorticks_on()
+        ax_error.spines['top'].set_visible(False)
+        ax_error.spines['right'].set_visible(False)
+        ax_error.spines['bottom'].set_position('zero')
+        ax_error.set_ylabel("Volts", labelpad=0.2)
+        ax_error.xaxis.set_visible(False)
+        ax_error.set_xlim([0, ERROR_GRAPH_POINTS + 1])
+        line_colour = "#ED798D"
+        self.line, = ax_error.plot([], [], color=line_colour, linewidth=2, animated=True)
+        self.text = ax_error.text(0, 0, "", animated=True)  # text displaying most recent voltage output value
+        self.artists = [self.line, self.text]
+        fig_agg_error.mpl_connect('draw_event', self.on_draw)
+
+    def on_draw(self, event):
+        self.background = self.fig_agg.copy_from_bbox(self.ax.bbox)
+        for artist in self.artists:
+            self.ax.draw_artist(artist)
+
+    def update(self, corrections):
+        """corrections are the most recent voltage outputs, oldest first"""
+        if len(corrections) == 0:
+            return
+        self.line.set_data(np.arange(len(corrections)), corrections)
+        self.text.set_position((len(corrections), corrections[-1]))
+        self.text.set_text(f'{corrections[-1]:.3f}')
+        # y range symmetric around 0. Only changed if corrections don't fit or are much smaller than the range
+        max_cor = np.amax(np.abs(corrections)) + 0.05
+        y_max = self.ax.get_ylim()[1]
+        if self.background is None or max_cor > y_max or max_cor < y_max / 3:
+            y_max = 1.5 * max_cor  # headroom, so a slowly ramping voltage doesn't redraw the axes every frame
+            self.ax.set_ylim([-y_max, y_max])
+            self.fig_agg.draw()
+        else:
+            self.fig_agg.restore_region(self.background)
+            for artist in self.artists:
+                self.ax.draw_artist(artist)
+            self.fig_agg.blit(self.ax.bbox)
+
+
+# Start up commands for GUI
+
+
+class OSCCalibration:
+    """Calibration of the x-axis. The calibration factors are only recalculated when the scale, HeNe FSR, calibration
+    scale or number of points changes, and the x-axis arrays only when the calibration or number of points changes."""
+
+    def __init__(self):
+        self.key = None  # (scale, one_HeNe_FSR, cal_scale, cal_points, len_waveform) of the cached factors
+        self.in_MHz = None
+        self.in_nm = None
+        self.x_axis = {}  # number of points: x-axis points in MHz (from 0), for the current in_MHz
+        self.x_axis_in_MHz = None
+        self.shifted = {}  # number of points: buffer for the x-axis shifted to the HeNe peak
+
+    def calibrate(self, scale, one_HeNe_FSR, cal_scale, cal_points, len_waveform):
+        """Calibrates the x-axis/peak separation assuming a 300 MHz FSR using two HeNe peaks.
+        Use scan generator offset only to change number of HeNe peaks.
+        Changing frequency or amplitude will change calibration and cause improper locking.
+        The calibration is rescaled to the number of points the oscilloscope returns (cal_points at calibration,
+        3000 if unknown), so it stays correct when the scale makes the oscilloscope return a different number of points.
+        """
+        key = (scale, one_HeNe_FSR, cal_scale, cal_points, len_waveform)
+        if key == self.key:
+            return self.in_MHz, self.in_nm
+        self.in_MHz, self.in_nm = calibration_factors(scale, one_HeNe_FSR, cal_scale, cal_points, len_waveform)
+        self.key = key
+        return self.in_MHz, self.in_nm
+
+    def x_axis_points(self, in_MHz, points):
+        """in_MHz * np.arange(points), made once per calibration and number of points. Read only"""
+        if in_MHz != self.x_axis_in_MHz:
+            self.x_axis.clear()
+            self.x_axis_in_MHz = in_MHz
+        if points not in self.x_axis:
+            self.x_axis[points] = in_MHz * np.arange(points)
+            self.x_axis[points].flags.writeable = False
+        return self.x_axis[points]
+
+    def shift(self, x_axis_points, offset):
+        """x_axis_points - offset, written into a buffer kept for that number of points (the lines are updated every frame)"""
+        points = len(x_axis_points)
+        if points not in self.shifted:
+            self.shifted[points] = np.empty(points)
+        return np.subtract(x_axis_points, offset, out=self.shifted[points])
+
+    def cal_hene(self, in_MHz, ax, peaks_loc, trigger_data, hene_peak, len_waveform):
+        """Calibrates x-axis into nm and changes offset of axis in order to set HeNe peak at 632 nm.
+        Turns on axis labels if calibration is completed."""
+        if in_MHz is not None and hene_peak is not None:
+            ax.xaxis.set_visible(True)  # Turns on x-axis
+            peaks_loc_cal = (peaks_loc * in_MHz)  # Converts peak location into MHz
+            hene_peak_cal = hene_peak * in_MHz
+            HeNeError = (hene_peak_cal - 0)
+            x_axis_points = self.shift(self.x_axis_points(in_MHz, len_waveform), HeNeError)  # calibrated x-axis points
+            if len(trigger_data) == len_waveform:
+                x_axis_points_trig = x_axis_points  # trigger has the same time axis
+            else:
+                x_axis_points_trig = self.shift(self.x_axis_points(in_MHz, len(trigger_data)), HeNeError)
+            peaks_loc_cal = peaks_loc_cal - HeNeError
+            hene_peak_cal = hene_peak_cal - HeNeError
+        else:
+            peaks_loc_cal = peaks_loc
+            x_axis_points = self.x_axis_points(1, len_waveform)
+            x_axis_points_trig = self.x_axis_points(1, len(trigger_data))
+            hene_peak_cal = hene_peak
+            ax.xaxis.set_visible(False)
+
+        return x_axis_points, peaks_loc_cal, x_axis_points_trig, hene_peak_cal
@@ -0,0 +1,55 @@
+from collections import namedtuple
+
+import numpy as np
+
+'''Smooth analog output trajectories for the lock voltage (main.py --ramp). Instead of jumping to a new correction, the
+DAQ plays a raised cosine from the voltage reached to the new target as a hardware timed scan (DAQ_control.daq_ramp),
+so no sample timing is left to Python. A new target replaces the ramp running, starting from where it got to.'''
+
+RAMP_RATE = 1000.  # Hz, samples per sec per channel of the output scan
+MAX_RAMP_POINTS = 4000  # samples per channel, longer ramps are played at a lower rate
+
+# ramp of one channel: from start (V) at start_time (sec, perf_counter) to target, over duration sec
+Segment = namedtuple("Segment", ["start_time", "start", "target", "duration"])
+
+
+class RampPlanner:
+    """Output trajectory of every analog output channel written so far"""
+
+    def __init__(self):
+        self.segments = {}  # output channel: Segment
+
+    def value(self, channel, now):
+        """Voltage of channel at time now (a number or an array of times). 0 V if never written"""
+        if channel not in self.segments:
+            return 0. * now
+        start_time, start, target, duration = self.segments[channel]
+        if duration <= 0:
+            return target + 0. * now
+        x = np.clip((now - start_time) / duration, 0., 1.)
+        return start + (target - start) * (1 - np.cos(np.pi * x)) / 2  # zero slope at both ends
+
+    def ramp(self, channel, target, duration, now):
+        """Replaces the trajectory of channel by a ramp from its voltage now to target"""
+        self.segments[channel] = Segment(now, self.value(channel, now), target, duration)
+
+    def step(self, channel, value, now):
+        self.segments[channel] = Segment(now, value, value, 0.)
+
+    def ramping(self, now):
+        """Channels whose ramp hasn't finished"""
+        return [channel for channel, segment in self.segments.items()
+                if segment.duration > 0 and now < segment.start_time + segment.duration]
+
+    def samples(self, now, rate=RAMP_RATE):
+        """Scan of every channel from the lowest to the highest written (a contiguous range, as the DAQ scans), from now
+        until the last ramp ends. Returns (low channel, high channel, rate, samples (points x channels))"""
+        channels = range(min(self.segments), max(self.segments) + 1)
+        end = max(segment.start_time + segment.duration for segment in self.segments.values())
+        points = max(2, int(np.ceil((end - now) * rate)) + 1)  # the last sample is the target
+        if points > MAX_RAMP_POINTS:
+            rate = rate * (MAX_RAMP_POINTS - 1) / (points - 1)
+            points = MAX_RAMP_POINTS
+        times = now + np.arange(points) / rate
+        samples = np.column_stack([self.value(channel, times) for channel in channels])
+        return channels[0], channels[-1], rate, samples
@@ -0,0 +1,141 @@
+import glob
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from controls import TRACE_SCALE
+
+'''Records what the lock loop saw (main.py --record DIR) and reads it back (main.py/benchmark.py --replay DIR).
+Frames are stored in chunk files of preallocated, memory-mapped numpy records (chunk_000000.npy, ...).
+Only the newest max_chunks files are kept, so disk use is bounded.'''
+
+MAX_PEAKS = 2  # peaks_loc from get_trace (first two peaks)
+
+
+def record_dtype(max_points):
+    return np.dtype([('valid', '?'), ('time', 'f8'), ('length', 'i4'), ('trigger_length', 'i4'),
+                     ('waveform', 'f4', (max_points,)), ('trigger', 'f4', (max_points,)), ('num_peaks', 'i4'),
+                     ('peaks', 'i4', (MAX_PEAKS,)), ('separation', 'f8'), ('uncal_sep', 'f8'), ('correction', 'f8'),
+                     ('voltage_out', '?')])
+
+
+class TraceRecorder:
+    """Appends frames from the acquisition thread to chunk files. record() only queues the frame, a separate thread
+    writes it, so the lock loop is never held up by the disk. Frames are dropped (and counted) if the writer falls behind."""
+
+    def __init__(self, directory, chunk_frames=1000, max_chunks=20, max_points=6000, queue_size=100):
+        self.directory = directory
+        self.chunk_frames = chunk_frames  # frames per file. 1000 frames of 6000 points is ~48 MB
+        self.max_chunks = max_chunks
+        self.dtype = record_dtype(max_points)
+        self.max_points = max_points
+        os.makedirs(directory, exist_ok=True)
+        existing = chunk_files(directory)
+        self.chunk_index = int(os.path.basename(existing[-1])[6:12]) + 1 if existing else 0
+        self.chunk = None
+        self.row = 0
+        self.recorded = 0
+        self.dropped = 0
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.write_loop, name="recorder", daemon=True)
+        self.thread.start()
+
+    def record(self, frame):
+        """Queues an acquisition.Frame to be written. Never blocks"""
+        try:
+            self.queue.put_nowait((time.time(), frame))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Writes the queued frames and closes the current chunk"""
+        self.queue.put(None)
+        self.thread.join()
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self.write(*item)
+        if self.chunk is not None:
+            self.chunk.flush()
+            self.chunk = None
+
+    def write(self, timestamp, frame):
+        if self.chunk is None or self.row == self.chunk_frames:
+            self.new_chunk()
+        record = self.chunk[self.row]
+        length = min(len(frame.waveform), self.max_points)
+        trigger_length = min(len(frame.trigger_data), self.max_points)
+        record['time'] = timestamp
+        record['length'] = length
+        record['trigger_length'] = trigger_length
+        record['waveform'][:length] = frame.waveform[:length]
+        record['trigger'][:trigger_length] = frame.trigger_data[:trigger_length]
+        record['num_peaks'] = frame.num_peaks
+        record['peaks'] = -1
+        record['peaks'][:len(frame.peaks_loc)] = frame.peaks_loc[:MAX_PEAKS]
+        record['separation'] = frame.separation
+        record['uncal_sep'] = frame.uncal_sep
+        record['correction'] = np.nan if frame.correction is None else frame.correction
+        record['voltage_out'] = frame.voltage_out
+        record['valid'] = True  # last, so a frame cut off by a crash is skipped by the reader
+        self.row += 1
+        self.recorded += 1
+
+    def new_chunk(self):
+        """Starts the next chunk file (preallocated) and deletes the oldest beyond max_chunks"""
+        if self.chunk is not None:
+            self.chunk.flush()
+        path = os.path.join(self.directory, f"chunk_{self.chunk_index:06d}.npy")
+        self.chunk = np.lib.format.open_memmap(path, mode='w+', dtype=self.dtype, shape=(self.chunk_frames,))
+        self.chunk_index += 1
+        self.row = 0
+        for old in chunk_files(self.directory)[:-self.max_chunks]:
+            os.remove(old)
+
+
+def chunk_files(directory):
+    return sorted(glob.glob(os.path.join(directory, "chunk_[0-9][0-9][0-9][0-9][0-9][0-9].npy")))
+
+
+class TraceReader:
+    """Reads a recording, oldest frame first. Files are memory mapped, so only the frames used are read from disk.
+    reader[i] is a record (fields as in record_dtype), reader.waveforms() gives the raw traces for the simulated
+    oscilloscope so a recording can be run back through get_trace and the lock code."""
+
+    def __init__(self, directory):
+        self.chunks = [np.load(path, mmap_mode='r') for path in chunk_files(directory)]
+        self.index = [(chunk, row) for chunk, data in enumerate(self.chunks) for row in np.flatnonzero(data['valid'])]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        chunk, row = self.index[i]
+        return self.chunks[chunk][row]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def waveforms(self):
+        return RecordedWaveforms(self)
+
+
+class RecordedWaveforms:
+    """Sequence of the recorded channel 1 traces, in oscilloscope units (as returned by controls.read_channel)"""
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    def __len__(self):
+        return len(self.reader)
+
+    def __getitem__(self, i):
+        record = self.reader[i]
+        return np.asarray(record['waveform'][:record['length']], dtype=float) / TRACE_SCALE
@@ -0,0 +1,48 @@
+import threading
+
+import numpy as np
+
+
+class RingBuffer:
+    """Fixed size history of values (e.g. correction voltages). Memory is allocated once.
+    Every value is stored twice, at i and i + capacity, so the newest values are always one contiguous slice:
+    push() never allocates and view() never copies."""
+
+    def __init__(self, capacity, dtype=float):
+        self.capacity = capacity
+        self._data = np.zeros(2 * capacity, dtype=dtype)
+        self._next = 0  # index the next value is written to, 0 to capacity - 1
+        self._count = 0
+        self._lock = threading.Lock()  # pushed from the acquisition thread (lock corrections) and the GUI (manual voltage)
+
+    def __len__(self):
+        return self._count
+
+    def push(self, value):
+        """Adds value, overwriting the oldest value once the buffer is full"""
+        with self._lock:
+            self._data[self._next] = value
+            self._data[self._next + self.capacity] = value
+            self._next = (self._next + 1) % self.capacity
+            if self._count < self.capacity:
+                self._count += 1
+
+    def last(self):
+        """Most recent value. Raises IndexError if the buffer is empty"""
+        if self._count == 0:
+            raise IndexError("RingBuffer is empty")
+        return self._data[self._next - 1]  # index -1 is the copy of the value at capacity - 1
+
+    def view(self, length=None):
+        """Read only view of the newest length values (all values if None), oldest first"""
+        with self._lock:
+            length = self._count if length is None else min(length, self._count)
+            end = self._next + self.capacity
+            values = self._data[end - length:end]
+        values.flags.writeable = False
+        return values
+
+    def clear(self):
+        with self._lock:
+            self._next = 0
+            self._count = 0
@@ -0,0 +1,68 @@
+from collections import deque
+from time import monotonic
+
+MIN_PERIOD = 0.05  # sec. Shortest voltage response rate accepted by the GUI. In practice the rate is limited by the osc frame rate
+LOG_INTERVAL = 10  # sec between missed deadline reports
+
+
+class ControlScheduler:
+    """Decides when the lock writes a new voltage. Deadlines are on a fixed grid (start + n * period), so the average
+    rate is the response rate and doesn't drift with the loop speed or with anything that blocks the loop.
+    The check is made for every new frame, so the voltage written is always from the newest measurement.
+    A deadline is missed if a whole period passes without a write (e.g. period shorter than the osc frame time).
+    Missed deadlines are counted and printed every LOG_INTERVAL sec, the achieved rate is kept in achieved_rate (Hz)."""
+
+    def __init__(self, period=1.5, rate_window=10):
+        self.period = period
+        self.deadline = None  # time of the next write. None writes on the next frame and starts a new grid
+        self.times = deque(maxlen=rate_window)  # times of the last writes, for the achieved rate
+        self.achieved_rate = 0.  # Hz
+        self.missed = 0  # missed deadlines since the start
+        self.max_lateness = 0.  # sec, worst since the last report
+        self.missed_since_report = 0
+        self.last_report = monotonic()
+
+    def set_period(self, period):
+        """Changes the period (sec). The next deadline moves with it. 0 writes every frame"""
+        period = float(period)
+        if period != self.period:
+            if self.deadline is not None:
+                self.deadline += period - self.period
+            self.period = period
+
+    def due(self, now=None):
+        """True if a voltage should be written now"""
+        now = monotonic() if now is None else now
+        return self.deadline is None or now >= self.deadline
+
+    def actuated(self, now=None):
+        """Call after writing a voltage. Moves to the next deadline after now, counting any whole periods skipped"""
+        now = monotonic() if now is None else now
+        if self.deadline is None:
+            self.deadline = now
+            self.times.clear()
+        lateness = now - self.deadline
+        skipped = int(lateness // self.period) if self.period > 0 else 0  # deadlines that passed without a write
+        if skipped > 0:
+            self.missed += skipped
+            self.missed_since_report += skipped
+            self.max_lateness = max(self.max_lateness, lateness)
+        self.deadline += (skipped + 1) * self.period
+        self.times.append(now)
+        if len(self.times) > 1:
+            self.achieved_rate = (len(self.times) - 1) / (self.times[-1] - self.times[0])
+        self.report(now)
+
+    def reset(self):
+        """Call when not locked. Deadlines aren't counted until the next write, which happens straight away"""
+        self.deadline = None
+        self.achieved_rate = 0.
+
+    def report(self, now):
+        if self.missed_since_report and now - self.last_report >= LOG_INTERVAL:
+            print(f"Voltage response: {self.missed_since_report} deadlines missed in the last {now - self.last_report:.0f} s "
+                  f"(period {self.period:.2f} s, achieved {self.achieved_rate:.2f} Hz, up to {self.max_lateness:.2f} s late)")
+            self.missed_since_report = 0
+            self.max_lateness = 0.
+        if now - self.last_report >= LOG_INTERVAL:
+            self.last_report = now
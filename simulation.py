@@ -0,0 +1,241 @@
+import os
+import time
+
+import numpy as np
+
+from ramp import RampPlanner
+
+'''Simulated oscilloscope and DAQ, used instead of the hardware in osc_connection.py/DAQ_control.py (main.py --backend simulated).
+Lets the whole lock loop run and be timed without the lab.'''
+
+
+class SimulatedDAQ:
+    """Stands in for DAQ_control.DAQ. Records every analog (a_out), ramp (a_out_scan, with the target) and digital
+    (d_out) output as (time, name, channel, value). Ramps are followed in time, as the DAQ would play them.
+    Analog writes of the voltage already output are skipped, as by the DAQ driver"""
+
+    def __init__(self):
+        self.calls = []
+        self.ramps = RampPlanner()
+        self.port_value = 0x00  # last digital output. 0xFF is mirror up
+        self.skipped = 0  # writes skipped as the output already had the value
+
+    @property
+    def voltages(self):
+        """Analog output of each channel now"""
+        now = time.perf_counter()
+        return {channel: float(self.ramps.value(channel, now)) for channel in self.ramps.segments}
+
+    @property
+    def voltage(self):
+        return self.voltages.get(0, 0.)  # analog output on channel 0
+
+    def DAQconnect(self):
+        print("Simulated DAQ connected")
+
+    def daq_output(self, correction, output_channel=0):
+        now = time.perf_counter()
+        if output_channel in self.ramps.segments and output_channel not in self.ramps.ramping(now) and \
+                self.ramps.value(output_channel, now) == correction:
+            self.skipped += 1  # as DAQ_control.DAQ, the output already has the value
+            return
+        self.ramps.step(output_channel, correction, now)
+        self.calls.append((now, "a_out", output_channel, correction))
+
+    def daq_ramp(self, target, output_channel=0, duration=0.1):
+        self.ramps.ramp(output_channel, target, duration, time.perf_counter())
+        self.calls.append((time.perf_counter(), "a_out_scan", output_channel, target))
+
+    def board_name(self):
+        return "Simulated DAQ"
+
+    def daq_mirror_flipper_on(self):
+        self.port_value = 0xFF
+        self.calls.append((time.perf_counter(), "d_out", 0, self.port_value))
+
+    def daq_mirror_flipper_off(self):
+        self.port_value = 0x00
+        self.calls.append((time.perf_counter(), "d_out", 0, self.port_value))
+
+    def daq_disconnect(self):
+        self.daq_output(0)
+
+
+class SimulatedOscilloscope:
+    """Stands in for the RsInstrument connection. Answers the SCPI commands used by controls.py and osc_connection.py.
+    CHANnel1 is a Fabry-Perot transmission trace: Lorentzian dips from the HeNe and the laser (repeating every FSR),
+    with noise and a random walk drift of the cavity and the laser. The laser dip moves with the simulated DAQ voltage,
+    and is hidden when the DAQ flips the mirror up, so locking and peak identification both work.
+    extra_lasers are the offsets (MHz) of more lasers, tuned by DAQ channels 1, 2, ... (multi laser locking).
+    The screen shows one HeNe FSR at a time scale of fsr_scale, dips are placed relative to the left of the screen
+    (TIMebase:POSition is accepted but doesn't move the dips).
+    If traces are given (e.g. from load_traces) they are replayed in a loop instead."""
+
+    def __init__(self, daq=None, points=3000, laser_offset=100., mhz_per_volt=1000., fsr_scale=0.004, linewidth=3.,
+                 depth=0.2, noise=0.005, cavity_drift=0.5, laser_drift=0.5, frame_rate=3., rapid_frame_rate=20.,
+                 transfer_rate=1e6, realtime=True, traces=None, seed=None, extra_lasers=()):
+        self.daq = daq  # SimulatedDAQ driving the laser and the mirror
+        self.points = points  # points per waveform (600/3000/6000). Rapid data (MWAVeform) gives points // 5, DATA:POINts MAXimum twice as many
+        self.laser_offset = laser_offset  # MHz, laser dip from the HeNe dip at 0 V
+        self.extra_lasers = list(extra_lasers)  # MHz, more laser dips at 0 V on their channel (1, 2, ...)
+        self.mhz_per_volt = mhz_per_volt  # laser tuning, MHz per DAQ volt
+        self.fsr_scale = fsr_scale  # time scale (s/div) at which the screen is exactly one 300 MHz HeNe FSR
+        self.linewidth = linewidth  # MHz, FWHM of the dips
+        self.depth = depth  # V
+        self.noise = noise  # V, before averaging
+        self.cavity_drift = cavity_drift  # MHz per frame, random walk of the cavity (moves all dips)
+        self.laser_drift = laser_drift  # MHz per frame, random walk of the laser frequency
+        self.frame_rate = frame_rate  # frames/s with ACQuire:WRATe AUTO
+        self.rapid_frame_rate = rapid_frame_rate  # frames/s with ACQuire:WRATe MWAVeform
+        self.transfer_rate = transfer_rate  # bytes/s for data queries
+        self.realtime = realtime  # sleep to mimic the scope. False runs as fast as possible
+        self.traces = traces
+        self.rng = np.random.default_rng(seed)
+        self.data_format = "ASCii"
+        self.scale = 0.002
+        self.pos = 0.08
+        self.channel_scale = {1: 0.05, 2: 10.}
+        self.rapid = False
+        self.max_points = False  # CHANnel1:DATA:POINts MAXimum/DMAXimum
+        self.average_count = 2
+        self.frame_count = 0
+        self.cavity_position = 0.  # MHz
+        self.laser_position = 0.  # MHz
+        self.last_frame_time = time.perf_counter()
+        self.waveform = None
+        self.trigger = None
+        self.writes = []
+        self.driver_version = "simulated"
+        self.visa_manufacturer = "simulated"
+        self.full_instrument_model_name = "Simulated RTB2000"
+        self.instrument_options = []
+
+    # SCPI
+    def write(self, command):
+        self.writes.append(command)
+        name, _, value = command.partition(" ")
+        name = name.upper()
+        if name == "FORM" or name.startswith("FORMAT:DATA"):
+            self.data_format = value.strip()
+        elif name == "TIMEBASE:SCALE":
+            self.scale = float(value)
+        elif name == "TIMEBASE:POSITION":
+            self.pos = float(value)
+        elif name.startswith("CHANNEL") and name.endswith(":SCALE"):
+            self.channel_scale[int(name[7])] = float(value)
+        elif name == "ACQUIRE:WRATE":
+            self.rapid = value.strip().upper().startswith("MWAV")
+        elif name == "CHANNEL1:DATA:POINTS":
+            self.max_points = value.strip().upper().startswith(("MAX", "DMAX"))
+        elif name == "ACQUIRE:AVERAGE:COUNT":
+            self.average_count = int(value)
+
+    def query(self, command):
+        return self.query_str(command)
+
+    def query_str(self, command):
+        name = command.split(" ")[0].upper()
+        if name == "*IDN?":
+            return "Rohde&Schwarz,RTB2004,simulated,1.0"
+        if name == "TIMEBASE:RATIME?":
+            return str(self.scale * 12)
+        if name.endswith(":DATA:YORIGIN?"):
+            return "0"
+        if name.endswith(":DATA:YINCREMENT?"):
+            return str(self.y_increment(int(name[7])))
+        if name.endswith(":DATA?"):
+            return ",".join(f"{value:.4E}" for value in self.channel_data(int(name[7])))
+        return "0"
+
+    def query_bin_block(self, command):
+        data = self.channel_data(int(command.upper()[7]))
+        if self.data_format == "REAL,32":
+            return data.astype('<f4').tobytes()
+        if self.data_format == "INT,16":
+            return np.round(data / self.y_increment(int(command[7]))).astype('<i2').tobytes()
+        if self.data_format == "INT,8":
+            return np.round(data / self.y_increment(int(command[7]))).clip(-128, 127).astype('i1').tobytes()
+        raise ValueError(f"query_bin_block with FORM {self.data_format}")
+
+    def close(self):
+        pass
+
+    # waveforms
+    def y_increment(self, channel):
+        """Volts per ADC step, 10 vertical divisions over the range of the integer format"""
+        bits = 8 if self.data_format == "INT,8" else 16
+        return 10 * self.channel_scale[channel] / 2 ** bits
+
+    def channel_data(self, channel):
+        """CHANnel1 starts a new frame (waits for it if realtime), CHANnel2 returns the trigger of the same frame"""
+        if channel == 1 or self.waveform is None:
+            self.new_frame()
+        data = self.waveform if channel == 1 else self.trigger
+        if self.realtime:
+            time.sleep(len(data) * (4 if self.data_format != "ASCii" else 12) / self.transfer_rate)
+        return data
+
+    def new_frame(self):
+        if self.realtime:
+            frame_time = 1 / (self.rapid_frame_rate if self.rapid else self.frame_rate)
+            wait = self.last_frame_time + frame_time - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        self.last_frame_time = time.perf_counter()
+        self.frame_count += 1
+        if self.traces is not None:
+            self.waveform = self.traces[self.frame_count % len(self.traces)]
+        else:
+            self.waveform = self.fabry_perot_trace()
+        points = len(self.waveform)
+        self.trigger = np.where(np.arange(points) < points // 2, 2.5, 0.)  # scan generator trigger, high for the first half
+
+    def fabry_perot_trace(self):
+        points = self.points * (2 if self.max_points else 1) // (5 if self.rapid else 1)
+        span = 300 * self.scale / self.fsr_scale  # MHz across the screen
+        self.cavity_position += self.rng.normal(0, self.cavity_drift)
+        self.laser_position += self.rng.normal(0, self.laser_drift)
+        frequency = np.arange(points) * span / points - 0.1 * span - self.cavity_position  # MHz from the HeNe dip
+        dips = [0.]
+        mirror_up = self.daq is not None and self.daq.port_value != 0
+        if not mirror_up:
+            for channel, offset in enumerate([self.laser_offset] + self.extra_lasers):
+                voltage = self.daq.voltages.get(channel, 0.) if self.daq is not None else 0.
+                dips.append((offset + self.laser_position + voltage * self.mhz_per_volt) % 300)
+        trace = np.zeros(points)
+        half_width = self.linewidth / 2
+        for dip in dips:
+            for fsr in range(int(np.floor(frequency[0] / 300)) - 1, int(np.ceil(frequency[-1] / 300)) + 1):
+                trace -= self.depth / (1 + ((frequency - dip - 300 * fsr) / half_width) ** 2)
+        trace += self.rng.normal(0, self.noise / np.sqrt(self.average_count), points)
+        return trace
+
+
+def load_trace_file(fname):
+    """Reads a waveform exported from the oscilloscope (e.g. C_test_TraceFile.CSV, one 'value;' per line after the header)"""
+    with open(fname, 'r') as trace_file:
+        next(trace_file)  # header
+        values = [float(line.split(";")[0]) for line in trace_file if line.strip()]
+    return [np.array(values)]
+
+
+def load_traces(path):
+    """Traces to replay from an oscilloscope trace file or a recording directory (recorder.py)"""
+    if os.path.isdir(path):
+        from recorder import TraceReader
+        traces = TraceReader(path).waveforms()
+        if len(traces) == 0:
+            raise ValueError(f"No recorded frames in {path}")
+        return traces
+    return load_trace_file(path)
+
+
+def simulated_backends(points=3000, trace_file=None, realtime=True, **options):
+    """Returns a connected simulated oscilloscope and DAQ, set up the same way as osc_connection.connect"""
+    from controls import set_data_format
+    daq = SimulatedDAQ()
+    traces = load_traces(trace_file) if trace_file is not None else None
+    instr = SimulatedOscilloscope(daq, points=points, realtime=realtime, traces=traces, **options)
+    set_data_format(instr, "REAL,32")
+    daq.DAQconnect()
+    return instr, daq
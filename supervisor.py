@@ -0,0 +1,215 @@
+import threading
+from collections import OrderedDict
+from time import monotonic, perf_counter, sleep
+
+from ramp import RampPlanner
+
+'''Connection supervision of the oscilloscope and the DAQ (main.py). A failed call marks the connection as lost and a
+background thread reconnects with exponential backoff, then puts the instrument back in the state the program left it
+in (acquisition settings, pos/scale, acquisition profile, DAQ voltages and ramps, mirror). Calls made while the
+connection is down raise ConnectionLost instead of waiting for it (at most for the reconnection attempt in progress),
+the acquisition thread skips frames until it is back.
+The GUI/daemon state (calibration, identified peaks, HeNe peak) is not touched, so locking carries on after a blip.'''
+
+SCOPE_TIMEOUT = 3.  # sec, VISA timeout of every oscilloscope query
+HEALTH_INTERVAL = 5.  # sec without any call before the connection is checked
+FIRST_RETRY = 0.5  # sec before the first reconnection attempt, doubled after every failed attempt
+MAX_RETRY = 30.  # sec, longest wait between attempts
+
+
+class ConnectionLost(RuntimeError):
+    """The instrument connection failed, or is being re-established"""
+
+
+class Supervised:
+    """Wraps an instrument connection made by connect() (called once here, errors are raised to the caller).
+    Method calls are passed on one at a time. The first call that raises marks the connection as lost, starts the
+    reconnection thread and raises ConnectionLost (with the original error as the cause). Subclasses give the health
+    check and what is re-applied after reconnecting (restore)."""
+
+    name = "instrument"
+
+    def __init__(self, connect, health_interval=HEALTH_INTERVAL):
+        self._connect = connect
+        self._lock = threading.RLock()  # the connection isn't thread safe, and is replaced by the reconnection thread
+        self._target = self.open()
+        self.connected = True
+        self.outages = 0  # connections lost so far
+        self.last_error = None
+        self.last_call = monotonic()
+        self.health_interval = health_interval
+        self.running = True
+        threading.Thread(target=self.health_loop, name=f"{self.name} health", daemon=True).start()
+
+    def open(self):
+        return self._connect()
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)  # not set up yet (during __init__)
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def supervised(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+
+        return supervised
+
+    def call(self, name, *args, **kwargs):
+        with self._lock:
+            if not self.connected:
+                raise ConnectionLost(f"{self.name} reconnecting") from self.last_error
+            try:
+                result = getattr(self._target, name)(*args, **kwargs)
+            except ConnectionLost:
+                raise
+            except Exception as error:
+                self.lost(error)
+                raise ConnectionLost(f"{self.name} connection lost: {error}") from error
+            self.last_call = monotonic()
+            self.remember(name, args, kwargs)
+            return result
+
+    def lost(self, error):
+        """Marks the connection as lost and starts reconnecting (once)"""
+        with self._lock:
+            if not self.connected:
+                return
+            self.connected = False
+            self.outages += 1
+            self.last_error = error
+        print(f"{self.name} connection lost ({error}), reconnecting")
+        threading.Thread(target=self.reconnect, name=f"{self.name} reconnect", daemon=True).start()
+
+    def reconnect(self):
+        wait = FIRST_RETRY
+        start = monotonic()
+        while self.running:
+            sleep(wait)
+            with self._lock:
+                try:
+                    self.close_target()
+                    self._target = self.open()
+                    self.restore()
+                except Exception as error:
+                    self.last_error = error
+                    wait = min(2 * wait, MAX_RETRY)
+                    print(f"{self.name} reconnection failed ({error}), next attempt in {wait:.1f} s")
+                    continue
+                self.connected = True
+                self.last_call = monotonic()
+            print(f"{self.name} reconnected after {monotonic() - start:.1f} s")
+            return
+
+    def health_loop(self):
+        """Checks an idle connection every health_interval sec (calls of the lock loop are checks in themselves)"""
+        while self.running:
+            sleep(self.health_interval)
+            if self.connected and monotonic() - self.last_call > self.health_interval:
+                try:
+                    with self._lock:
+                        self.check()
+                        self.last_call = monotonic()
+                except Exception as error:
+                    self.lost(error)
+
+    def close_target(self):
+        try:
+            self._target.close()
+        except Exception:
+            pass  # the old connection is usually already broken
+
+    def close(self):
+        self.running = False
+        with self._lock:
+            self._target.close()
+
+    def remember(self, name, args, kwargs):
+        """Keeps what restore() needs from a successful call"""
+
+    def restore(self):
+        """Puts the new connection in the state of the old one"""
+
+    def check(self):
+        """Raises if the connection doesn't work"""
+
+
+class SupervisedScope(Supervised):
+    """Oscilloscope (RsInstrument or simulated). Every query times out after timeout sec. The last value of every setting
+    written (SCPI header, e.g. TIMebase:SCAle) is replayed after connect() has set up the acquisition again."""
+
+    name = "Oscilloscope"
+
+    def __init__(self, connect, timeout=SCOPE_TIMEOUT, **options):
+        self.timeout = timeout
+        self.settings = OrderedDict()  # SCPI header: last command written, most recent last
+        super().__init__(connect, **options)
+
+    def open(self):
+        instr = self._connect()
+        instr.visa_timeout = int(self.timeout * 1000)  # ms. RsInstrument raises a timeout exception instead of waiting
+        return instr
+
+    def remember(self, name, args, kwargs):
+        if name == "write":
+            header = args[0].split(" ")[0].upper()
+            self.settings.pop(header, None)
+            self.settings[header] = args[0]
+
+    def restore(self):
+        for command in self.settings.values():
+            self._target.write(command)
+
+    def check(self):
+        self._target.query_str("*OPC?")
+
+
+class SupervisedDAQ(Supervised):
+    """MCC DAQ (DAQ_control.DAQ or simulated). connect() returns the connected DAQ. After reconnecting every output
+    channel is set to the voltage it should have now, ramps (daq_ramp) that hadn't finished are played again for the
+    time they had left (the output scan stops with the connection), and the mirror is moved back."""
+
+    name = "DAQ"
+
+    def __init__(self, connect, **options):
+        self.ramps = RampPlanner()  # trajectory of every output channel written, as the DAQ plays it
+        self.mirror = None  # last flipper call (daq_mirror_flipper_on/off)
+        super().__init__(connect, **options)
+
+    def open(self):
+        daq = self._connect()
+        if getattr(daq, "output_range", True) is None:  # DAQconnect prints the error and leaves the range unset
+            raise ConnectionError("DAQ not found")
+        return daq
+
+    def remember(self, name, args, kwargs):
+        if name in ("daq_output", "daq_ramp"):
+            channel = kwargs.get("output_channel", args[1] if len(args) > 1 else 0)
+            if name == "daq_ramp":
+                duration = kwargs.get("duration", args[2] if len(args) > 2 else 0.1)  # default of DAQ.daq_ramp
+                self.ramps.ramp(channel, args[0], duration, perf_counter())
+            else:
+                self.ramps.step(channel, args[0], perf_counter())
+        elif name in ("daq_mirror_flipper_on", "daq_mirror_flipper_off"):
+            self.mirror = name
+
+    def restore(self):
+        now = perf_counter()
+        for channel in self.ramps.segments:
+            self._target.daq_output(float(self.ramps.value(channel, now)), channel)  # where the output should be now
+        for channel in self.ramps.ramping(now):
+            start_time, start, target, duration = self.ramps.segments[channel]
+            self._target.daq_ramp(target, channel, start_time + duration - now)  # the rest of the ramp
+        if self.mirror is not None:
+            getattr(self._target, self.mirror)()
+
+    def check(self):
+        # a real board access. Unchanged outputs aren't written, so an unlocked loop holding 0 V makes no USB calls
+        self._target.board_name()
+
+    def close_target(self):
+        pass  # the DAQ is released by daq_disconnect on exit only
+
+    def close(self):
+        self.running = False
@@ -1,14 +1,18 @@
 import PySimpleGUI as sg
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
-from controls import Signal, status_indicator, osc_update
-import csv
+import controls
+import metrics
+from controls import Signal, status_indicator, osc_update, laser_gains, laser_channel
 from collections import OrderedDict
-from flipper_raspi import FlipperControl, PeakIdentification
+from flipper_raspi import flipper
 from base64 import b64encode
-import numpy as np
-from matplotlib.ticker import FormatStrFormatter
-from DAQ_control import DAQ
+from lock_loop import LockLoop
+from plots import WaveformPlot, ErrorPlot, OSCCalibration, ERROR_GRAPH_POINTS
+from scheduler import MIN_PERIOD
+from lock_statistics import summary_text
+from laser_store import LaserStore
+from acquisition_profiles import PROFILES, apply_profile, tune_profiles, print_measurements, laser_profile
 
 
 # from time import sleep
@@ -17,67 +21,79 @@ from DAQ_control import DAQ
 ##########################################
 # GUI MAIN
 
-def gui_main(instr):
-    manual_adj_V = None
-    """Main function. Does everything other than DAQ/OSC start up and shut down."""
-    fname = "laser_data.csv"  # File containing laser data. (Laser Name, Desired Offset, Default Position, Default Scale, Voltage Corresponding to 1 MHz Change, Voltage Response Rate (sec))
-    dict_laser_info = laser_settings(
-        fname)  # Laser settings converts the CSV information into a dictionary, with the laser names as keys
+def gui_main(instr, daq, recorder=None):
+    """Main function. Does everything other than DAQ/OSC start up and shut down. instr and daq are the connected oscilloscope and DAQ (hardware or simulated)"""
+    flipper.daq = daq
+    fname = "laser_data.csv"  # File containing laser data. (Laser Name, Desired Offset, Default Position, Default Scale, Voltage Corresponding to 1 MHz Change, Voltage Response Rate (sec), Lock Gains kp, ki, kd (optional), DAQ Output Channel (optional), Acquisition Profile (optional))
+    store = LaserStore(fname)  # laser settings in memory, written to the CSV file in the background after changes
+    dict_laser_info = store.lasers  # dictionary of the laser settings, with the laser names as keys
     fig_agg, ax, window, canvas, fig_agg_error, ax_error = GUIStartUP(
         dict_laser_info).gui_open_window()  # Opens the GUI window
-    laser_name, pos, scale, default_pos, default_scale, dict_laser_info, locking, change_pos, continue_lock, peaks_identified, stage, prev_peaks, mirror_up, loc_mirror, show_trig_sig, laser_lock_status, one_HeNe_FSR, stage, peaks_identified, hene_peak, ident_peaks, mirror_error, in_MHz, status_osc = GUIStartUP(
-        dict_laser_info,
-        window).initial_set_up()  # Set initial conditions for GUI and variables. Will open last used laser.
-    cal_scale = None  # Should be moved into initial conditions
-    osc_update(instr, scale, pos)  # Updates the oscilloscope pos/scale with the defaults from the last used laser
-    rapid_data = False  # Should be moved into initial conditions
-    while 1:
-        # get data from osc
-        waveform, peaks_loc, separation, pos, num_peaks, scale, laser_lock_status, lost_peaks, trigger_data, correction, voltage_out, uncal_sep, len_waveform \
-            = Signal(pos, default_pos, change_pos, locking, in_MHz, continue_lock, scale, laser_lock_status,
-                     peaks_identified, ident_peaks, default_scale, dict_laser_info,
-                     laser_name, show_trig_sig, manual_adj_V).final_data(instr,
-                                                           rapid_data,
-                                                           correction_array)  # Retrieves the data from the oscilloscope and returns peak information and locking information. Sends information to the DAQ. This is the main function working behind the scenes of the GUI
-        if not locking or change_pos or num_peaks != 2 or not status_osc:  # laser_lock_status controls whether locking occurs and a status LED. Only True when there are only two peaks, user has chosen to lock the laser, the oscilloscope is working fine and the user has disabled change pos
-            laser_lock_status = False
-        # scaling set up initial
-        in_MHz, in_nm = OSCCalibration.calibrate(scale, one_HeNe_FSR, cal_scale,
-                                                 len_waveform)  # Returns calibration factor depending on user indicated FSR of the HeNe laser, as well as the current scale. Code could be made faster by calculating the new calibration only when the osc scale or HeNe FSR is reselected, however this is very minor
-        # check lock peaks
-        no_peaks_check(lost_peaks, window)  # lost peaks is False when there are no peaks
-        # read any inputted data from window
-        event, values = window.read(timeout=15)
-        # react to events
-        pos, default_pos, default_scale, scale, status_osc, locking, change_pos, laser_name, dict_laser_info, loc_mirror, one_HeNe_FSR, show_trig_sig, ident_peaks, status_osc, cal_scale, rapid_data, manual_adj_V \
-            = GUIEvents(window, default_pos, default_scale, dict_laser_info, laser_name, change_pos, instr,
-                        fname="laser_data.csv"). \
-            check_events(event, values, pos, window, scale, status_osc, locking, loc_mirror,
-                         uncal_sep, one_HeNe_FSR, show_trig_sig, ident_peaks, peaks_identified, cal_scale,
-                         rapid_data)  # Checks for any events in the GUI and reacts according to those events
-        if hene_peak is not None:
-            ident_peaks, peaks_identified = PeakIdentification(ident_peaks, peaks_loc,
-                                                               peaks_identified).check_peaks_in_range(hene_peak,
-                                                                                                      change_pos,
-                                                                                                      waveform)  # Checks that there is a peak within an appropriate range of the previous peak. If it drifted/moved too much within one cycle, will attempt to identify peaks again by returning ident_peaks = True
-            hene_peak = peaks_loc[PeakIdentification.find_closest(hene_peak,
-                                                                  peaks_loc)]  # Keeps track of the HeNe peak by finding the peak closest to the previous HeNe peak index.
-        # update gui
-        update_gui(window, fig_agg, separation, num_peaks, status_osc, ax, laser_lock_status,
-                   waveform, peaks_loc, loc_mirror, in_nm, in_MHz, trigger_data,
-                   hene_peak, peaks_identified, stage, ax_error, correction, fig_agg_error, voltage_out, len_waveform,
-                   rapid_data, res_rate=dict_laser_info[laser_name][4])  # Updates GUI - graphs, text values, etc.
-        # peak identity
-        if ident_peaks and len(peaks_loc) >= 1:
-            peaks_identified, stage, prev_peaks, hene_peak, mirror_up, ident_peaks, loc_mirror, mirror_error = PeakIdentification(
-                ident_peaks, peaks_loc, peaks_identified).peak_identity(stage, prev_peaks, mirror_up,
-                                                                        mirror_error)  # Identifies the peaks by flipping the mirror, blocking the non-hene laser, and matches the index of the remaining peak to the closest of the two peaks after the mirror is lowered again.
-            window["-PROG-BAR-"].update(
-                current_count=stage * 18)  # Progress bar for peak identification. Stage is dependent on the portion of the peak identification process complete. 18 was chosen as it looked nice and didn't appear to be complete before it actually was (as with 20)
-        if mirror_error:  # Mirror error - True when error occurs during peak identification, e.g. more than one peak when the mirror is flipped up (possible that more than one FSR or raspberry pi not connected)
-            mirror_error_popup()
-            mirror_error = False
-        window.refresh()
+    calibration = OSCCalibration()  # cached calibration factors and x-axis arrays
+    waveform_plot = WaveformPlot(fig_agg, ax, calibration)  # plot artists are made once and then only updated
+    error_plot = ErrorPlot(fig_agg_error, ax_error)
+    view = WidgetView(window)  # widgets are only updated when their value changes
+    if metrics.enabled:
+        window.read = metrics.timed("window_read", window.read)  # time waiting for GUI events (the other stages are wrapped by metrics.install)
+    GUIStartUP(dict_laser_info, window).gui_initial_settings()  # match the GUI to the last used laser
+    # Lock state and the steps for every frame are shared with the headless daemon (lock_loop.py). The acquisition thread owns the oscilloscope and DAQ,
+    # and runs the lock (Signal.final_data) at the rate the scope returns frames. This loop only draws the newest frame and reacts to GUI events, so a slow redraw no longer delays the next correction voltage
+    loop = GUILockLoop(window, instr, daq, store, recorder=recorder, calibration=calibration, show_trig_sig=True)
+    loop.acquisition.start()
+    instr, daq = loop.instr, loop.daq  # GUI only talks to hardware through the acquisition thread
+    try:
+        frame = None
+        while frame is None:  # wait for the first frame
+            frame = loop.next_frame(timeout=0.1)
+            window.refresh()
+        while 1:
+            if frame is None and loop.acquisition.connection_lost is not None:
+                view.set_led('-LED-OSC-', 'tomato')  # scope or DAQ reconnecting (supervisor.py), no frames until it is back
+            if metrics.enabled:
+                metrics.gui_loop(loop.acquisition.dropped_frames)
+            # read any inputted data from window
+            event, values = window.read(timeout=15)
+            # react to events
+            loop.pos, loop.default_pos, loop.default_scale, loop.scale, loop.status_osc, loop.locking, loop.change_pos, loop.laser_name, loop.dict_laser_info, loop.loc_mirror, loop.one_HeNe_FSR, loop.show_trig_sig, loop.ident_peaks, loop.status_osc, loop.cal_scale, loop.cal_points, loop.rapid_data, loop.lock_lasers \
+                = GUIEvents(window, loop.default_pos, loop.default_scale, loop.dict_laser_info, loop.laser_name, loop.change_pos, instr,
+                            store=store, daq=daq, correction_history=loop.correction_history). \
+                check_events(event, values, loop.pos, window, loop.scale, loop.status_osc, loop.locking, loop.loc_mirror,
+                             loop.frame.uncal_sep, loop.one_HeNe_FSR, loop.show_trig_sig, loop.ident_peaks, loop.peaks_identified, loop.cal_scale,
+                             loop.cal_points, loop.rapid_data, loop.lock_lasers, loop.frame.len_waveform, loop.in_MHz)  # Checks for any events in the GUI and reacts according to those events
+            if frame is not None:
+                # update gui
+                update_gui(view, waveform_plot, frame.separation, frame.num_peaks, loop.status_osc, loop.laser_lock_status,
+                           frame.waveform, frame.peaks_loc, loop.loc_mirror, loop.in_nm, loop.in_MHz, frame.trigger_data,
+                           loop.hene_peak, loop.peaks_identified, loop.stage, error_plot, loop.correction_history, frame.len_waveform,
+                           loop.rapid_data, achieved_rate=controls.control_scheduler.achieved_rate,
+                           laser_locks=frame.laser_locks, expected_peaks=loop.expected_peaks)  # Updates GUI - graphs, text values, etc.
+                view.update("-PROG-BAR-",
+                            current_count=loop.stage * 25)  # Progress bar for peak identification. Stage is dependent on the portion of the peak identification process complete (stages 0-3, so never shows complete before it actually is)
+                window.refresh()
+            # hand the current GUI state to the acquisition thread for the next frame
+            loop.push_settings()
+            frame = loop.next_frame()
+    finally:
+        loop.acquisition.stop()
+        store.flush()
+
+
+class GUILockLoop(LockLoop):
+    """The shared lock loop, asking the user with popups when the peaks are lost or can't be identified"""
+
+    def __init__(self, window, *args, **kwargs):
+        self.window = window
+        super().__init__(*args, **kwargs)
+
+    def use_laser_profile(self, instr):
+        self.rapid_data = use_laser_profile(instr, self.window, self.dict_laser_info, self.laser_name, self.rapid_data)
+
+    def peaks_lost(self):
+        no_peaks_check(True, self.window)  # yes continues locking, no clicks the lock button
+
+    def identification_failed(self):
+        # more than one peak when the mirror is flipped up (possibly more than one FSR on screen or raspberry pi not connected)
+        mirror_error_popup()
 
 
 ##########################################
@@ -117,6 +133,9 @@ class GUILayout:
         # change laser button, opens a new window
         button_change_laser = sg.Button("Change Laser", key="-CHANGE-LASER-", enable_events=True,
                                         tooltip="Change Selected Laser, Add/Remove Lasers")
+        # multi laser lock button, opens a new window
+        button_multi_lock = sg.Button("Multi Laser Lock", key="-MULTI-LOCK-", enable_events=True,
+                                      tooltip="Lock several lasers at once, each on its own DAQ output channel")
         # change scaling set up button
         button_change_scale = sg.Button("Reset Scale Set Up", key="-CHANGE-SCALE-SETUP-",
                                         enable_events=True)
@@ -126,6 +145,10 @@ class GUILayout:
         # identify peaks button
         identify_peaks_button = sg.Button("Identify Peaks", key="-IDEN-PEAKS-", enable_events=True,
                                           auto_size_button=True)
+        # lock statistics button, opens a new window
+        lock_statistics_button = sg.Button("Lock Statistics", key="-LOCK-STATS-", enable_events=True,
+                                           auto_size_button=True,
+                                           tooltip="Lock error statistics, Allan deviation and spectrum of the selected laser")
         # display frame, contains graph and info text
         display_frame = sg.Frame("Display",
                                  [[sg.Canvas(size=(380, 260), key='-CANVAS-WAVEFORM-', pad=(65, 10), expand_x=True,
@@ -133,9 +156,10 @@ class GUILayout:
                                   [sg.Canvas(size=(380, 60), key='-CANVAS-ERROR-', pad=(65, 10), expand_x=True,
                                              expand_y=False)],
                                   [sg.Text(f'Peak Separation: ', key='-SEP-TEXT-')],
+                                  [sg.Text('', key='-MULTI-LOCK-TEXT-', visible=False)],
                                   [sg.Text(f'', key='-SEL-LASER-'),
-                                   sg.Text(f'Desired Offset: ', key='-OFF-TEXT-'), button_change_laser,
-                                   button_change_scale], [button_show_trigger, identify_peaks_button],
+                                   sg.Text(f'Desired Offset: ', key='-OFF-TEXT-'), button_change_laser, button_multi_lock,
+                                   button_change_scale], [button_show_trigger, identify_peaks_button, lock_statistics_button],
                                   [sg.Text('Manual Voltage Output')], [sg.Slider(range=(-5, 5), size=(60, 15),
                                                                                  orientation='h',
                                                                                  key='-SLIDER-MANUAL-V-',
@@ -147,9 +171,12 @@ class GUILayout:
                                                                                  pad=((0, 0), (0, 17)),
                                                                                  trough_color='grey90')],
                                   [sg.Button('Return to 0', key='-RETURN0-MANUALV-', size=(8, 2))],
-                                  [sg.Text('Change in voltage calibration amount')], [sg.Input(expand_x=True, expand_y=True, do_not_clear=True,
-                                                                                               key='-V-CAL-MANUAL-ADJ-',
-                                                                                               size=(6, 1))]])
+                                  [sg.Text('Lock Gains (relative to voltage for 1 MHz)')],
+                                  [sg.Text('Kp'), sg.Input(do_not_clear=True, key='-GAIN-KP-', size=(6, 1)),
+                                   sg.Text('Ki (1/s)'), sg.Input(do_not_clear=True, key='-GAIN-KI-', size=(6, 1)),
+                                   sg.Text('Kd (s)'), sg.Input(do_not_clear=True, key='-GAIN-KD-', size=(6, 1)),
+                                   sg.Button('Set Gains', key='-SET-GAINS-',
+                                             tooltip="Saves the PID gains of the selected laser")]])
         # controls
         pos_controls_row = [sg.Button('Change Default', key='-CHANGE-DEFAULT-POS-', size=(8, 2)),
                             sg.Button('Default', key='-DEFAULT-POS-', size=(8, 1)),
@@ -208,8 +235,11 @@ class GUILayout:
                                key="-V-RATE-", size=(6, 1))
         speed_input_text = sg.Text("Voltage Rate")
         speed_input_text_sec = sg.Text("(sec)")
+        achieved_rate_text = sg.Text("Achieved: N/A", key="-V-RATE-ACHIEVED-", size=(14, 1),
+                                     tooltip="Voltage writes per second while locked. Limited by the oscilloscope frame rate")
         response_speed_frame = sg.Frame(title="Voltage Response",
-                                        layout=[[speed_input_text], [speed_input, speed_input_text_sec]],
+                                        layout=[[speed_input_text], [speed_input, speed_input_text_sec],
+                                                [achieved_rate_text]],
                                         element_justification='left')
         # controls for oscilloscope acquisition mode (waveform priority (rapid) or AUTO)
         rapid_data_button = sg.Button("Rapid Data Collection", key="-RAPID-DATA-",
@@ -217,11 +247,37 @@ class GUILayout:
         averaging_frame = sg.Frame("Average Count", [[sg.Combo([2, 4, 8, 16, 32, 64, 128], default_value=2,
                                                                key="-AVG-COUNT-", readonly=True, enable_events=True,
                                                                text_color='grey14', background_color='grey90')]])
+        # measures the acquisition profiles (acquisition_profiles.py) and saves the best for the selected laser
+        tune_button = sg.Button("Tune Acquisition", key="-TUNE-ACQ-",
+                                tooltip="Measures frame rate and peak noise of each oscilloscope acquisition profile "
+                                        "and uses the best for this laser. Pauses the lock for about a minute.")
+        profile_text = sg.Text("Profile: none", key="-ACQ-PROFILE-TEXT-", size=(18, 1))
         column = sg.Column(
-            [[mirror_frame], [trigger_frame], [response_speed_frame], [averaging_frame], [rapid_data_button]],
+            [[mirror_frame], [trigger_frame], [response_speed_frame], [averaging_frame], [rapid_data_button],
+             [tune_button], [profile_text]],
             element_justification='center')
         return column
 
+    @staticmethod
+    def multi_lock_layout(dict_laser_info, lock_lasers):
+        """Defines layout for multi laser lock window. One row per laser: lock checkbox and DAQ output channel"""
+        rows = [[sg.Checkbox(name, default=bool(lock_lasers) and name in lock_lasers, key=('-MULTI-LOCK-', name),
+                             size=(12, 1)),
+                 sg.Text('DAQ Channel'), sg.Input(laser_channel(dict_laser_info, name), key=('-MULTI-CHANNEL-', name),
+                                                  size=(4, 1))] for name in dict_laser_info]
+        info = [sg.Text("Select 2 or more lasers to lock together (fewer locks only the selected laser).\n"
+                        "The error graph shows the selected laser.")]
+        buttons = [sg.Push(), sg.Button('Ok', key='-MULTI-LOCK-OK-', bind_return_key=True), sg.Button("Cancel")]
+        return [info, [sg.Frame("Lasers", rows)], buttons]
+
+    @staticmethod
+    def lock_statistics_layout():
+        """Defines layout for lock statistics window. Text is filled in (and refreshed) by GUIEvents"""
+        text = sg.Multiline("", key='-STATS-TEXT-', size=(60, 30), disabled=True, font='Courier 9')
+        buttons = [sg.Button("Reset", key='-STATS-RESET-'), sg.Button("Export", key='-STATS-EXPORT-'), sg.Push(),
+                   sg.Button("Close")]
+        return [[text], buttons]
+
     @staticmethod
     def change_laser_layout():
         """Defines layout for laser settings window"""
@@ -268,6 +324,40 @@ class GUILED:
                         pad=((0, 0), (5, 0)), key=key)
 
 
+class WidgetView:
+    """Remembers the last values given to each widget, and only sends changes to Tk. In steady lock most widgets
+    (LEDs, mirror slider, progress bar, texts) don't change, so nothing is redrawn for them."""
+
+    def __init__(self, window):
+        self.window = window
+        self.state = {}  # key: {update argument: last value}
+
+    def update(self, key, **values):
+        """window[key].update(**values), with only the values that changed since the last call"""
+        last = self.state.setdefault(key, {})
+        changed = {name: value for name, value in values.items() if name not in last or last[name] != value}
+        if changed:
+            self.window[key].update(**changed)
+            last.update(changed)
+
+    def set_led(self, key, color):
+        """GUILED.setLED, only if the colour changed"""
+        if self.state.get(key) != color:
+            GUILED(self.window).setLED(key, color)
+            self.state[key] = color
+
+    def mirror_slider(self, key, loc):
+        """draw_mirror_slider, only if the mirror position (up or down) changed"""
+        mirror_up = loc >= 1
+        if self.state.get(key) != mirror_up:
+            draw_mirror_slider(self.window[key], loc)
+            self.state[key] = mirror_up
+
+    def invalidate(self, key):
+        """Forget the state of a widget that was changed somewhere else, the next update redraws it"""
+        self.state.pop(key, None)
+
+
 # Tkinter functions for graph animation
 def draw_figure(canvas, figure):
     """Tkinter controls for drawing a figure, for animation"""
@@ -277,27 +367,10 @@ def draw_figure(canvas, figure):
     return figure_canvas_agg
 
 
-# Start up commands for GUI
 class GUIStartUP:
-    # initial conditions for variables
     def __init__(self, dict_laser_info, window=None):
         self.dict_laser_info = dict_laser_info
         self.window = window
-        self.locking = False
-        self.change_pos = False
-        self.continue_lock = False
-        self.peaks_identified = False
-        self.stage = 0
-        self.prev_peaks = None
-        self.mirror_up = True
-        self.loc_mirror = 1
-        self.show_trig_sig = True
-        self.laser_lock_status = False
-        self.one_HeNe_FSR = None
-        self.stage = 0
-        self.peaks_identified = False
-        self.hene_peak = None
-        self.ident_peaks = False  # identify the peaks
 
     def gui_open_window(self):
         """"Opens the GUI window"""
@@ -330,21 +403,6 @@ class GUIStartUP:
         window['-SLIDER-TRIG-'].set_cursor("sb_v_double_arrow")
         return fig_agg, ax, window, canvas, fig_agg_error, ax_error
 
-    def initial_set_up(self):
-        """Initial set up for gui and settings"""
-        laser_name, desired_offset, default_pos, default_scale = get_laser_info(
-            self.dict_laser_info)  # gets laser information from dictionary
-        pos = default_pos  # sets current pos to default pos
-        scale = default_scale  # sets current scale to default scale
-        # match gui to settings
-        self.gui_initial_settings()
-        # flips up the mirror for faster calibration
-        FlipperControl.flipper_on()
-        status_osc = True
-        mirror_error = False
-        in_MHz = None
-        return laser_name, pos, scale, default_pos, default_scale, self.dict_laser_info, self.locking, self.change_pos, self.continue_lock, self.peaks_identified, self.stage, self.prev_peaks, self.mirror_up, self.loc_mirror, self.show_trig_sig, self.laser_lock_status, self.one_HeNe_FSR, self.stage, self.peaks_identified, self.hene_peak, self.ident_peaks, mirror_error, in_MHz, status_osc
-
     def gui_initial_settings(self):
         """Initial settings, based on the first row in CSV. Sets proper values from dictionary for variables and GUI"""
         laser_name, desired_offset, default_pos, default_scale = get_laser_info(self.dict_laser_info)
@@ -354,41 +412,7 @@ class GUIStartUP:
         self.window["-SEL-LASER-"].update(value=f'Laser: {laser_name}')
         self.window["-SCALE-VALUE-"].update(value=default_scale)
         self.window["-SLIDER-POS-"].update(value=default_pos)
-
-
-# Voltage output graph
-class ErrorValuesGraph:
-    def __init__(self, correction, voltage_out):
-        self.correction = correction
-        self.voltage_out = voltage_out
-
-    def graph_error_signal(self, ax_error):
-        global qy
-        correction_array = self.error_array()  # updates correction array
-        try:
-            ax_error.spines['top'].set_visible(False)
-            ax_error.spines['right'].set_visible(False)
-            ax_error.spines['bottom'].set_position('zero')
-            ax_error.set_ylabel("Volts", labelpad=0.2)
-            ax_error.xaxis.set_visible(False)
-            max_cor = np.amax(np.abs(correction_array))
-            ax_error.set_ylim([-max_cor - 0.05, max_cor + 0.05])
-            ax_error.set_xlim([0, 51])
-            line_colour = "#ED798D"
-            ax_error.plot(correction_array, color=line_colour, linewidth=2)
-            ax_error.text(len(correction_array), correction_array[-1],
-                          f'{correction_array[-1]:.3f}')  # text displaying most recent voltage output value
-        except (TypeError, ValueError):
-            pass
-
-    def error_array(self):
-        """Updates correction array with new correction value. Only keeps 50 most recent data points"""
-        global correction_array
-        if self.correction is not None and self.voltage_out:
-            correction_array = np.append(correction_array, self.correction)
-            if len(correction_array) >= 50:
-                correction_array = np.delete(correction_array, 0)
-        return correction_array
+        show_gains(self.window, self.dict_laser_info, laser_name)
 
 
 def draw_mirror_slider(graph, loc):
@@ -419,74 +443,42 @@ def draw_mirror_slider(graph, loc):
     graph.set_cursor("hand2")
 
 
-def update_gui(window, fig_agg, separation, num_peaks, status_osc, ax, laser_lock_status, waveform,
+def update_gui(view, waveform_plot, separation, num_peaks, status_osc, laser_lock_status, waveform,
                peaks_loc, loc_mirror, in_nm, in_MHz, trigger_data, loc_closest,
-               peaks_identified, stage, ax_error, correction, fig_agg_error, voltage_out, len_waveform, rapid_data,
-               res_rate):
-    """Updates all GUI values and graphics"""
+               peaks_identified, stage, error_plot, correction_history, len_waveform, rapid_data,
+               achieved_rate, laser_locks=None, expected_peaks=2):
+    """Updates all GUI values and graphics. view is the WidgetView of the main window, widgets are only updated if changed"""
     # only show peak separation if has been converted to MHz. Small bug where it shows the non MHz version for one loop but shouldn't affect functionality
     try:
         if in_MHz is not None:
-            window['-SEP-TEXT-'].update(value=f'Peak Separation: {separation:.2f}  MHz')
+            view.update('-SEP-TEXT-', value=f'Peak Separation: {separation:.2f}  MHz')
     except ValueError:
-        window['-SEP-TEXT-'].update(value=f'Peak Separation: N/A')
+        view.update('-SEP-TEXT-', value=f'Peak Separation: N/A')
     status_peak = status_indicator(num_peaks, separation,
-                                   in_MHz)  # True if there are two peaks and peaks are not 3000 MHz apart (indicating that they are from the same laser)
+                                   in_MHz, expected_peaks)  # True if there are two peaks and peaks are not 3000 MHz apart (indicating that they are from the same laser)
     # update peaks status + LED. If value is True, LED is green, else the LED is red. Could be made into a separate function
-    GUILED(window).setLED('-LED-PEAK-', 'forest green' if status_peak else 'tomato')
-    GUILED(window).setLED('-LED-OSC-', 'forest green' if status_osc else 'tomato')
-    GUILED(window).setLED('-LED-LOCK-', 'forest green' if laser_lock_status else 'tomato')
+    view.set_led('-LED-PEAK-', 'forest green' if status_peak else 'tomato')
+    view.set_led('-LED-OSC-', 'forest green' if status_osc else 'tomato')
+    view.set_led('-LED-LOCK-', 'forest green' if laser_lock_status else 'tomato')
     # progress bar for peak identity
     if stage != 0:
-        window["-PROG-BAR-"].update(visible=True)
+        view.update("-PROG-BAR-", visible=True)
     else:
-        window["-PROG-BAR-"].update(visible=False)
-    # makes response rate 1.5 if in slow data collection and chosen response rate <1.5. Doesn't change value in CSV until user changes value
-    if not rapid_data and res_rate < 1.5:
-        window['-V-RATE-'].update(value=1.5)
+        view.update("-PROG-BAR-", visible=False)
+    # separation and lock of each laser in multi laser locking
+    if laser_locks:
+        view.update('-MULTI-LOCK-TEXT-', visible=True, value='   '.join(
+            f'{name}: ' + (f'{laser_separation:.2f} MHz' if laser_separation is not None else 'no dip') +
+            (' (locked)' if locked else '') for name, (laser_separation, correction, locked) in laser_locks.items()))
+    else:
+        view.update('-MULTI-LOCK-TEXT-', visible=False)
+    # voltage writes per second achieved by the control scheduler (controls.control_scheduler). Shown to 0.1 Hz so it doesn't change every frame
+    view.update('-V-RATE-ACHIEVED-', value=f'Achieved: {achieved_rate:.1f} Hz' if achieved_rate else 'Achieved: N/A')
     # mirror slider
-    draw_mirror_slider(window["-MIRROR-CONTROL-"], loc_mirror)
-    # clear plots and draw new graph. would be faster not to redraw axis but cannot figure out how to do it without clearing the entire plot (and still have the tick marks move according to data values)
-    ax.clear()
-    ax.grid()
-    ax.minorticks_on()
-    animate(ax, waveform, peaks_loc, in_MHz, trigger_data, loc_closest, peaks_identified, len_waveform)
-    fig_agg.draw()
-    ErrorValuesGraph(correction, voltage_out).graph_error_signal(ax_error)
-    fig_agg_error.draw()
-    ax_error.clear()
-    ax_error.grid()
-    ax_error.minorticks_on()
-
-
-def animate(ax, waveform, peaks_loc, in_MHz, trigger_data, hene_peak, peaks_identified, len_waveform):
-    line_colour = "#5F9EA0"
-    x_axis_points, peaks_loc_cal, x_axis_points_trig, hene_peak_cal = OSCCalibration.cal_hene(in_MHz, ax, peaks_loc,
-                                                                                              trigger_data, hene_peak,
-                                                                                              len_waveform)
-    # plot the signal, and the first 2 detected peaks by scipy
-
-    if len(trigger_data) != 0:
-        ax.plot(x_axis_points_trig, -trigger_data)
-    # plot waveform
-    ax.plot(x_axis_points, waveform, color=line_colour, linewidth=2)
-    ax.plot(peaks_loc_cal, waveform[peaks_loc], 'x', color="#7223B4", linewidth=2)
-    # plot hene peak identifiers
-    if peaks_identified and hene_peak is not None:  # plots red x and "HeNe" text on HeNe peak
-        ax.plot(hene_peak_cal, waveform[hene_peak], 'x', color="r", linewidth=10)
-        ax.text(hene_peak_cal, (waveform[hene_peak] - 2), "HeNe")
-    # set axis limits to reduce movement of axis
-    if -15 <= min(waveform) <= 1:
-        ax.set_ylim([-15, 1])
-    # turn off top and right axis for aesthetics
-    ax.spines['top'].set_visible(False)
-    ax.spines['right'].set_visible(False)
-    # label x-axis in MHz only when calibrated and HeNe peak identified
-    if in_MHz is not None and hene_peak is not None:
-        ax.set_xlabel("MHz", labelpad=0.2)
-    # label y-axis
-    ax.set_ylabel("Millivolts", labelpad=0.2)
-    ax.yaxis.set_major_formatter(FormatStrFormatter('%.00f'))
+    view.mirror_slider("-MIRROR-CONTROL-", loc_mirror)
+    # update plots. Only the lines/markers are redrawn, axes are redrawn when the calibration or scale changes
+    waveform_plot.update(waveform, peaks_loc, in_MHz, trigger_data, loc_closest, peaks_identified, len_waveform)
+    error_plot.update(correction_history.view(ERROR_GRAPH_POINTS))
 
 
 ##########################################
@@ -495,34 +487,37 @@ def animate(ax, waveform, peaks_loc, in_MHz, trigger_data, hene_peak, peaks_iden
 class GUIEvents:
     def __init__(self, window=None, default_pos=None, default_scale=None, dict_laser_info=None, laser_name=None,
                  change_pos=None, instr=None,
-                 fname=None):
+                 store=None, daq=None, correction_history=None):
         self.change_pos = change_pos
         self.default_pos = default_pos
         self.default_scale = default_scale
         self.dict_laser_info = dict_laser_info
         self.laser_name = laser_name
-        self.fname = fname
+        self.store = store  # laser_store.LaserStore, owns dict_laser_info
         self.window = window
         self.desired_offset = None
         self.res_rate = self.dict_laser_info[self.laser_name][4]
         self.instr = instr
+        self.daq = daq
+        self.correction_history = correction_history
 
     def check_events(self, event, values, pos, window, scale, status_osc, locking, loc_mirror,
                      uncal_sep, one_HeNe_FSR, show_trig_sig,
-                     ident_peaks, peaks_identified, cal_scale, rapid_data):
+                     ident_peaks, peaks_identified, cal_scale, cal_points, rapid_data, lock_lasers, len_waveform,
+                     in_MHz=None):
         """Check all events in the GUI and react accordingly"""
-        manual_adj_V = 0
         if event in '-SLIDER-MANUAL-V-':
             manual_voltage = float(values['-SLIDER-MANUAL-V-'])
-            ErrorValuesGraph(manual_voltage, True).error_array()
-            DAQ.daq_output(manual_voltage)
+            self.correction_history.push(manual_voltage)
+            self.daq.daq_output(manual_voltage)
         if event in '-RETURN0-MANUALV-':
             manual_voltage = 0
-            ErrorValuesGraph(manual_voltage, True).error_array()
-            DAQ.daq_output(manual_voltage)
+            self.correction_history.push(manual_voltage)
+            self.daq.daq_output(manual_voltage)
             window['-SLIDER-MANUAL-V-'].update(value=0)
-        if event in '-V-CAL-MANUAL-ADJ-':
-          manual_adj_V = float(values['-V - CAL - MANUAL - ADJ -'])
+        if event in '-SET-GAINS-':
+            # saves the lock gains of the selected laser
+            self.set_gains(values)
 
         if event == '-EXIT-' or event == sg.WIN_CLOSED:
             self.close_window()
@@ -531,6 +526,20 @@ class GUIEvents:
             window.DisableClose = True
             scale, pos = self.change_laser()
             window.DisableClose = False
+            rapid_data = use_laser_profile(self.instr, window, self.dict_laser_info, self.laser_name, rapid_data)
+        if event in "-MULTI-LOCK-":
+            # choose lasers to lock together and their DAQ channels. Peaks have to be identified again for the new number of dips
+            window.DisableClose = True
+            new_lock_lasers = self.open_multi_lock_window(lock_lasers)
+            window.DisableClose = False
+            if new_lock_lasers != lock_lasers:
+                lock_lasers = new_lock_lasers
+                ident_peaks = True
+        if event in "-LOCK-STATS-":
+            # lock statistics of the selected laser. The lock keeps running while the window is open
+            window.DisableClose = True
+            self.open_lock_statistics_window()
+            window.DisableClose = False
         if event in "-SLIDER-MANUAL-V-":
             correction = float(values['-SLIDER-MANUAL-V-'])
             # DAQ_control.DAQ().daq_output(correction)
@@ -581,7 +590,7 @@ class GUIEvents:
             show_trig_sig = self.hide_trigger(show_trig_sig)
         if event in "-CHANGE-SCALE-SETUP-":
             # changes scaling factor
-            one_HeNe_FSR, cal_scale = check_FSR(one_HeNe_FSR, uncal_sep, scale, rapid_data)
+            one_HeNe_FSR, cal_scale, cal_points = check_FSR(one_HeNe_FSR, uncal_sep, scale, rapid_data, len_waveform)
         if event in "-IDEN-PEAKS-":
             # initiates peak identification process
             ident_peaks = True
@@ -594,20 +603,18 @@ class GUIEvents:
             # changes number of waveforms used by oscilloscope for averaging
             avg = str(values["-AVG-COUNT-"])
             self.instr.write('ACQuire:AVERage:COUNt ' + avg)
-        return pos, self.default_pos, self.default_scale, scale, status_osc, locking, self.change_pos, self.laser_name, self.dict_laser_info, loc_mirror, one_HeNe_FSR, show_trig_sig, ident_peaks, status_osc, cal_scale, rapid_data, manual_adj_V
+        if event in "-TUNE-ACQ-":
+            # measures the acquisition profiles in the acquisition thread, "-ACQ-TUNED-" when done
+            self.tune_acquisition(locking, in_MHz, len_waveform, lock_lasers)
+        if event == "-ACQ-TUNED-":
+            rapid_data = self.save_acquisition_profile(values[event], rapid_data)
+        return pos, self.default_pos, self.default_scale, scale, status_osc, locking, self.change_pos, self.laser_name, self.dict_laser_info, loc_mirror, one_HeNe_FSR, show_trig_sig, ident_peaks, status_osc, cal_scale, cal_points, rapid_data, lock_lasers
 
     # CLOSE WINDOW
     def close_window(self):
-        """Closes main window. First rewrites CSV file in order to have last selected laser to open first upon the next start-up"""
-        with open(self.fname, 'r+') as dF:  # wipes CSV file
-            dF.truncate()
-        with open(self.fname, 'a') as f:  # rewrites CSV file
-            self.dict_laser_info.move_to_end(self.laser_name,
-                                             last=False)  # moves selected laser to the first position in dict
-            writer = csv.writer(f)
-            for key, value in self.dict_laser_info.items():
-                value.insert(0, key)
-                writer.writerow(value)
+        """Closes main window. First saves the laser settings with the last selected laser first, to open first upon the next start-up"""
+        self.store.select(self.laser_name)  # moves selected laser to the first position in dict
+        self.store.flush()  # written to a temporary file and renamed, the old file stays until the new one is complete
         self.window.close()  # closes main window
         raise SystemExit("Main Window Closed")  # for confirmation that program didn't crash
 
@@ -619,10 +626,53 @@ class GUIEvents:
         # updates GUI texts to match changed variable values
         self.window["-OFF-TEXT-"].update(value=f'Desired Offset: {self.desired_offset} MHz')
         self.window["-SEL-LASER-"].update(value=f'Laser: {self.laser_name}')
+        show_gains(self.window, self.dict_laser_info, self.laser_name)
         scale = self.default_scale
         pos = self.default_pos
         return scale, pos
 
+    # MULTI LASER LOCK
+    def open_multi_lock_window(self, lock_lasers):
+        """Opens multi laser lock window. Saves the DAQ channels of the lasers in CSV/Dict. Returns the lasers to lock
+        together, None if fewer than 2 are selected or the window is cancelled"""
+        multi_lock_window = sg.Window("Multi Laser Lock", GUILayout.multi_lock_layout(self.dict_laser_info, lock_lasers),
+                                      finalize=True, modal=True)
+        event, values = multi_lock_window.read()
+        multi_lock_window.close()
+        if event != '-MULTI-LOCK-OK-':
+            return lock_lasers
+        for name in self.dict_laser_info:
+            try:
+                channel = int(values[('-MULTI-CHANNEL-', name)])
+                if channel >= 0 and channel != laser_channel(self.dict_laser_info, name):
+                    self.store.set(name, channel=channel)
+            except ValueError:
+                pass  # keeps the saved channel
+        selected = [name for name in self.dict_laser_info if values[('-MULTI-LOCK-', name)]]
+        channels = [laser_channel(self.dict_laser_info, name) for name in selected]
+        if len(set(channels)) != len(channels):
+            sg.popup_auto_close("Each locked laser needs its own DAQ channel", title="Multi Laser Lock Error",
+                                modal=False, auto_close_duration=5)
+            return lock_lasers
+        return selected if len(selected) >= 2 else None
+
+    # LOCK STATISTICS
+    @staticmethod
+    def open_lock_statistics_window():
+        """Opens lock statistics window (controls.lock_statistics), refreshed every second. Can reset and export (JSON)"""
+        statistics_window = sg.Window("Lock Statistics", GUILayout.lock_statistics_layout(), finalize=True, modal=True)
+        while True:
+            statistics_window['-STATS-TEXT-'].update(value="\n".join(summary_text(controls.lock_statistics.summary())))
+            event, values = statistics_window.read(timeout=1000)
+            if event in (sg.WIN_CLOSED, "Close"):
+                break
+            if event == '-STATS-RESET-':
+                controls.lock_statistics.reset(controls.lock_statistics.laser_name)
+            if event == '-STATS-EXPORT-':
+                fname = controls.lock_statistics.export()
+                sg.popup_auto_close(f"Saved to {fname}", title="Lock Statistics", modal=False, auto_close_duration=3)
+        statistics_window.close()
+
     def open_change_laser_window(self):
         """Opens change laser window, and reacts to events"""
         # layout for change laser window
@@ -677,8 +727,6 @@ class GUIEvents:
 
     def get_selected_laser_info(self, change_laser_window):
         """Returns variables corresponding to selected laser and updates values in info box"""
-        # Defines laser info dictionary values from CSV file
-        self.dict_laser_info = laser_settings(self.fname)
         self.default_pos = self.dict_laser_info[self.laser_name][1]  # retrieve default pos for that laser
         self.default_scale = self.dict_laser_info[self.laser_name][2]  # retrieve default scale for that laser
         # updates change laser info text box with values
@@ -689,11 +737,9 @@ class GUIEvents:
         self.window['-POS-TEXT-'].update(value=f'Default Pos: {self.default_pos:.7}')
 
     def delete_laser(self, change_laser_window):
-        """Deletes laser from CSV using del_laser then updates listbox. Automatically selects the first value in listbox"""
-        # deletes laser from CSV
-        CSVControls(self.fname, self.laser_name).del_laser()
-        # remakes laser information dictionary
-        self.dict_laser_info = laser_settings(self.fname)
+        """Deletes laser from the laser store then updates listbox. Automatically selects the first value in listbox"""
+        # deletes laser from dictionary (and CSV)
+        self.store.delete(self.laser_name)
         # updates listbox options with new dictionary keys
         change_laser_window["-SELECT-LASER-"].update(values=self.dict_laser_info.keys())
         # highlights first option in listbox
@@ -712,11 +758,12 @@ class GUIEvents:
         # ensures that entry is valid
         if check_entry(self.laser_name, laser_frequency):
             # ensure all entries are filled
-            new_laser_info = f"{laser_name}, {laser_frequency}, 0.08, 0.002, {laser_volt_frequency}, 1.0"  # 0.08 = def pos for new laser, 0.002 = def scale for new laser, 2 sec = def voltage output rate
-            # adds new laser info to CSV
-            CSVControls(self.fname).add_laser_csv(new_laser_info)
+            try:
+                # adds new laser info to dictionary (and CSV). Default pos, scale, voltage output rate, lock gains, DAQ channel 0
+                self.store.add(laser_name, laser_frequency, laser_volt_frequency)
+            except ValueError:
+                return  # voltage for 1 MHz isn't a number
             self.laser_name = laser_name
-            self.dict_laser_info = laser_settings(self.fname)
             change_laser_window["-SELECT-LASER-"].update(values=self.dict_laser_info.keys())
             change_laser_window["-SELECT-LASER-"].update(set_to_index=len(self.dict_laser_info.keys()) - 1)
             self.get_selected_laser_info(change_laser_window)
@@ -725,18 +772,15 @@ class GUIEvents:
 
     # CHANGE VOLTAGE OUTPUT RATE FUNCTIONS
     def change_V_rate(self, res_rate):
-        """Updates voltage output rate in CSV and dictionary"""
+        """Updates voltage output rate in dictionary (and CSV)"""
         self.res_rate = res_rate
-        CSVControls(self.fname, self.laser_name).update_defaults(self.default_pos, self.default_scale, self.res_rate)
-        self.dict_laser_info = laser_settings(self.fname)
+        self.store.set(self.laser_name, response_rate=self.res_rate)
 
     def user_enter_vrate(self, values, rapid_data):
-        """Updates voltage rate depending on user inputted value. Must be a valid entry. Must be larger than 0.4 (limited by speed of code)"""
+        """Updates voltage rate depending on user inputted value. Must be a valid entry. Must be at least MIN_PERIOD.
+        Rates faster than the oscilloscope frame rate are accepted, the voltage is then written every frame"""
         try:
-            if rapid_data:
-                min_rate = 0.4
-            else:
-                min_rate = 1.2
+            min_rate = MIN_PERIOD
             res_rate = float(values['-V-RATE-'])
             if res_rate >= min_rate:
                 self.change_V_rate(res_rate)
@@ -747,13 +791,9 @@ class GUIEvents:
                 value=self.dict_laser_info[self.laser_name][4])  # makes rate previously saved value
 
     def darrow_vrate(self, values, rapid_data):
-        """Decreases voltage output rate by 0.01 using keyboard down arrow. Limited due to speed of code"""
-        if rapid_data:
-            min_rate = 0.4
-        else:
-            min_rate = 1.2
-        if float(values['-V-RATE-']) >= min_rate:
-            res_rate = round(float(values['-V-RATE-']) - 0.01, 2)
+        """Decreases voltage output rate by 0.01 using keyboard down arrow. Limited to MIN_PERIOD"""
+        res_rate = round(float(values['-V-RATE-']) - 0.01, 2)
+        if res_rate >= MIN_PERIOD:
             self.window["-V-RATE-"].update(value=res_rate)
             self.change_V_rate(res_rate)
 
@@ -763,6 +803,18 @@ class GUIEvents:
         self.window["-V-RATE-"].update(value=res_rate)
         self.change_V_rate(res_rate)
 
+    # LOCK GAINS
+    def set_gains(self, values):
+        """Updates the PID gains of the selected laser in CSV and dictionary. Must be valid numbers, kp and ki not negative"""
+        try:
+            kp, ki, kd = float(values['-GAIN-KP-']), float(values['-GAIN-KI-']), float(values['-GAIN-KD-'])
+            if kp < 0 or ki < 0 or kd < 0:
+                raise ValueError
+            self.store.set(self.laser_name, kp=kp, ki=ki, kd=kd)
+        except ValueError:
+            pass
+        show_gains(self.window, self.dict_laser_info, self.laser_name)  # shows saved values (previous ones if not valid)
+
     # OSC HORIZONTAL POSITION FUNCTIONS
     def enable_change_pos(self):
         """Button that enables/disables changing oscilloscope x-axis position (Reference to trigger). Will enable/disable slider control."""
@@ -777,16 +829,14 @@ class GUIEvents:
         """Changes default pos to current position. Updates CSV/Dict."""
         self.default_pos = float(values['-SLIDER-POS-'])
         self.window['-POS-TEXT-'].update(value=f'Default Pos: {self.default_pos:.6} ')
-        CSVControls(self.fname, self.laser_name).update_defaults(self.default_pos, self.default_scale, self.res_rate)
-        self.dict_laser_info = laser_settings(self.fname)
+        self.store.set(self.laser_name, default_pos=self.default_pos)
 
     # OSC TIME SCALE FUNCTIONS
 
     def change_default_scale(self):
         """Changes default time scale to current scale. Updates CSV/Dict."""
         self.window['-SCALE-TEXT-'].update(value=f'Default Scale: {self.default_scale:.7}')
-        CSVControls(self.fname, self.laser_name).update_defaults(self.default_pos, self.default_scale, self.res_rate)
-        self.dict_laser_info = laser_settings(self.fname)
+        self.store.set(self.laser_name, default_scale=self.default_scale)
 
     # ENABLE/DISABLE LASER LOCK
     def enable_laser_lock(self, locking, peaks_identified, one_HeNe_FSR):
@@ -809,9 +859,9 @@ class GUIEvents:
         """Moves flipper mirror up or down. If user selection is >= 1, mirror is moved up (blocking beam), else it is moved down. """
         loc_mirror = values["-MIRROR-CONTROL-"][1]
         if loc_mirror >= 1.:
-            FlipperControl.flipper_on()
+            flipper.flipper_on()
         elif loc_mirror == 0:
-            FlipperControl.flipper_off()
+            flipper.flipper_off()
         return loc_mirror
 
     @staticmethod
@@ -825,6 +875,45 @@ class GUIEvents:
         self.window["-SHOW-TRIG-"].Update('Hide Trigger Signal' if show_trig_sig else 'Show Trigger Signal')
         return show_trig_sig
 
+    # ACQUISITION PROFILE
+    def tune_acquisition(self, locking, in_MHz, len_waveform, lock_lasers):
+        """Starts tune_profiles for the selected laser. Needs the scale calibration (noise in MHz) and locking off"""
+        if locking:
+            sg.popup_auto_close("Turn off locking before tuning the acquisition", title="Tune Acquisition",
+                                modal=False, auto_close_duration=5)
+            return
+        if in_MHz is None:
+            sg.popup_auto_close("Set up the scale (HeNe FSR) before tuning the acquisition", title="Tune Acquisition",
+                                modal=False, auto_close_duration=5)
+            return
+        expected_peaks = len(lock_lasers) + 1 if lock_lasers else 2
+        period = self.dict_laser_info[self.laser_name][4]
+        window = self.window
+        set_scope_controls(self.window, False)  # the acquisition thread is busy, scope changes would wait on it (or spoil the tuning)
+        self.window["-ACQ-PROFILE-TEXT-"].update(value="Profile: tuning...")
+
+        def run(instr):
+            try:
+                result = tune_profiles(instr, in_MHz * len_waveform, period, expected_peaks)
+            except Exception as error:
+                print("Acquisition tuning failed:", error)
+                result = None, []
+            window.write_event_value("-ACQ-TUNED-", result)  # thread safe
+
+        self.instr.submit(run)
+
+    def save_acquisition_profile(self, result, rapid_data):
+        """Saves the tuned profile for the selected laser. Returns rapid_data (True for waveform rate priority)"""
+        best, measurements = result
+        print_measurements(measurements, best)
+        set_scope_controls(self.window, True)
+        if best is None:
+            sg.popup_auto_close("No acquisition profile showed the expected peaks", title="Tune Acquisition",
+                                modal=False, auto_close_duration=5)
+            return use_laser_profile(self.instr, self.window, self.dict_laser_info, self.laser_name, rapid_data)
+        self.store.set(self.laser_name, profile=best)
+        return show_profile(self.window, best)
+
     def enable_rapid_data(self, rapid_data):
         rapid_data = not rapid_data
         self.window['-RAPID-DATA-'].update(button_color='forest green' if rapid_data else 'LightCyan3')
@@ -835,58 +924,6 @@ class GUIEvents:
         return rapid_data
 
 
-##########################################
-# LASER SETTINGS
-
-class OSCCalibration:
-    @staticmethod
-    def calibrate(scale, one_HeNe_FSR, cal_scale, len_waveform):
-        """Calibrates the x-axis/peak separation assuming a 300 MHz FSR using two HeNe peaks.
-        Use scan generator offset only to change number of HeNe peaks.
-        Changing frequency or amplitude will change calibration and cause improper locking.
-        Assumes waveform from oscilloscope is  3000 points long if not rapid data collection (600 points).
-        """
-        # HeNe wavelength/4/avg. num of indices between HeNe peaks
-
-        try:
-            if len_waveform != 3000 and len_waveform != 600:
-                print("UhOh not the same num of points",
-                      len_waveform)  # not always correct number of points if scaling is too small/big
-            in_MHz = 300 / one_HeNe_FSR * scale / cal_scale * 3000 / len_waveform
-            in_nm = 632 / 4 / one_HeNe_FSR * scale / cal_scale
-        except (TypeError, ZeroDivisionError):
-            in_MHz = None
-            in_nm = None
-        return in_MHz, in_nm
-
-    @staticmethod
-    def cal_hene(in_MHz, ax, peaks_loc, trigger_data, hene_peak, len_waveform):
-        """Calibrates x-axis into nm and changes offset of axis in order to set HeNe peak at 632 nm.
-        Turns on axis labels if calibration is completed."""
-        if in_MHz is not None and hene_peak is not None:
-            ax.xaxis.set_visible(True)  # Turns on x-axis
-            peaks_loc_cal = (peaks_loc * in_MHz)  # Converts peak location into MHz
-            x_axis_points = in_MHz * np.arange(len_waveform)  # calibrates x-axis points into nm
-            x_axis_points_trig = in_MHz * np.arange(len(trigger_data))  # calibrates trigger x-axis into nm
-            if hene_peak is None:
-                hene_peak_cal = None
-            else:
-                hene_peak_cal = hene_peak * in_MHz
-                HeNeError = (hene_peak_cal - 0)
-                x_axis_points = x_axis_points - HeNeError
-                peaks_loc_cal = peaks_loc_cal - HeNeError
-                hene_peak_cal = hene_peak_cal - HeNeError
-                x_axis_points_trig = x_axis_points_trig - HeNeError
-        else:
-            peaks_loc_cal = peaks_loc
-            x_axis_points = np.arange(len_waveform)
-            x_axis_points_trig = np.arange(len(trigger_data))
-            hene_peak_cal = hene_peak
-            ax.xaxis.set_visible(False)
-
-        return x_axis_points, peaks_loc_cal, x_axis_points_trig, hene_peak_cal
-
-
 ##########################################
 #  Pop Ups
 
@@ -907,21 +944,24 @@ def no_peaks_check(lost_peaks, window):
         pass
 
 
-def check_FSR(one_HeNe_FSR, uncal_sep, scale, rapid_data):
+def check_FSR(one_HeNe_FSR, uncal_sep, scale, rapid_data, len_waveform):
     """Popup to ensure user is ready to set calibration.
-    Additional popup if calibration was not successful.
+    Additional popup if calibration was not successful. Returns the HeNe FSR (samples), and the scale and number of
+    points it was measured at.
     """
     cal_scale = None
+    cal_points = None
     ready_for_reset = True if sg.popup_yes_no("Are you sure?", title="Calibration Set Up",
                                               modal=False, keep_on_top=True) == "Yes" else False
     if ready_for_reset and uncal_sep != 0 and uncal_sep is not None and not rapid_data:
         one_HeNe_FSR = uncal_sep
         cal_scale = scale
+        cal_points = len_waveform
     elif ready_for_reset and (uncal_sep == 0 or uncal_sep is None or rapid_data):
         sg.popup_timed("Calibration set up error, try again. Ensure rapid data is disabled.", auto_close_duration=5)
     else:  # add error if they said yes but something wrong with peaks
         one_HeNe_FSR = None
-    return one_HeNe_FSR, cal_scale
+    return one_HeNe_FSR, cal_scale, cal_points
 
 
 def mirror_error_popup():
@@ -949,53 +989,6 @@ def lock_error_scale_popup():
 ##########################################
 # CSV
 
-class CSVControls:
-    def __init__(self, fname, laser_name=None):
-        self.fname = fname
-        self.laser_name = laser_name
-
-    def update_defaults(self, default_pos, default_scale, res_rate):
-        """Updates values in CSV file if user changes default values. Save rows in CSV, clears CSV and rewrites file with new values"""
-        lines = list()
-        with open(self.fname, 'r+') as dF:
-            writer = csv.writer(dF, delimiter=",")
-            reader = csv.reader(dF, delimiter=",")
-            for row in reader:
-                if row == [] or row is None:
-                    pass
-                elif row[0] != self.laser_name:
-                    lines.append(row)
-                else:
-                    row[2] = default_pos
-                    row[3] = default_scale
-                    row[5] = res_rate
-                    lines.append(row)
-            dF.seek(0)
-            dF.truncate()
-            for row in lines:
-                writer.writerow(row)
-
-    def del_laser(self):
-        """Deletes laser from CSV"""
-        lines = list()
-        with open(self.fname, 'r+') as dF:
-            writer = csv.writer(dF, delimiter=",")
-            reader = csv.reader(dF, delimiter=",")
-            for row in reader:
-                if row != [] and row is not None and row[0] != self.laser_name:
-                    lines.append(row)
-            dF.seek(0)
-            dF.truncate()
-            for row in lines:
-                writer.writerow(row)
-
-    def add_laser_csv(self, new_laser_info):
-        """Adds new laser information from dictionary into CSV file"""
-        with open(self.fname, 'a') as ld:
-            ld.write("\n")
-            ld.write(new_laser_info)
-
-
 def check_entry(laser_name, laser_offset):
     try:
         float(laser_offset)
@@ -1016,15 +1009,36 @@ def get_laser_info(dict_laser_info):
     return laser_name, desired_offset, default_pos, default_scale
 
 
-def laser_settings(fname):
-    # make dictionary of laser settings saved in a CSV file
-    with open(fname, 'r') as ld:
-        reader = csv.reader(ld)
-        dict_laser_info = OrderedDict(
-            {rows[0]: [float(rows[1]), float(rows[2]), float(rows[3]), float(rows[4]), float(rows[5])] for rows in
-             reader if
-             rows != []})
-    return dict_laser_info
+# controls that change the oscilloscope, disabled while the acquisition profiles are tuned (about a minute)
+SCOPE_CONTROL_KEYS = ["-TUNE-ACQ-", "-CHANGE-LASER-", "-SLIDER-POS-", "-CHANGE-POS-", "-DEFAULT-POS-", "-DEFAULT-SCALE-",
+                      "-SCALE-VALUE-", "-SLIDER-TRIG-", "-RAPID-DATA-", "-AVG-COUNT-"]
+
+
+def set_scope_controls(window, enabled):
+    for key in SCOPE_CONTROL_KEYS:
+        window[key].update(disabled=not enabled)
+
+
+def use_laser_profile(instr, window, dict_laser_info, laser_name, rapid_data):
+    """Applies the acquisition profile saved for the laser. Returns rapid_data, unchanged if the laser has no profile"""
+    profile = laser_profile(dict_laser_info, laser_name)
+    if profile is None:
+        window["-ACQ-PROFILE-TEXT-"].update(value="Profile: none")
+        return rapid_data
+    apply_profile(instr, profile)
+    return show_profile(window, profile)
+
+
+def show_profile(window, profile):
+    """Shows the acquisition profile in use. Returns rapid_data, the rapid data button is lit for waveform rate priority"""
+    rapid_data = PROFILES[profile].waveform_rate == "MWAVeform"
+    window["-ACQ-PROFILE-TEXT-"].update(value=f"Profile: {profile}")
+    window['-RAPID-DATA-'].update(button_color='forest green' if rapid_data else 'LightCyan3')
+    return rapid_data
+
 
+def show_gains(window, dict_laser_info, laser_name):
+    """Shows the lock gains of the laser in the gain inputs"""
+    for key, gain in zip(('-GAIN-KP-', '-GAIN-KI-', '-GAIN-KD-'), laser_gains(dict_laser_info, laser_name)):
+        window[key].update(value=gain)
 
-correction_array = np.array([])